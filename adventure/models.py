@@ -1,11 +1,10 @@
 import random
 from typing import List, Tuple
 
-from firestore_ci import FirestoreDocument
-
 from adventure.errors import InvalidWinner, NextMatchUpNotPossibleWhenRoundOver, AdventuresNeedToBeSetBeforeOpponents, \
     OpponentRemovedFromRemainingOpponents, \
     NewRoundCreatedWhileRoundIsInProgress, UnableToSetOpponent
+from documents import TrackedDocument
 from models import Group, Player
 
 
@@ -15,7 +14,7 @@ class AdventureConfig:
     PLAYER_RANKS_UPTO: int = 1200
 
 
-class Adventure(FirestoreDocument):
+class Adventure(TrackedDocument):
 
     def __init__(self):
         super().__init__()
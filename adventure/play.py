@@ -1,7 +1,6 @@
 import json
-import random
 from random import sample
-from typing import List, Callable, Tuple
+from typing import List, Callable, Tuple, Dict
 
 from munch import Munch
 
@@ -10,6 +9,7 @@ from adventure.models import Adventure, AdventureConfig
 from adventure.response import StandardResponse, RequestType, SuccessMessage
 from methods import perform_io_task
 from models import Group, Player, Match
+from vote_queue import VoteUnitOfWork
 
 
 def read_groupwise_players() -> dict:
@@ -37,6 +37,13 @@ def set_opponent(adventure: Adventure) -> None:
     return
 
 
+def sample_ranked_players(count: int) -> List[Player]:
+    # One range query for the names of the ranked players. Tied ranks leave holes in the ranks, so the players are sampled.
+    query = Player.objects.filter("rank", ">", 0).filter("rank", "<=", AdventureConfig.PLAYER_RANKS_UPTO)
+    doc_dicts: List[dict] = query.project("name")
+    return [Player.dict_to_doc(doc_dict, doc_dict["id"]) for doc_dict in sample(doc_dicts, k=min(count, len(doc_dicts)))]
+
+
 def create_season(request: Munch) -> Munch:
     rsp: StandardResponse = StandardResponse(request=request, request_type=RequestType.CREATE_SEASON)
     current_adventure: Adventure = get_latest_adventure()
@@ -52,15 +59,11 @@ def create_season(request: Munch) -> Munch:
     # adventurer_group_names: List[str] = sample(list(groupwise_players), k=AdventureConfig.INITIAL_ADVENTURERS_COUNT)
     # new_adventure.adventurers = [sample(groupwise_players[group_name], k=1)[0] for group_name in adventurer_group_names]
     # shuffle(new_adventure.adventurers)
-    player_ranks: List[int] = sample(range(AdventureConfig.PLAYER_RANKS_UPTO), k=AdventureConfig.INITIAL_ADVENTURERS_COUNT + 30)
-    task_list = [Player.objects.filter_by(rank=r).first for r in player_ranks]
-    players: List[Player] = perform_io_task(task_list)
-    players = [p for p in players if p]
+    players: List[Player] = sample_ranked_players(AdventureConfig.INITIAL_ADVENTURERS_COUNT)
     if len(players) < AdventureConfig.INITIAL_ADVENTURERS_COUNT:
-        rsp.message.error = "Unable to set adventures. Try again."
+        rsp.message.error = "Unable to set adventures. Not enough ranked players."
         return rsp.dict
-    random.shuffle(players)
-    new_adventure.set_adventurers(players[:AdventureConfig.INITIAL_ADVENTURERS_COUNT])
+    new_adventure.set_adventurers(players)
     groups: List[Group] = Group.objects.order_by("rank").limit(100).get()
     new_adventure.init_remaining_opponents(groups)
     try:
@@ -84,8 +87,8 @@ def get_adventure_players_groups(rsp) -> Tuple[Adventure, List[Player], List[Gro
     group_names: List[str] = [rsp.request.winner[:2], rsp.request.loser[:2]]
     task_list: List[Callable] = list()
     task_list.append(Adventure.objects.filter_by(season=rsp.request.season, round=rsp.request.round).get)
-    task_list.append(Player.objects.filter("name", Player.objects.IN, player_names).get)
-    task_list.append(Group.objects.filter("name", Group.objects.IN, group_names).get)
+    task_list.append(Player.objects.fresh.filter("name", Player.objects.IN, player_names).get)
+    task_list.append(Group.objects.fresh.filter("name", Group.objects.IN, group_names).get)
     results = perform_io_task(task_list)
     players: List[Player] = next((result for result in results if result and isinstance(result[0], Player)), list())
     groups: List[Group] = next((result for result in results if result and isinstance(result[0], Group)), list())
@@ -132,14 +135,13 @@ def update_play_result(request: dict) -> Munch:
         rsp.message.error = "Unable to find Groups."
         return rsp.dict
     update_score(players, groups, rsp.request.winner)
-    task_list: List[Callable] = [player.save for player in players]
-    task_list.extend([group.save for group in groups])
+    unit_of_work: VoteUnitOfWork = VoteUnitOfWork(synced=[Adventure]).save(*players, *groups)
     adventurer, opponent = adventure.next_match_up()
     match = create_match(adventure.season, adventure.round, adventurer, opponent, rsp.request.winner)
-    task_list.append(match.create)
+    unit_of_work.create(match)
     adventure.update_result(rsp.request.winner, rsp.request.acquired)
-    task_list.append(adventure.save)
-    perform_io_task(task_list)
+    unit_of_work.save(adventure)
+    unit_of_work.commit()
     if not adventure.is_round_over():
         rsp.message.success = SuccessMessage.PLAY_RESULT
         return rsp.dict
@@ -148,10 +150,10 @@ def update_play_result(request: dict) -> Munch:
         rsp.message.error = f"Game is over. You {result}. Create a new season to play again."
         return rsp.dict
     # Create a new round for the adventure in the same season
-    task_list: List[Callable] = [Player.objects.filter_by(name=adventurer).first for adventurer in adventure.adventurers if
-                                 adventurer not in adventure.released]
-    task_list.extend([Player.objects.filter_by(name=adventurer).first for adventurer in adventure.acquired])
-    adventurers: List[Player] = perform_io_task(task_list)
+    adventurer_names: List[str] = [adventurer for adventurer in adventure.adventurers if adventurer not in adventure.released]
+    adventurer_names.extend(adventure.acquired)
+    players_by_name: Dict[str, Player] = Player.objects.get_many_by_names(adventurer_names)
+    adventurers: List[Player] = [players_by_name[name] for name in adventurer_names if name in players_by_name]
     new_round = Adventure.create_next_round(adventure, adventurers)
     try:
         set_opponent(new_round)
@@ -164,18 +166,17 @@ def update_play_result(request: dict) -> Munch:
 
 
 def get_urls(input_player_names: Munch) -> Munch:
-    player_urls: Munch = Munch.fromDict({key: [{"name": name, "url": str(), "rank": int()} for name in player_list]
+    player_urls: Munch = Munch.fromDict({key: [{"name": name, "url": str(), "thumbnail": str(), "rank": int()} for name in player_list]
                                          for key, player_list in input_player_names.items()})
     player_names: List[str] = [name for _, player_list in input_player_names.items() for name in player_list]
-    task_list: List[Callable] = [Player.objects.filter_by(name=player_name).first for player_name in player_names]
-    results = perform_io_task(task_list)
-    players = [player for player in results if player]
+    players: List[Player] = list(Player.objects.get_many_by_names(player_names).values())
 
     def update_player_url(player: Player):
         for key, player_list in player_urls.items():
             for index, _ in enumerate(player_list):
                 if player_urls[key][index].name == player.name:
                     player_urls[key][index].url = player.url
+                    player_urls[key][index].thumbnail = player.url_thumbnail or player.url
                     player_urls[key][index].rank = player.rank
         return
 
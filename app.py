@@ -17,8 +17,11 @@ login = LoginManager(app)
 login.login_view = "login"
 login.session_protection = "strong" if CI_SECURITY else "basic"
 
+from executor import start_request_deadline
 from models import User
 
+app.before_request(start_request_deadline)
+
 @login.user_loader
 def load_user(email: str) -> Optional[User]:
     user: User = User.objects.filter_by(email=email).first()
@@ -37,6 +40,15 @@ app.register_blueprint(s2021_bp)
 app.register_blueprint(adventure_bp)
 app.register_blueprint(super_cup_bp)
 
+from counters import start_compaction
+from ranking import start_refresh
+from vote_queue import VOTE_QUEUE
+
+start_refresh()
+start_compaction()
+if VOTE_QUEUE:
+    VOTE_QUEUE.start()
+
 if __name__ == "__main__":
     app.run()
 
@@ -45,12 +57,13 @@ if __name__ == "__main__":
 def make_shell_context() -> dict:
     import methods
     from s2022 import wc_methods
-    from main import update_url, generate_url
+    from main import update_url, generate_url, update_ranks_and_star_players
     from models import Player, Group, Series, Standing, Match, FINAL_SERIES_TYPES
     from super_cup.models import CupSeries
     from adventure.models import Adventure
     import adventure.play as adventure_play
     import upload
+    from executor import io_executor
     return {
         "User": User,
         "Group": Group,
@@ -60,6 +73,7 @@ def make_shell_context() -> dict:
         "Match": Match,
         "update_url": update_url,
         "generate_url": generate_url,
+        "update_ranks_and_star_players": update_ranks_and_star_players,
         "game_methods": methods,
         "FINAL_SERIES_TYPES": FINAL_SERIES_TYPES,
         "game": upload,
@@ -67,4 +81,5 @@ def make_shell_context() -> dict:
         "CupSeries": CupSeries,
         "Adventure": Adventure,
         "adventure_play": adventure_play,
+        "io_executor": io_executor,
     }
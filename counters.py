@@ -0,0 +1,152 @@
+import logging
+from datetime import datetime
+from itertools import chain
+from threading import Thread
+from time import time, sleep
+from typing import Dict, List, Iterable, Type, Optional
+
+import pytz
+# noinspection PyProtectedMember
+from firestore_ci.firestore_ci import _DB
+from google.api_core.exceptions import NotFound, Conflict
+from google.cloud.firestore import Increment, WriteBatch
+
+from documents import TrackedDocument, CachedDocument
+from executor import io_executor
+from leaderboard import ResultUnitOfWork
+from models import Group, Standing
+
+logger = logging.getLogger(__name__)
+
+# The value of a sharded counter is the one on its document plus the ones on its shards. The shards are folded back
+# into the documents by compact_shards. Every worker runs the compactor started by start_compaction and one of them
+# compacts per period. update_ranks_and_star_players and compact_counters also compact before they run.
+# The fields derived from the sharded counters are only derived again by the compaction. So the stored score of a group,
+# its rank and its leaderboard row all agree with its compacted counters and never count some of the shards only.
+SHARDED_CLASSES = (Group, Standing)
+IN_LIMIT: int = 30  # Maximum number of values Firestore allows in a single IN filter
+COMPACT_SECONDS: int = 300
+LEASE_COLLECTION: str = "counter_compactions"
+
+
+def read_shard_counts(document_class: Type[TrackedDocument], doc_ids: Iterable[str]) -> Dict[str, Dict[str, int]]:
+    doc_ids: List[str] = list(dict.fromkeys(doc_ids))
+    collection = _DB.collection(document_class.shard_collection())
+    chunks: List[List[str]] = [doc_ids[index: index + IN_LIMIT] for index in range(0, len(doc_ids), IN_LIMIT)]
+    results: List[list] = io_executor.run_all([collection.where("document_id", "in", chunk).get for chunk in chunks])
+    counts: Dict[str, Dict[str, int]] = dict()
+    for snapshot in chain.from_iterable(results):
+        shard_dict: dict = snapshot.to_dict()
+        document_counts: Dict[str, int] = counts.setdefault(shard_dict["document_id"], dict())
+        for field in document_class.SHARDED_FIELDS:
+            document_counts[field] = document_counts.get(field, 0) + shard_dict.get(field, 0)
+    return counts
+
+
+def add_shard_counts(documents: List[TrackedDocument]) -> List[TrackedDocument]:
+    # The counts become part of the last read values, so that a later save only sends what changed after this read.
+    # The derived fields keep their stored values.
+    if not documents:
+        return documents
+    counts: Dict[str, Dict[str, int]] = read_shard_counts(type(documents[0]), [document.id for document in documents])
+    for document in documents:
+        if document.id not in counts:
+            continue
+        for field, count in counts[document.id].items():
+            setattr(document, field, getattr(document, field) + count)
+        if document.is_tracked:
+            document.mark_clean()
+    return documents
+
+
+def add_shard_counts_to_dicts(document_class: Type[TrackedDocument], doc_dicts: List[dict]) -> List[dict]:
+    # For the rows of a projection, which have their document id in "id"
+    counts: Dict[str, Dict[str, int]] = read_shard_counts(document_class, [doc_dict["id"] for doc_dict in doc_dicts])
+    for doc_dict in doc_dicts:
+        for field, count in counts.get(doc_dict["id"], dict()).items():
+            doc_dict[field] = doc_dict.get(field, 0) + count
+    return doc_dicts
+
+
+def compact_shards(document_class: Type[TrackedDocument]) -> int:
+    # Takes the counts read from the shards off them in the same batch that adds them to the document. So an increment
+    # that reaches a shard after it was read stays on it for the next compaction and the total never changes.
+    shards: Dict[str, List[tuple]] = dict()  # document id -> [(shard reference, counts)]
+    collection = _DB.collection(document_class.shard_collection())
+    for snapshot in collection.stream():
+        shard_dict: dict = snapshot.to_dict()
+        counts: Dict[str, int] = {field: shard_dict[field] for field in document_class.SHARDED_FIELDS
+                                  if shard_dict.get(field)}
+        if counts:
+            shards.setdefault(shard_dict["document_id"], list()).append((collection.document(snapshot.id), counts))
+    compacted: List[str] = list()
+    for doc_id, document_shards in shards.items():
+        totals: Dict[str, int] = dict()
+        batch: WriteBatch = _DB.batch()
+        for shard_ref, counts in document_shards:
+            batch.update(shard_ref, {field: Increment(-count) for field, count in counts.items()})
+            for field, count in counts.items():
+                totals[field] = totals.get(field, 0) + count
+        batch.update(_DB.collection(document_class.COLLECTION).document(doc_id),
+                     {field: Increment(total) for field, total in totals.items()})
+        try:
+            batch.commit()
+        except NotFound:  # The document was deleted. Its shards go with it.
+            batch = _DB.batch()
+            for shard_ref, _ in document_shards:
+                batch.delete(shard_ref)
+            batch.commit()
+            continue
+        compacted.append(doc_id)
+    if not compacted:
+        return 0
+    if issubclass(document_class, CachedDocument):
+        for doc_id in compacted:
+            document_class.objects.cache.discard(doc_id)
+    # The fields derived from the counters are derived again on load. Where they changed, they are saved and their ranks
+    # and leaderboard rows move with them.
+    references = [_DB.collection(document_class.COLLECTION).document(doc_id) for doc_id in compacted]
+    documents: List[TrackedDocument] = [document_class.dict_to_doc(snapshot.to_dict(), snapshot.id)
+                                        for snapshot in _DB.get_all(references) if snapshot.exists]
+    ResultUnitOfWork().save(*[document for document in documents if document.changed_fields]).commit()
+    return len(compacted)
+
+
+def compact_all_shards() -> int:
+    return sum(compact_shards(document_class) for document_class in SHARDED_CLASSES)
+
+
+def _take_lease(period: int) -> bool:
+    # The first worker to create the lease of a period compacts in it
+    try:
+        _DB.collection(LEASE_COLLECTION).document(str(period)).create({"started": datetime.now(tz=pytz.UTC)})
+    except Conflict:
+        return False
+    _DB.collection(LEASE_COLLECTION).document(str(period - 1)).delete()
+    return True
+
+
+def compact_if_due() -> int:
+    if not _take_lease(int(time() // COMPACT_SECONDS)):
+        return 0
+    return compact_all_shards()
+
+
+_compactor: Optional[Thread] = None
+
+
+def _compact_forever() -> None:
+    while True:
+        sleep(COMPACT_SECONDS)
+        try:
+            compact_if_due()
+        except Exception:
+            logger.exception("Unable to compact the sharded counters.")
+
+
+def start_compaction() -> None:
+    # Called once per worker process at startup
+    global _compactor
+    if _compactor is None:
+        _compactor = Thread(target=_compact_forever, name="counter-compaction", daemon=True)
+        _compactor.start()
@@ -0,0 +1,50 @@
+from concurrent.futures import ProcessPoolExecutor, Future
+from io import BytesIO
+from typing import Dict
+
+from PIL import Image, ImageOps
+
+from images import DERIVATIVE_SIZES
+
+WEBP_QUALITY: int = 80
+
+
+def make_derivatives(file_path: str) -> Dict[str, bytes]:
+    # Runs in a worker process. Returns the WebP bytes of every derivative size of the image.
+    derivatives: Dict[str, bytes] = dict()
+    with Image.open(file_path) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        for size, longest_side in DERIVATIVE_SIZES.items():
+            resized: Image.Image = image.copy()
+            resized.thumbnail((longest_side, longest_side), Image.LANCZOS)
+            buffer: BytesIO = BytesIO()
+            resized.save(buffer, format="WEBP", quality=WEBP_QUALITY, method=6)
+            derivatives[size] = buffer.getvalue()
+    return derivatives
+
+
+class DerivativeStage:
+    # Resizes the images of an upload in a pool of worker processes while the originals are being uploaded.
+
+    def __init__(self, max_workers: int = None):
+        self._pool: ProcessPoolExecutor = ProcessPoolExecutor(max_workers=max_workers)
+        self._futures: Dict[str, Future] = dict()
+
+    def __enter__(self) -> "DerivativeStage":
+        return self
+
+    def __exit__(self, *args):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, file_path: str) -> None:
+        self._futures[file_path] = self._pool.submit(make_derivatives, file_path)
+
+    def discard(self, file_path: str) -> None:
+        future: Future = self._futures.pop(file_path, None)
+        if future:
+            future.cancel()
+
+    def result(self, file_path: str) -> Dict[str, bytes]:
+        # Images that were not submitted ahead are resized now
+        future: Future = self._futures.pop(file_path, None) or self._pool.submit(make_derivatives, file_path)
+        return future.result()
@@ -0,0 +1,465 @@
+from copy import deepcopy
+from itertools import chain
+from random import randrange
+from threading import RLock
+from typing import Optional, List, Dict, Iterable, Tuple
+
+from cachetools import TTLCache
+from firestore_ci import FirestoreDocument, FirestoreQuery
+# noinspection PyProtectedMember
+from firestore_ci.firestore_ci import _DB
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore import WriteBatch, Increment
+
+from executor import io_executor
+
+
+class DocumentCache:
+
+    def __init__(self, maxsize: int, ttl: int):
+        self._documents: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)  # doc_id -> doc_dict
+        self._ids_by_name: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)  # name -> doc_id
+        self._lock: RLock = RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._documents)
+
+    def get_by_id(self, doc_id: str) -> Optional[dict]:
+        with self._lock:
+            doc_dict: Optional[dict] = self._documents.get(doc_id)
+            return deepcopy(doc_dict) if doc_dict is not None else None
+
+    def get_by_name(self, name: str) -> Optional[Tuple[str, dict]]:
+        with self._lock:
+            doc_id: Optional[str] = self._ids_by_name.get(name)
+            doc_dict: Optional[dict] = self._documents.get(doc_id) if doc_id else None
+            if doc_dict is None or doc_dict.get("name") != name:  # Evicted or renamed since it was cached
+                return None
+            return doc_id, deepcopy(doc_dict)
+
+    def put(self, document: FirestoreDocument) -> None:
+        if not document.id:
+            return
+        doc_dict: dict = document.doc_to_dict()
+        with self._lock:
+            self._documents[document.id] = doc_dict
+            if doc_dict.get("name"):
+                self._ids_by_name[doc_dict["name"]] = document.id
+
+    def discard(self, doc_id: str) -> None:
+        with self._lock:
+            doc_dict: Optional[dict] = self._documents.pop(doc_id, None)
+            if doc_dict and self._ids_by_name.get(doc_dict.get("name")) == doc_id:
+                del self._ids_by_name[doc_dict["name"]]
+
+    def invalidate(self, document: FirestoreDocument) -> None:
+        with self._lock:
+            doc_dict: Optional[dict] = self._documents.pop(document.id, None) if document.id else None
+            for name in {getattr(document, "name", None), doc_dict.get("name") if doc_dict else None}:
+                if name and self._ids_by_name.get(name) == document.id:
+                    del self._ids_by_name[name]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._documents.clear()
+            self._ids_by_name.clear()
+
+
+class TrackedDocument(FirestoreDocument):
+    # Remembers the field values last read from or written to Firestore, so that save only sends the changed fields.
+    # A counter changed only through increment is sent as a server-side increment, so that concurrent saves add up.
+    # A unit of work sends the increments of the sharded counters to one of the shards of the document (see counters.py).
+    __slots__ = ("_snapshot", "_increments")
+    SHARDED_FIELDS: Tuple[str, ...] = tuple()
+    DERIVED_FIELDS: Tuple[str, ...] = tuple()  # Set by derive_fields. Left as stored until a compaction when sharded.
+    SHARD_COUNT: int = 8
+
+    def __init__(self):
+        self._snapshot: Optional[dict] = None
+        self._increments: Dict[str, int] = dict()
+        super().__init__()
+
+    @classmethod
+    def init(cls, collection: Optional[str] = None):
+        super().init(collection)
+        cls.objects = TrackedQuery()
+        cls.objects.set_document(cls)
+
+    @classmethod
+    def dict_to_doc(cls, doc_dict: dict, doc_id: Optional[str] = None, cascade: bool = False):
+        document = super().dict_to_doc(doc_dict, doc_id, cascade)
+        if doc_id and not cascade:
+            document.mark_clean({field: value for field, value in doc_dict.items() if field in document.__dict__})
+        document.derive_fields()
+        return document
+
+    def derive_fields(self) -> None:
+        # Recomputes the fields that are derived from others on load. A stored value that differs is saved next time.
+        pass
+
+    @property
+    def is_tracked(self) -> bool:
+        return self._snapshot is not None and bool(self.id) and not self._get_nested_documents()
+
+    @property
+    def changed_fields(self) -> dict:
+        doc_dict: dict = self.doc_to_dict()
+        if not self.is_tracked:
+            return doc_dict
+        return {field: value for field, value in doc_dict.items()
+                if field not in self._snapshot or self._snapshot[field] != value}
+
+    @property
+    def update_fields(self) -> dict:
+        # The changed fields as sent in an update
+        changed_fields: dict = self.changed_fields
+        if not self.is_tracked:
+            return changed_fields
+        return {field: Increment(self._increments[field]) if self._is_incremented(field) else value
+                for field, value in changed_fields.items()}
+
+    def _is_incremented(self, field: str) -> bool:
+        # A counter that was also assigned since it was read is sent as a value
+        last_value = self._snapshot.get(field)
+        return field in self._increments and isinstance(last_value, int) and \
+            last_value + self._increments[field] == getattr(self, field)
+
+    def split_update(self) -> Tuple[dict, Dict[str, int]]:
+        # The fields to update on the document and the increments to add to one of its shards
+        update_fields: dict = self.update_fields
+        increments: Dict[str, int] = {field: self._increments[field] for field in self.SHARDED_FIELDS
+                                      if isinstance(update_fields.get(field), Increment)}
+        if not increments:
+            return update_fields, increments
+        return {field: value for field, value in update_fields.items()
+                if field not in increments and field not in self.DERIVED_FIELDS}, increments
+
+    @classmethod
+    def shard_collection(cls) -> str:
+        return f"{cls.COLLECTION}_shards"
+
+    def random_shard_id(self) -> str:
+        return f"{self.id}-{randrange(self.SHARD_COUNT)}"
+
+    def increment(self, **amounts: int) -> None:
+        for field, amount in amounts.items():
+            setattr(self, field, getattr(self, field) + amount)
+            self._increments[field] = self._increments.get(field, 0) + amount
+
+    def mark_clean(self, doc_dict: Optional[dict] = None) -> None:
+        self._snapshot = deepcopy(doc_dict) if doc_dict is not None else self.doc_to_dict()
+        self._increments = dict()
+
+    def create(self) -> str:
+        doc_id: str = super().create()
+        self.mark_clean()
+        return doc_id
+
+    def save(self, cascade: bool = False) -> bool:
+        if cascade or not self.is_tracked:
+            saved: bool = super().save(cascade)
+            if saved:
+                self.mark_clean()
+            return saved
+        changed_fields: dict = self.changed_fields
+        if changed_fields:
+            try:
+                _DB.collection(self.COLLECTION).document(self.id).update(self.update_fields)
+            except NotFound:  # Deleted since it was read. Recreate it like the full save did.
+                _DB.collection(self.COLLECTION).document(self.id).set(self.doc_to_dict())
+                self.mark_clean()
+                return True
+        self._snapshot.update(deepcopy(changed_fields))
+        self._increments = dict()
+        return True
+
+
+class TrackedQuery(FirestoreQuery):
+
+    def project(self, *field_names: str) -> List[dict]:
+        # Reads only the given fields of the matching documents. The document id is returned in "id".
+        query_ref = self._doc_ref if self._query_ref is None else self._query_ref
+        return [dict(doc.to_dict(), id=doc.id) for doc in query_ref.select(list(field_names)).stream()]
+
+    def create(self, doc_dict: dict):
+        document = super().create(doc_dict)
+        if not self._no_orm:
+            document.mark_clean()
+        return document
+
+    def save(self, input_document):
+        if self._no_orm or not isinstance(input_document, TrackedDocument) or not input_document.is_tracked:
+            document = super().save(input_document)
+            if isinstance(document, TrackedDocument):
+                document.mark_clean()
+            return document
+        return input_document if input_document.save() else None
+
+
+class CachedQuery(TrackedQuery):
+    # Only the unfiltered `filter_by(name=...)` and `filter("name", IN, [...])` shapes are served from the cache.
+    # Every other query goes to Firestore and its results are used to warm the cache.
+    # Reads that feed a save must use `fresh` so that a stale cached score is never written back.
+    IN_LIMIT: int = 30  # Maximum number of values Firestore allows in a single IN filter
+
+    def __init__(self, cache: DocumentCache):
+        super().__init__()
+        self._cache: DocumentCache = cache
+        self._cached_names: Optional[List[str]] = None
+        self._is_filtered: bool = False
+        self._fresh: bool = False
+
+    @property
+    def cache(self) -> DocumentCache:
+        return self._cache
+
+    @property
+    def fresh(self) -> "CachedQuery":
+        object_manager = self._get_object_manager()
+        object_manager._fresh = True
+        return object_manager
+
+    @property
+    def _is_cacheable(self) -> bool:
+        return self._cached_names is not None and not self._no_orm and not self._cascade and not self._fresh
+
+    def _restrict(self, object_manager: "CachedQuery", cached_names: Optional[List[str]] = None) -> "CachedQuery":
+        object_manager._cached_names = cached_names if not self._is_filtered else None
+        object_manager._is_filtered = True
+        return object_manager
+
+    def filter_by(self, **kwargs) -> "CachedQuery":
+        object_manager = super().filter_by(**kwargs)
+        cached_names: Optional[List[str]] = [kwargs["name"]] if set(kwargs) == {"name"} else None
+        return self._restrict(object_manager, cached_names)
+
+    def filter(self, field_name: str, condition: str, field_value: object) -> "CachedQuery":
+        object_manager = super().filter(field_name, condition, field_value)
+        is_name_in: bool = field_name == "name" and condition == self.IN and isinstance(field_value, list)
+        return self._restrict(object_manager, list(field_value) if is_name_in else None)
+
+    def order_by(self, field_name: str, direction: str = FirestoreQuery.ORDER_ASCENDING) -> "CachedQuery":
+        return self._restrict(super().order_by(field_name, direction))
+
+    def limit(self, count: int) -> "CachedQuery":
+        return self._restrict(super().limit(count))
+
+    def _from_cache(self, names: Iterable[str]) -> Dict[str, FirestoreDocument]:
+        documents: Dict[str, FirestoreDocument] = dict()
+        for name in names:
+            cached: Optional[Tuple[str, dict]] = self._cache.get_by_name(name)
+            if cached is None:
+                continue
+            doc_id, doc_dict = cached
+            documents[name] = self._doc_class.dict_to_doc(doc_dict, doc_id)
+        return documents
+
+    def _warm(self, documents: Iterable[FirestoreDocument]) -> None:
+        for document in documents:
+            self._cache.put(document)
+
+    def first(self):
+        if self._is_cacheable and len(self._cached_names) == 1:
+            cached: Dict[str, FirestoreDocument] = self._from_cache(self._cached_names)
+            if cached:
+                return cached[self._cached_names[0]]
+        document = super().first()
+        if document and not self._no_orm:
+            self._warm([document])
+        return document
+
+    def get(self) -> list:
+        if self._is_cacheable:
+            cached: Dict[str, FirestoreDocument] = self._from_cache(self._cached_names)
+            if len(cached) == len(set(self._cached_names)):
+                return list(cached.values())
+        documents: list = super().get()
+        if not self._no_orm:
+            self._warm(documents)
+        return documents
+
+    def get_many_by_names(self, names: Iterable[str]) -> Dict[str, FirestoreDocument]:
+        unique_names: List[str] = list(dict.fromkeys(name for name in names if name))
+        documents: Dict[str, FirestoreDocument] = self._from_cache(unique_names) \
+            if not self._is_filtered and not self._fresh else dict()
+        missing_names: List[str] = [name for name in unique_names if name not in documents]
+        chunks: List[List[str]] = [missing_names[index: index + self.IN_LIMIT]
+                                   for index in range(0, len(missing_names), self.IN_LIMIT)]
+        results: List[list] = io_executor.run_all([self.filter("name", self.IN, chunk).get for chunk in chunks])
+        for document in chain.from_iterable(results):
+            documents[document.name] = document
+        return documents
+
+    def create(self, doc_dict: dict):
+        document = super().create(doc_dict)
+        if not self._no_orm:
+            self._warm([document])
+        return document
+
+    def save(self, input_document):
+        try:
+            document = super().save(input_document)
+        except Exception:
+            if not isinstance(input_document, dict):
+                self._cache.invalidate(input_document)
+            raise
+        if document and not self._no_orm:
+            self._warm([document])
+        return document
+
+
+class CachedDocument(TrackedDocument):
+    # Read-through cache shared by all the query managers of a model. It is keyed by document id and by name.
+    CACHE_MAXSIZE: int = 4096
+    CACHE_TTL: int = 60  # seconds. Bounds the staleness of documents written by other workers.
+
+    @classmethod
+    def init(cls, collection: Optional[str] = None):
+        super().init(collection)
+        cls.objects = CachedQuery(DocumentCache(maxsize=cls.CACHE_MAXSIZE, ttl=cls.CACHE_TTL))
+        cls.objects.set_document(cls)
+
+    @classmethod
+    def get_by_id(cls, doc_id: str, cascade: bool = False):
+        doc_dict: Optional[dict] = cls.objects.cache.get_by_id(doc_id) if not cascade else None
+        if doc_dict is not None:
+            return cls.dict_to_doc(doc_dict, doc_id)
+        document = super().get_by_id(doc_id, cascade)
+        if document:
+            cls.objects.cache.put(document)
+        return document
+
+    def create(self) -> str:
+        doc_id: str = super().create()
+        self.objects.cache.put(self)
+        return doc_id
+
+    def save(self, cascade: bool = False) -> bool:
+        try:
+            saved: bool = super().save(cascade)
+        except Exception:
+            self.objects.cache.invalidate(self)
+            raise
+        if saved:
+            self.objects.cache.put(self)
+        return saved
+
+    def delete(self, cascade: bool = False) -> str:
+        self.objects.cache.invalidate(self)
+        return super().delete(cascade)
+
+
+Write = Tuple[str, str, str, dict]  # (set, update or merge, collection, document id, fields)
+
+
+def add_writes(batch: WriteBatch, writes: Iterable[Write]) -> WriteBatch:
+    for operation, collection, doc_id, fields in writes:
+        doc_ref = _DB.collection(collection).document(doc_id)
+        if operation == "update":
+            batch.update(doc_ref, fields)
+        elif operation == "merge":
+            batch.set(doc_ref, fields, merge=True)
+        else:
+            batch.set(doc_ref, fields)
+    return batch
+
+
+def commit_writes(writes: Iterable[Write]) -> None:
+    add_writes(_DB.batch(), writes).commit()
+
+
+class UnitOfWork:
+    # Collects the documents mutated by a request and commits them in a single atomic WriteBatch.
+    # Either every write is applied or none of them are.
+
+    def __init__(self):
+        self._created: List[FirestoreDocument] = list()
+        self._saved: List[FirestoreDocument] = list()
+        self._sharded: Dict[Tuple[str, str], Dict[str, int]] = dict()  # (collection, id) -> increments sent to a shard
+
+    def __repr__(self):
+        return f"C#{len(self._created)}:S#{len(self._saved)}"
+
+    def create(self, *documents: FirestoreDocument) -> "UnitOfWork":
+        self._created.extend(documents)
+        return self
+
+    def save(self, *documents: FirestoreDocument) -> "UnitOfWork":
+        # Documents of different collections can share an id
+        saved: set = {(document.COLLECTION, document.id) for document in self._saved}
+        for document in documents:
+            if document.id and (document.COLLECTION, document.id) not in saved:
+                self._saved.append(document)
+                saved.add((document.COLLECTION, document.id))
+        return self
+
+    def _writes(self, created_ids: List[str], missing: Iterable[Tuple[str, str]] = ()) -> List[Write]:
+        # The missing documents were deleted since they were read. They are recreated in full like the full save did.
+        self._sharded = dict()
+        missing: set = set(missing)
+        writes: List[Write] = [("set", document.COLLECTION, doc_id, document.doc_to_dict())
+                               for document, doc_id in zip(self._created, created_ids)]
+        for document in self._saved:
+            if not isinstance(document, TrackedDocument) or not document.is_tracked:
+                writes.append(("set", document.COLLECTION, document.id, document.doc_to_dict()))
+            elif document.changed_fields:
+                update_fields, increments = document.split_update()
+                if (document.COLLECTION, document.id) in missing:
+                    doc_dict: dict = document.doc_to_dict()
+                    for field, amount in increments.items():
+                        doc_dict[field] -= amount
+                    writes.append(("merge", document.COLLECTION, document.id, doc_dict))
+                elif update_fields:
+                    writes.append(("update", document.COLLECTION, document.id, update_fields))
+                if increments:
+                    shard_dict: dict = {field: Increment(amount) for field, amount in increments.items()}
+                    writes.append(("merge", document.shard_collection(), document.random_shard_id(),
+                                   dict(shard_dict, document_id=document.id)))
+                    self._sharded[(document.COLLECTION, document.id)] = increments
+        return writes
+
+    def _commit_batch(self, created_ids: List[str], missing: Iterable[Tuple[str, str]] = ()) -> None:
+        writes: List[Write] = self._writes(created_ids, missing)
+        if writes:
+            commit_writes(writes)
+
+    def _missing(self) -> List[Tuple[str, str]]:
+        # The saved documents that an update would not find
+        updated: List[TrackedDocument] = [document for document in self._saved if isinstance(document, TrackedDocument)
+                                          and document.is_tracked and document.changed_fields]
+        references = [_DB.collection(document.COLLECTION).document(document.id) for document in updated]
+        missing_paths: set = {snapshot.reference.path for snapshot in _DB.get_all(references) if not snapshot.exists}
+        return [(document.COLLECTION, document.id) for document, reference in zip(updated, references)
+                if reference.path in missing_paths]
+
+    def commit(self) -> None:
+        created_ids: List[str] = [_DB.collection(document.COLLECTION).document().id for document in self._created]
+        try:
+            try:
+                self._commit_batch(created_ids)
+            except NotFound:  # A saved document was deleted since it was read. Only that one is recreated.
+                self._commit_batch(created_ids, self._missing())
+        except Exception:
+            for document in self._saved:
+                if isinstance(document, CachedDocument):
+                    document.objects.cache.invalidate(document)
+            raise
+        for document, doc_id in zip(self._created, created_ids):
+            document.set_id(doc_id)
+        for document in self._created + self._saved:
+            if isinstance(document, TrackedDocument):
+                document.mark_clean()
+            if isinstance(document, CachedDocument):
+                document.objects.cache.put(self._stored_copy(document))
+        self._created, self._saved = list(), list()
+
+    def _stored_copy(self, document: FirestoreDocument) -> FirestoreDocument:
+        # The cache holds the values stored on the document. Adding its shards to them must not count a vote twice.
+        increments: Optional[Dict[str, int]] = self._sharded.get((document.COLLECTION, document.id))
+        if not increments:
+            return document
+        stored: FirestoreDocument = deepcopy(document)
+        for field, amount in increments.items():
+            setattr(stored, field, getattr(stored, field) - amount)
+        return stored
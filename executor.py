@@ -0,0 +1,100 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from contextvars import ContextVar
+from threading import Lock, local
+from time import monotonic
+from typing import Callable, List, Optional, Iterable
+
+REQUEST_TIMEOUT: int = 25  # seconds. Kept below the gunicorn worker timeout of 30 seconds.
+
+_request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def start_request_deadline(seconds: int = REQUEST_TIMEOUT) -> None:
+    _request_deadline.set(monotonic() + seconds)
+
+
+def get_request_deadline() -> Optional[float]:
+    return _request_deadline.get()
+
+
+class IOExecutor:
+    # One bounded pool per worker process. All the fan-out I/O of concurrent requests shares its threads.
+
+    def __init__(self, max_workers: int):
+        self.max_workers: int = max_workers
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="io")
+        self._worker: local = local()
+        self._lock: Lock = Lock()
+        self._queued: int = 0
+        self._active: int = 0
+        self._completed: int = 0
+        self._cancelled: int = 0
+
+    def __repr__(self):
+        return f"IO:W#{self.max_workers}:Q#{self._queued}:A#{self._active}"
+
+    @property
+    def gauges(self) -> dict:
+        with self._lock:
+            return {"max_workers": self.max_workers, "queue_depth": self._queued, "active_threads": self._active,
+                    "completed": self._completed, "cancelled": self._cancelled}
+
+    @property
+    def in_worker_thread(self) -> bool:
+        return getattr(self._worker, "active", False)
+
+    def _run(self, task: Callable):
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+        self._worker.active = True
+        try:
+            return task()
+        finally:
+            self._worker.active = False
+            with self._lock:
+                self._active -= 1
+                self._completed += 1
+
+    def submit(self, task: Callable, deadline: Optional[float] = None) -> Future:
+        deadline = deadline if deadline is not None else get_request_deadline()
+        if deadline is not None and deadline <= monotonic():
+            raise DeadlineExceeded
+        with self._lock:
+            self._queued += 1
+        return self._executor.submit(self._run, task)
+
+    def cancel(self, futures: Iterable[Future]) -> None:
+        for future in futures:
+            if not future.cancel():
+                continue
+            with self._lock:
+                self._queued -= 1
+                self._cancelled += 1
+
+    def run_all(self, task_list: List[Callable], deadline: Optional[float] = None) -> list:
+        if self.in_worker_thread:
+            # A task that fans out again runs its subtasks inline so that it cannot wait on its own pool.
+            return [task() for task in task_list]
+        deadline = deadline if deadline is not None else get_request_deadline()
+        futures: List[Future] = list()
+        try:
+            for task in task_list:
+                futures.append(self.submit(task, deadline))
+        except DeadlineExceeded:
+            self.cancel(futures)
+            raise
+        timeout: Optional[float] = max(deadline - monotonic(), 0) if deadline is not None else None
+        _, not_done = wait(futures, timeout=timeout)
+        if not_done:
+            self.cancel(not_done)
+            raise DeadlineExceeded
+        return [future.result() for future in futures]
+
+
+io_executor: IOExecutor = IOExecutor(max_workers=int(os.environ.get("IO_MAX_WORKERS", 32)))
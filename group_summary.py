@@ -0,0 +1,99 @@
+from typing import Dict, List, Iterable, Optional
+
+from firestore_ci import FirestoreDocument
+
+from models import Player, Group, Standing
+
+STAR_FIELDS: List[str] = ["url", "url_thumbnail", "url_medium", "url_expiration"]  # Copied from the star player to its group
+TRIGGER_FIELDS: set = {"score", *STAR_FIELDS}
+STANDING_SEASON: int = 2022  # Only the world cup standings copy the star player
+
+
+# The star player of a group is its player with the best score. The group and its world cup standing copy the name and the
+# urls of the star player. The result handlers keep them current for the groups of the players they save and the
+# maintenance runs rebuild every group in one pass over the players.
+
+
+def bucket_by_group(players: Iterable[Player]) -> Dict[str, List[Player]]:
+    players_by_group: Dict[str, List[Player]] = dict()
+    for player in players:
+        players_by_group.setdefault(player.group_name, list()).append(player)
+    return players_by_group
+
+
+def _copy_star(star: Player, group: Group, standing: Optional[Standing]) -> None:
+    group.player_name = star.name
+    for field in STAR_FIELDS:
+        setattr(group, field, getattr(star, field))
+    if not standing:
+        return
+    standing.url_name = star.name
+    standing.url = star.url
+    standing.url_expiration = star.url_expiration
+
+
+def rebuild_group_summaries(players: List[Player], groups: List[Group], standings: List[Standing]) -> None:
+    # Sets the player count, the star player and its copies of every group in memory. The caller saves the changes.
+    players_by_group: Dict[str, List[Player]] = bucket_by_group(players)
+    standing_by_group: Dict[str, Standing] = {standing.group_name: standing for standing in standings}
+    for group in groups:
+        group_players: List[Player] = players_by_group.get(group.name, list())
+        group.player_count = len(group_players)
+        if not group_players:
+            continue
+        star: Player = max(group_players, key=lambda item: item.score)
+        for player in group_players:
+            player.star_player = player is star
+        _copy_star(star, group, standing_by_group.get(group.name))
+
+
+def _find_star(group: Group, scored: List[Player], saved_players: Dict[str, Player]) -> Optional[Player]:
+    star: Optional[Player] = saved_players.get(group.player_name)
+    if not star and group.player_name:
+        star = Player.objects.get_many_by_names([group.player_name]).get(group.player_name)
+    best: Player = max(scored, key=lambda item: item.score)
+    if star and star not in scored:
+        return best if best.score > star.score else star
+    # The star has played or is unknown. Only a scan of its group finds the next best player.
+    group_players: Dict[str, Player] = {player.name: player for player in
+                                        Player.objects.fresh.filter_by(group_name=group.name).get()}
+    group_players.update((player.name, player) for player in scored)
+    return max(group_players.values(), key=lambda item: item.score)
+
+
+def record_star_players(documents: Iterable[FirestoreDocument]) -> List[FirestoreDocument]:
+    # Moves the star players of the groups whose players changed score or url in the given unsaved documents.
+    # Returns the players, groups and standings that have changed and need to be saved with them.
+    saved: List[FirestoreDocument] = list(documents)
+    saved_players: Dict[str, Player] = {document.name: document for document in saved if isinstance(document, Player)}
+    scored: List[Player] = [player for player in saved_players.values() if TRIGGER_FIELDS & set(player.changed_fields)]
+    if not scored:
+        return list()
+    groups: Dict[str, Group] = {document.name: document for document in saved if isinstance(document, Group)}
+    missing: List[str] = [name for name in {player.group_name for player in scored} if name not in groups]
+    if missing:
+        groups.update(Group.objects.get_many_by_names(missing))
+    changed: List[FirestoreDocument] = list()
+    for group_name, group_players in bucket_by_group(scored).items():
+        group: Optional[Group] = groups.get(group_name)
+        if not group:
+            continue
+        old_star_name: str = group.player_name
+        star: Player = _find_star(group, group_players, saved_players)
+        standing: Optional[Standing] = None
+        if star.name != old_star_name or set(STAR_FIELDS) & set(star.changed_fields):
+            standing = Standing.objects.filter_by(season=STANDING_SEASON, group_name=group_name).first()
+        _copy_star(star, group, standing)
+        if star.name != old_star_name:
+            old_star: Optional[Player] = saved_players.get(old_star_name)
+            if not old_star and old_star_name:
+                old_star = Player.objects.get_many_by_names([old_star_name]).get(old_star_name)
+            if old_star:
+                old_star.star_player = False
+                changed.append(old_star)
+            star.star_player = True
+            changed.append(star)
+        changed.append(group)
+        if standing:
+            changed.append(standing)
+    return [document for document in changed if document.changed_fields]
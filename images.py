@@ -0,0 +1,162 @@
+import base64
+import os
+from datetime import datetime, timedelta
+from threading import RLock
+from typing import Dict, Optional, List, Set
+
+import google_crc32c
+# noinspection PyPackageRequirements
+from google.cloud.storage import Client, Bucket, Blob
+
+BUCKET_NAME: str = "za-2021"
+IMAGE_FOLDER: str = "images/"
+IMAGE_EXTENSIONS: List[str] = ["jpg", "jpeg", "png", "webp"]  # In order of preference when a player has more than one
+DERIVATIVE_SIZES: Dict[str, int] = {"thumbnail": 320, "medium": 800}  # Longest side in pixels. Stored in images/<size>/
+DERIVATIVE_EXTENSION: str = "webp"
+CHECKSUM_CHUNK_SIZE: int = 1024 * 1024
+
+
+def get_crc32c(file_path: str) -> str:
+    # Base64 encoded big endian CRC32C of the file, i.e. the format of the crc32c metadata of a cloud storage object.
+    checksum = google_crc32c.Checksum()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHECKSUM_CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode()
+
+
+def get_derivative_name(size: str, player_name: str) -> str:
+    return f"{IMAGE_FOLDER}{size}/{player_name}.{DERIVATIVE_EXTENSION}"
+
+
+class ImageObject:
+
+    def __init__(self, name: str, size: int, crc32c: str, updated: Optional[datetime]):
+        self.name: str = name
+        self.size: int = size
+        self.crc32c: str = crc32c
+        self.updated: Optional[datetime] = updated
+
+    def __repr__(self):
+        return f"{self.name}:{self.size}"
+
+    @property
+    def player_name(self) -> str:
+        return os.path.splitext(os.path.basename(self.name))[0]
+
+    @property
+    def extension(self) -> str:
+        return os.path.splitext(self.name)[1][1:].lower()
+
+    def folder(self, prefix: str) -> str:
+        return os.path.dirname(self.name[len(prefix):])
+
+    @classmethod
+    def from_blob(cls, blob: Blob) -> "ImageObject":
+        return cls(blob.name, blob.size or 0, blob.crc32c or str(), blob.updated)
+
+
+class ImageIndex:
+    # Object names of the images folder, built from one paginated listing and kept in memory.
+    # It replaces the exists() probes per player and extension. URLs are signed locally with the one shared client.
+    # The listing includes the resized derivatives kept in a sub folder per size.
+
+    def __init__(self, bucket_name: str = BUCKET_NAME, prefix: str = IMAGE_FOLDER):
+        self.bucket_name: str = bucket_name
+        self.prefix: str = prefix
+        self._client: Optional[Client] = None
+        self._objects: Dict[str, ImageObject] = dict()
+        self._by_player: Dict[str, ImageObject] = dict()
+        self._by_crc32c: Dict[str, Set[str]] = dict()  # crc32c -> names of the original images with that content
+        self._derivatives: Dict[str, Dict[str, ImageObject]] = {size: dict() for size in DERIVATIVE_SIZES}
+        self._loaded: bool = False
+        self._lock: RLock = RLock()
+
+    def __repr__(self):
+        return f"II:{self.prefix}#{len(self._objects)}"
+
+    def __len__(self):
+        return len(self._objects)
+
+    @property
+    def bucket(self) -> Bucket:
+        with self._lock:
+            if self._client is None:
+                self._client = Client()
+            return self._client.bucket(self.bucket_name)
+
+    def load(self) -> "ImageIndex":
+        objects: Dict[str, ImageObject] = {blob.name: ImageObject.from_blob(blob)
+                                           for blob in self.bucket.list_blobs(prefix=self.prefix)}
+        with self._lock:
+            self._objects = dict()
+            self._by_player = dict()
+            self._by_crc32c = dict()
+            self._derivatives = {size: dict() for size in DERIVATIVE_SIZES}
+            for image in objects.values():
+                self._add(image)
+            self._loaded = True
+        return self
+
+    def _loaded_index(self) -> "ImageIndex":
+        return self if self._loaded else self.load()
+
+    def _add(self, image: ImageObject) -> None:
+        folder: str = image.folder(self.prefix)
+        if folder in self._derivatives and image.extension == DERIVATIVE_EXTENSION:
+            self._objects[image.name] = image
+            self._derivatives[folder][image.player_name] = image
+            return
+        if folder or image.extension not in IMAGE_EXTENSIONS:
+            return
+        replaced: Optional[ImageObject] = self._objects.get(image.name)
+        if replaced:
+            self._by_crc32c.get(replaced.crc32c, set()).discard(replaced.name)
+        self._objects[image.name] = image
+        if image.crc32c:
+            self._by_crc32c.setdefault(image.crc32c, set()).add(image.name)
+        current: Optional[ImageObject] = self._by_player.get(image.player_name)
+        if current is None or IMAGE_EXTENSIONS.index(image.extension) < IMAGE_EXTENSIONS.index(current.extension):
+            self._by_player[image.player_name] = image
+
+    def add(self, blob: Blob) -> None:
+        self._loaded_index()
+        with self._lock:
+            self._add(ImageObject.from_blob(blob))
+
+    def get(self, player_name: str) -> Optional[ImageObject]:
+        return self._loaded_index()._by_player.get(player_name)
+
+    def get_derivative(self, player_name: str, size: str) -> Optional[ImageObject]:
+        return self._loaded_index()._derivatives[size].get(player_name)
+
+    def get_object(self, object_name: str) -> Optional[ImageObject]:
+        return self._loaded_index()._objects.get(object_name)
+
+    def find_by_crc32c(self, crc32c: str) -> Optional[ImageObject]:
+        # An original image with the same content, whatever its name
+        names: Set[str] = self._loaded_index()._by_crc32c.get(crc32c, set())
+        return self._objects[min(names)] if names else None
+
+    def copy(self, source_name: str, object_name: str) -> None:
+        # Server side copy. The bytes do not leave cloud storage.
+        bucket: Bucket = self.bucket
+        blob: Blob = bucket.copy_blob(bucket.blob(source_name), bucket, object_name)
+        self.add(blob)
+
+    def sign_url(self, object_name: str, expiration: timedelta) -> str:
+        return self.bucket.blob(object_name).generate_signed_url(version="v2", expiration=expiration)
+
+    def sign_urls(self, player_name: str, expiration: timedelta) -> Optional[Dict[str, str]]:
+        # Returns the url fields of a player, i.e. url and url_<size> for every derivative. A missing derivative is blank.
+        image: Optional[ImageObject] = self.get(player_name)
+        if not image:
+            return None
+        urls: Dict[str, str] = {"url": self.sign_url(image.name, expiration)}
+        for size in DERIVATIVE_SIZES:
+            derivative: Optional[ImageObject] = self.get_derivative(player_name, size)
+            urls[f"url_{size}"] = self.sign_url(derivative.name, expiration) if derivative else str()
+        return urls
+
+
+IMAGE_INDEX: ImageIndex = ImageIndex()
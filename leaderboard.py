@@ -0,0 +1,163 @@
+import logging
+from datetime import datetime
+from itertools import groupby
+from typing import List, Dict, Optional, Callable, Any, Iterable
+
+import pytz
+# noinspection PyProtectedMember
+from firestore_ci.firestore_ci import _DB
+from google.cloud.firestore import Transaction, DocumentReference, transactional
+from munch import Munch
+
+from documents import TrackedDocument
+from group_summary import record_star_players
+from models import Leaderboard, Player, Group
+from ranking import RankedUnitOfWork
+
+logger = logging.getLogger(__name__)
+
+
+class Board:
+    # A leaderboard materialized in a single document, so that a leaderboard page costs one document read.
+    # A board with a size holds the top rows plus a few spare rows, so that a row dropping out of the top can be replaced
+    # without a query. It is rebuilt from the collection only when it runs out of rows. Boards without a size hold every row.
+    SPARE_ROWS: int = 20
+
+    def __init__(self, name: str, document_class: type, fields: List[str], key: Callable[[dict], Any],
+                 loader: Callable[[Optional[int]], List[TrackedDocument]], size: Optional[int] = None,
+                 rank_field: Optional[str] = None, accepts: Callable[[TrackedDocument], bool] = None,
+                 seasonal: bool = False):
+        self.name: str = name
+        self.document_class: type = document_class
+        self.fields: List[str] = fields
+        self.key: Callable[[dict], Any] = key
+        self.size: Optional[int] = size
+        self.rank_field: Optional[str] = rank_field
+        self.seasonal: bool = seasonal
+        self._loader: Callable[[Optional[int]], List[TrackedDocument]] = loader
+        self._accepts: Callable[[TrackedDocument], bool] = accepts if accepts else lambda document: True
+        _BOARDS.setdefault(document_class.COLLECTION, list()).append(self)
+
+    def __repr__(self):
+        return f"{self.name}:{self.size}"
+
+    def document_id(self, season: Optional[int] = None) -> str:
+        return f"{self.name}-{season}" if self.seasonal else self.name
+
+    def accepts(self, document: TrackedDocument) -> bool:
+        return self._accepts(document)
+
+    def to_row(self, document: TrackedDocument) -> dict:
+        row: dict = {field: getattr(document, field) for field in self.fields}
+        row["id"] = document.id
+        return row
+
+    def _rank(self, rows: List[dict]) -> List[dict]:
+        rows.sort(key=self.key, reverse=True)
+        if not self.rank_field:
+            return rows
+        for _, tied_rows in groupby(enumerate(rows), key=lambda item: self.key(item[1])):
+            tied_rows: list = list(tied_rows)
+            for _, row in tied_rows:
+                row[self.rank_field] = tied_rows[0][0] + 1
+        return rows
+
+    def _trim(self, rows: List[dict], boundary) -> dict:
+        if self.size is not None and len(rows) > self.size + self.SPARE_ROWS:
+            rows = rows[:self.size + self.SPARE_ROWS]
+            boundary = self.key(rows[-1])
+        complete: bool = self.size is None or boundary is None or len(rows) >= self.size
+        return {"rows": rows, "boundary": boundary, "complete": complete, "updated": datetime.now(tz=pytz.UTC)}
+
+    def build(self, documents: Iterable[TrackedDocument]) -> dict:
+        # The loader of a board with a size reads only its top rows. The last of them is the boundary.
+        rows: List[dict] = self._rank([self.to_row(document) for document in documents])
+        is_limited: bool = self.size is not None and len(rows) >= self.size + self.SPARE_ROWS
+        return self._trim(rows, boundary=self.key(rows[-1]) if is_limited else None)
+
+    def merge(self, board_dict: dict, documents: Iterable[TrackedDocument]) -> dict:
+        # Rows whose key falls below the boundary leave the board, since a document outside it may now rank above them.
+        boundary = board_dict.get("boundary")
+        rows_by_id: Dict[str, dict] = {row["id"]: row for row in board_dict.get("rows", list())}
+        for document in documents:
+            row: dict = self.to_row(document)
+            if not row.get("url") and rows_by_id.get(document.id, dict()).get("url"):
+                row["url"] = rows_by_id[document.id]["url"]
+            if boundary is not None and self.key(row) < boundary:
+                rows_by_id.pop(document.id, None)
+                continue
+            rows_by_id[document.id] = row
+        return self._trim(self._rank(list(rows_by_id.values())), boundary)
+
+    def rebuild(self, season: Optional[int] = None) -> List[dict]:
+        board_dict: dict = self.build(self._loader(season))
+        board: Leaderboard = Leaderboard.dict_to_doc(board_dict)
+        board.set_id(self.document_id(season))
+        board.save()
+        return board.rows
+
+    def get(self, season: Optional[int] = None) -> List[Munch]:
+        # A page view never writes. A missing or incomplete board is served from the collection until it is rebuilt.
+        board: Optional[Leaderboard] = Leaderboard.get_by_id(self.document_id(season))
+        rows: List[dict] = board.rows if board and board.complete else self.build(self._loader(season))["rows"]
+        rows = rows[:self.size] if self.size is not None else rows
+        return [Munch(row) for row in rows]
+
+    def record(self, documents: List[TrackedDocument]) -> None:
+        documents = [document for document in documents if document.id and self.accepts(document)]
+        for season, season_documents in groupby(sorted(documents, key=lambda item: self._season(item) or 0), key=self._season):
+            doc_ref: DocumentReference = _DB.collection(Leaderboard.COLLECTION).document(self.document_id(season))
+            _merge_in_transaction(_DB.transaction(), doc_ref, self, list(season_documents))
+
+    def _season(self, document: TrackedDocument) -> Optional[int]:
+        return document.season if self.seasonal else None
+
+
+@transactional
+def _merge_in_transaction(transaction: Transaction, doc_ref: DocumentReference, board: Board,
+                          documents: List[TrackedDocument]) -> None:
+    snapshot = doc_ref.get(transaction=transaction)
+    if not snapshot.exists:  # Built in full by rebuild_leaderboards
+        return
+    transaction.set(doc_ref, board.merge(snapshot.to_dict(), documents))
+
+
+_BOARDS: Dict[str, List[Board]] = dict()
+
+
+def record_leaderboards(documents: Iterable[TrackedDocument]) -> None:
+    documents = list(documents)
+    for collection, boards in _BOARDS.items():
+        board_documents: List[TrackedDocument] = [document for document in documents if document.COLLECTION == collection]
+        if not board_documents:
+            continue
+        for board in boards:
+            try:
+                board.record(board_documents)
+            except Exception:
+                logger.exception(f"Unable to update the leaderboard {board}.")
+
+
+def rebuild_leaderboards() -> None:
+    for board in [board for boards in _BOARDS.values() for board in boards if not board.seasonal]:
+        board.rebuild()
+
+
+class ResultUnitOfWork(RankedUnitOfWork):
+    # Also moves the star players of the groups that played and updates the leaderboards once the results are committed.
+
+    def commit(self) -> None:
+        self.save(*record_star_players(self._saved))
+        saved: List[TrackedDocument] = list(self._saved)
+        super().commit()
+        self._record_leaderboards(saved)
+
+    def _record_leaderboards(self, saved: List[TrackedDocument]) -> None:
+        record_leaderboards(saved)
+
+
+PLAYER_BOARD: Board = Board("players", Player, ["name", "group_name", "url", "score"], key=lambda row: row["score"],
+                            loader=lambda _: Player.objects.order_by("score", Player.objects.ORDER_DESCENDING)
+                            .limit(100 + Board.SPARE_ROWS).get(), size=100, rank_field="rank")
+GROUP_BOARD: Board = Board("groups", Group, ["name", "url", "score"], key=lambda row: row["score"],
+                           loader=lambda _: Group.objects.get(), rank_field="rank")
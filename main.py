@@ -1,81 +1,75 @@
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import deepcopy
 from datetime import timedelta, datetime
-from typing import List, Optional
+from typing import List, Optional, Dict
 
 import pytz
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "google-cloud.json"
 
-# noinspection PyPackageRequirements
-from google.cloud.storage import Client
+from counters import compact_all_shards
+from executor import io_executor
+from group_summary import rebuild_group_summaries, STANDING_SEASON
+from images import IMAGE_INDEX
+from leaderboard import rebuild_leaderboards
 from models import Player, Group, Standing
 from methods import update_rank
+from url_refresh import UrlRefreshScheduler
+# noinspection PyUnresolvedReferences
+from s2022.wc_methods import STANDING_WC_BOARD
 
 
 def generate_url(player: Player) -> Optional[Player]:
-    bucket = Client().bucket("za-2021")
-    possible_filenames: List[str] = [f"images/{player.name}.{ext}" for ext in ("jpg", "jpeg", "png", "webp")]
-    filename: str = next((filename for filename in possible_filenames if bucket.blob(filename).exists()), str())
-    if not filename:
+    expiration: timedelta = timedelta(days=365)
+    urls: Optional[Dict[str, str]] = IMAGE_INDEX.sign_urls(player.name, expiration)
+    if not urls:
         print(f"{player} Storage Image does not exists.")
         return None
-    expiration: timedelta = timedelta(days=365)
     player_with_url: Player = deepcopy(player)
-    player_with_url.url = bucket.blob(filename).generate_signed_url(version="v2", expiration=expiration)
+    for field, url in urls.items():
+        setattr(player_with_url, field, url)
     player_with_url.url_expiration = datetime.now(tz=pytz.UTC) + expiration
     return player_with_url
 
 
 # noinspection PyUnusedLocal
 def update_url(*args, **kwargs):
-    max_workers: int = 30
     print("Update url process started")
     start_time = datetime.now(tz=pytz.UTC)
+    IMAGE_INDEX.load()
+    print(f"{len(IMAGE_INDEX)} images listed.")
+    refreshed_count: int = UrlRefreshScheduler().load().run()
+    if refreshed_count:
+        rebuild_leaderboards()
+    seconds: int = (datetime.now(tz=pytz.UTC) - start_time).seconds
+    print(f"{refreshed_count} urls updated in {seconds} seconds.")
+
+
+# noinspection PyUnusedLocal
+def compact_counters(*args, **kwargs):
+    start_time = datetime.now(tz=pytz.UTC)
+    compacted_count: int = compact_all_shards()
+    seconds: int = (datetime.now(tz=pytz.UTC) - start_time).seconds
+    print(f"{compacted_count} documents compacted in {seconds} seconds.")
+
+
+def update_ranks_and_star_players():
+    # Full rebuild of the ranks, star players and group urls. Only the documents that changed are written.
+    print("Rank rebuild started")
+    start_time = datetime.now(tz=pytz.UTC)
+    compact_all_shards()  # The counters are read from the documents below
     players: List[Player] = Player.objects.get()
-    players.sort(key=lambda item: item.url_expiration)
-    player_count: int = len(players)
-    batch_count: int = len(players) // 50
-    updated_players: List[Player] = players[batch_count:]
-    players = players[:batch_count]
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        threads: set = set()
-        for player in players:
-            threads.add(executor.submit(generate_url, player))
-            thread_count: int = len(threads)
-            if thread_count in {1, batch_count} or thread_count % max_workers == 0:
-                print(f"{thread_count} of {batch_count} threads created.")
-        for future in as_completed(threads):
-            if future.result():
-                updated_players.append(future.result())
-            result_count: int = len(updated_players)
-            if result_count in {1, player_count} or result_count % max_workers == 0:
-                print(f"{result_count} of {player_count} url generated.")
-    update_rank(updated_players)
-    update_rank(updated_players, "wc_rank", "wc_score")
+    update_rank(players)
+    update_rank(players, "wc_rank", "wc_score")
     groups: List[Group] = Group.objects.get()
-    standings: List[Standing] = Standing.objects.filter_by(season=2022).get()
-    for group in groups:
-        players_in_this_group: List[Player] = [player for player in updated_players if player.group_name == group.name]
-        group.player_count = len(players_in_this_group)
-        top_player: Player = max(players_in_this_group, key=lambda item: item.score)
-        if not top_player:
-            continue
-        for player in players_in_this_group:
-            player.star_player = False
-        top_player.star_player = True
-        group.player_name = top_player.name
-        group.url = top_player.url
-        group.url_expiration = top_player.url_expiration
-        standing = next((s for s in standings if s.group_name == group.name), None)
-        if standing:
-            standing.player_name = top_player.name
-            standing.url = top_player.url
-            standing.url_expiration = top_player.url_expiration
+    standings: List[Standing] = Standing.objects.filter_by(season=STANDING_SEASON).get()
+    rebuild_group_summaries(players, groups, standings)
     update_rank(groups)
-    Player.objects.save_all(updated_players)
-    Group.objects.save_all(groups)
-    Standing.objects.save_all(standings)
+    workers: int = io_executor.max_workers
+    updated_players: List[Player] = [player for player in players if player.changed_fields]
+    Player.objects.save_all(updated_players, workers=workers)
+    Group.objects.save_all([group for group in groups if group.changed_fields], workers=workers)
+    Standing.objects.save_all([standing for standing in standings if standing.changed_fields], workers=workers)
+    rebuild_leaderboards()
     seconds: int = (datetime.now(tz=pytz.UTC) - start_time).seconds
-    print(f"All urls updated in {seconds} seconds.")
+    print(f"{len(updated_players)} players updated in {seconds} seconds.")
@@ -0,0 +1,340 @@
+import sys
+from copy import deepcopy
+from itertools import count
+from threading import RLock
+from time import sleep
+from typing import Dict, List, Optional, Tuple, Iterable, Any
+
+# noinspection PyProtectedMember
+from firestore_ci.firestore_ci import _DB, _REFERENCE
+from google.api_core.exceptions import NotFound, AlreadyExists
+from google.cloud.firestore import Query, Increment
+
+from documents import CachedDocument
+
+
+# An in-memory stand-in for the part of the Firestore client that the models use. It counts what a run would cost on
+# Firestore: a query bills one read per document returned (at least one), a lookup one read per key and every set,
+# update or delete one write. Each call that would go over the network is a round trip and sleeps for the latency.
+# A write replaces the stored dict instead of changing it, so that snapshots can share it until they are read.
+
+
+class StoreStats:
+
+    def __init__(self):
+        self.reads: int = 0
+        self.writes: int = 0
+        self.queries: int = 0
+        self.lookups: int = 0
+        self.commits: int = 0
+        self.round_trips: int = 0
+
+    def __repr__(self):
+        return f"R#{self.reads}:W#{self.writes}:Q#{self.queries}:L#{self.lookups}:C#{self.commits}:RT#{self.round_trips}"
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+    def since(self, before: Dict[str, int]) -> Dict[str, int]:
+        return {field: value - before[field] for field, value in self.__dict__.items()}
+
+
+class MemorySnapshot:
+
+    def __init__(self, doc_id: str, doc_dict: Optional[dict], reference: "MemoryDocumentReference" = None):
+        self.id: str = doc_id
+        self.reference: Optional[MemoryDocumentReference] = reference
+        self.exists: bool = doc_dict is not None
+        self._doc_dict: Optional[dict] = doc_dict
+
+    def to_dict(self) -> Optional[dict]:
+        return deepcopy(self._doc_dict)
+
+
+def _matches(doc_dict: dict, field: str, op: str, value: Any) -> bool:
+    if field not in doc_dict:
+        return False
+    field_value = doc_dict[field]
+    if op == "==":
+        return field_value == value
+    if op == "in":
+        return field_value in value
+    if op == "array_contains":
+        return isinstance(field_value, list) and value in field_value
+    if op == "array_contains_any":
+        return isinstance(field_value, list) and any(item in field_value for item in value)
+    if op == "!=":
+        return field_value != value
+    if op == "not-in":
+        return field_value not in value
+    try:
+        return {"<": field_value < value, "<=": field_value <= value, ">": field_value > value,
+                ">=": field_value >= value}[op]
+    except TypeError:  # Firestore only compares values of the same type
+        return False
+
+
+class MemoryQuery:
+
+    def __init__(self, client: "MemoryClient", collection: str):
+        self._client: MemoryClient = client
+        self._collection: str = collection
+        self._filters: List[Tuple[str, str, Any]] = list()
+        self._orders: List[Tuple[str, str]] = list()
+        self._limit: Optional[int] = None
+        self._fields: Optional[List[str]] = None
+
+    def _copy(self) -> "MemoryQuery":
+        query = MemoryQuery(self._client, self._collection)
+        query._filters, query._orders = list(self._filters), list(self._orders)
+        query._limit, query._fields = self._limit, self._fields
+        return query
+
+    def where(self, field_path: str = None, op_string: str = None, value: Any = None, *, filter=None) -> "MemoryQuery":
+        query = self._copy()
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        query._filters.append((field_path, op_string, value))
+        return query
+
+    def order_by(self, field_path: str, direction: str = Query.ASCENDING) -> "MemoryQuery":
+        query = self._copy()
+        query._orders.append((field_path, direction))
+        return query
+
+    def limit(self, count_: int) -> "MemoryQuery":
+        query = self._copy()
+        query._limit = count_
+        return query
+
+    def select(self, field_paths: Iterable[str]) -> "MemoryQuery":
+        query = self._copy()
+        query._fields = list(field_paths)
+        return query
+
+    def stream(self, transaction=None) -> Iterable[MemorySnapshot]:
+        with self._client.lock:
+            documents: Dict[str, dict] = self._client.collection_dict(self._collection)
+            results: List[Tuple[str, dict]] = [(doc_id, doc_dict) for doc_id, doc_dict in documents.items()
+                                               if all(_matches(doc_dict, *item) for item in self._filters)]
+            # Like Firestore, documents without an ordered field are left out and ties are ordered by id.
+            results = [(doc_id, doc_dict) for doc_id, doc_dict in results
+                       if all(field in doc_dict for field, _ in self._orders)]
+            results.sort(key=lambda item: item[0])
+            for field, direction in reversed(self._orders):
+                results.sort(key=lambda item: item[1][field], reverse=direction == Query.DESCENDING)
+            if self._limit is not None:
+                results = results[:self._limit]
+            if self._fields is not None:
+                results = [(doc_id, {field: doc_dict[field] for field in self._fields if field in doc_dict})
+                           for doc_id, doc_dict in results]
+            snapshots = [MemorySnapshot(doc_id, doc_dict, MemoryDocumentReference(self._client, self._collection, doc_id))
+                         for doc_id, doc_dict in results]
+        self._client.record(queries=1, reads=max(1, len(snapshots)))
+        return iter(snapshots)
+
+    def get(self, transaction=None) -> List[MemorySnapshot]:
+        return list(self.stream(transaction))
+
+
+class MemoryDocumentReference:
+
+    def __init__(self, client: "MemoryClient", collection: str, doc_id: str):
+        self._client: MemoryClient = client
+        self._collection: str = collection
+        self.id: str = doc_id
+
+    def __repr__(self):
+        return f"/{self._collection}/{self.id}"
+
+    @property
+    def path(self) -> str:
+        return f"{self._collection}/{self.id}"
+
+    def get(self, field_paths=None, transaction=None) -> MemorySnapshot:
+        with self._client.lock:
+            doc_dict: Optional[dict] = self._client.collection_dict(self._collection).get(self.id)
+        self._client.record(lookups=1, reads=1)
+        return MemorySnapshot(self.id, doc_dict, self)
+
+    def create(self, document_data: dict) -> None:
+        self._client.commit([("create", self, document_data)])
+
+    def set(self, document_data: dict, merge: bool = False) -> None:
+        self._client.commit([("merge" if merge else "set", self, document_data)])
+
+    def update(self, field_updates: dict) -> None:
+        self._client.commit([("update", self, field_updates)])
+
+    def delete(self) -> None:
+        self._client.commit([("delete", self, None)])
+
+
+class MemoryCollection(MemoryQuery):
+
+    def document(self, document_id: Optional[str] = None) -> MemoryDocumentReference:
+        return MemoryDocumentReference(self._client, self._collection, document_id or self._client.new_id())
+
+    def add(self, document_data: dict, document_id: Optional[str] = None) -> Tuple[None, MemoryDocumentReference]:
+        doc_ref: MemoryDocumentReference = self.document(document_id)
+        doc_ref.set(document_data)
+        return None, doc_ref
+
+
+class MemoryBatch:
+    # Applies all its writes at commit or none of them
+
+    def __init__(self, client: "MemoryClient"):
+        self._client: MemoryClient = client
+        self._writes: List[Tuple[str, MemoryDocumentReference, Optional[dict]]] = list()
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, reference: MemoryDocumentReference, document_data: dict, merge: bool = False) -> None:
+        self._writes.append(("merge" if merge else "set", reference, document_data))
+
+    def create(self, reference: MemoryDocumentReference, document_data: dict) -> None:
+        self._writes.append(("create", reference, document_data))
+
+    def update(self, reference: MemoryDocumentReference, field_updates: dict) -> None:
+        self._writes.append(("update", reference, field_updates))
+
+    def delete(self, reference: MemoryDocumentReference) -> None:
+        self._writes.append(("delete", reference, None))
+
+    def commit(self) -> list:
+        self._client.commit(self._writes)
+        self._writes = list()
+        return list()
+
+
+class MemoryTransaction(MemoryBatch):
+    # Only what the transactional decorator of the client library calls. Nothing else writes in between in memory.
+
+    def __init__(self, client: "MemoryClient"):
+        super().__init__(client)
+        self._id: Optional[bytes] = None
+        self._max_attempts: int = 1
+        self._read_only: bool = False
+
+    def _clean_up(self) -> None:
+        self._writes = list()
+        self._id = None
+
+    def _begin(self, retry_id: Optional[bytes] = None) -> None:
+        self._id = b"memory"
+
+    def _rollback(self) -> None:
+        self._clean_up()
+
+    def _commit(self) -> list:
+        result: list = self.commit() if self._writes else list()
+        self._clean_up()
+        return result
+
+
+class MemoryClient:
+
+    def __init__(self, latency: float = 0.0):
+        self.latency: float = latency  # seconds per round trip
+        self.stats: StoreStats = StoreStats()
+        self.lock: RLock = RLock()
+        self._collections: Dict[str, Dict[str, dict]] = dict()
+        self._ids = count(1)
+        self._installed: List[Tuple[Any, str, Any]] = list()
+
+    def __repr__(self):
+        return f"MC:{self.stats}"
+
+    def new_id(self) -> str:
+        return f"{next(self._ids):020d}"
+
+    def collection_dict(self, collection: str) -> Dict[str, dict]:
+        return self._collections.setdefault(collection, dict())
+
+    def record(self, **counts: int) -> None:
+        # Called outside the lock, so that concurrent calls wait for their latency together
+        with self.lock:
+            for field, value in counts.items():
+                setattr(self.stats, field, getattr(self.stats, field) + value)
+            self.stats.round_trips += 1
+        if self.latency:
+            sleep(self.latency)
+
+    def commit(self, writes: List[Tuple[str, MemoryDocumentReference, Optional[dict]]]) -> None:
+        with self.lock:
+            for operation, reference, data in writes:
+                if operation == "update" and reference.id not in self.collection_dict(reference._collection):
+                    raise NotFound(f"No document to update: {reference.path}")
+                if operation == "create" and reference.id in self.collection_dict(reference._collection):
+                    raise AlreadyExists(f"Document already exists: {reference.path}")
+            for operation, reference, data in writes:
+                documents: Dict[str, dict] = self.collection_dict(reference._collection)
+                if operation in ("set", "create"):
+                    documents[reference.id] = {field: self._transform(None, value) for field, value in data.items()}
+                elif operation in ("update", "merge"):
+                    doc_dict: dict = dict(documents.get(reference.id, dict()))
+                    for field, value in data.items():
+                        doc_dict[field] = self._transform(doc_dict.get(field), value)
+                    documents[reference.id] = doc_dict
+                else:
+                    documents.pop(reference.id, None)
+        self.record(commits=1, writes=len(writes))
+
+    @staticmethod
+    def _transform(field_value: Any, value: Any) -> Any:
+        if not isinstance(value, Increment):
+            return deepcopy(value)
+        # Like Firestore, a missing or non-numeric field is incremented from 0
+        is_number: bool = isinstance(field_value, (int, float)) and not isinstance(field_value, bool)
+        return (field_value if is_number else 0) + value.value
+
+    def collection(self, collection_path: str) -> MemoryCollection:
+        return MemoryCollection(self, collection_path)
+
+    def batch(self) -> MemoryBatch:
+        return MemoryBatch(self)
+
+    def transaction(self, **kwargs) -> MemoryTransaction:
+        return MemoryTransaction(self)
+
+    def get_all(self, references: List[MemoryDocumentReference], field_paths=None,
+                transaction=None) -> Iterable[MemorySnapshot]:
+        references = list(references)
+        with self.lock:
+            snapshots = [MemorySnapshot(reference.id, self.collection_dict(reference._collection).get(reference.id), reference)
+                         for reference in references]
+        self.record(lookups=1, reads=len(references))
+        return snapshots
+
+    def install(self) -> None:
+        # Points every module that imported the Firestore client and every model's query manager to this store.
+        # The document caches are cleared, so that no document crosses between the stores.
+        for module in list(sys.modules.values()):
+            if getattr(module, "_DB", None) is _DB and module is not sys.modules[__name__]:
+                self._installed.append((module, "_DB", _DB))
+                setattr(module, "_DB", self)
+        for document_class in _REFERENCE.values():
+            self._installed.append((document_class.objects, "_doc_ref", document_class.objects._doc_ref))
+            document_class.objects._doc_ref = self.collection(document_class.COLLECTION)
+        self._clear_caches()
+
+    def uninstall(self) -> None:
+        for target, name, value in reversed(self._installed):
+            setattr(target, name, value)
+        self._installed = list()
+        self._clear_caches()
+
+    def __enter__(self) -> "MemoryClient":
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.uninstall()
+
+    @staticmethod
+    def _clear_caches() -> None:
+        for document_class in _REFERENCE.values():
+            if issubclass(document_class, CachedDocument):
+                document_class.objects.cache.clear()
@@ -1,4 +1,3 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from functools import wraps
 from typing import List, Union, Optional, Callable
@@ -7,15 +6,10 @@ import pytz
 from flask import request, current_app
 from flask_login import current_user, login_user
 
+from executor import io_executor
 from models import Standing, Group, Player, Match, User
 
 
-def update_rank_and_save(items: List[Union[Player, Group, Standing]], rank="rank", score="score"):
-    updated_items: List[Union[Player, Group, Standing]] = update_rank(items, rank, score)
-    items[0].__class__.objects.save_all(updated_items)
-    return
-
-
 def update_rank(items: List[Union[Player, Group, Standing]], rank="rank", score="score") -> List[Union[Player, Group]]:
     updated_items: List[Union[Player, Group]] = list()
     items.sort(key=lambda p_item: getattr(p_item, score), reverse=True)
@@ -79,9 +73,5 @@ def cookie_login_required(route_function):
     return decorated_route
 
 
-def perform_io_task(task_list: List[Callable]):
-    max_workers = min(100, len(task_list))
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        threads = [executor.submit(task) for task in task_list]
-        results = [future.result() for future in as_completed(threads)]
-    return results
+def perform_io_task(task_list: List[Callable], deadline: Optional[float] = None) -> list:
+    return io_executor.run_all(task_list, deadline)
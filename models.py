@@ -4,10 +4,11 @@ from datetime import datetime, timedelta
 from typing import List
 
 import pytz
-from firestore_ci import FirestoreDocument
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from documents import CachedDocument, TrackedDocument
+
 INITIAL1, INITIAL2, WINNER, LOSER, DECIDER, FINAL = "Initial 1", "Initial 2", "Winner", "Loser", "Decider", "Final"
 SERIES_TYPES = (INITIAL1, INITIAL2, WINNER, LOSER, DECIDER)
 BYE_SERIES_TYPES = (INITIAL1, WINNER, LOSER, DECIDER)
@@ -31,7 +32,7 @@ WC_WIN_MARGIN = {
 }
 
 
-class Match(FirestoreDocument):
+class Match(TrackedDocument):
 
     def __init__(self, season: int = None, week: int = None, round_number: int = None, series_type: str = None,
                  player1: str = None, player2: str = None):
@@ -60,7 +61,7 @@ class Match(FirestoreDocument):
 Match.init("matches")
 
 
-class Series(FirestoreDocument):
+class Series(TrackedDocument):
 
     def __init__(self, season: int = None, week: int = None, round_number: int = None, series_type: str = None,
                  order: int = None):
@@ -75,6 +76,11 @@ class Series(FirestoreDocument):
         self.group_names: List[str] = [TBD, TBD]
         self.winner: str = str()
         self.scores: List[int] = [0, 0]
+        # The series that the winner and the loser play next and their slot (1 or 2) in it. Set in init_series.
+        self.winner_to: str = str()
+        self.winner_slot: int = int()
+        self.loser_to: str = str()
+        self.loser_slot: int = int()
 
     def __repr__(self):
         return f"S{self.season}:O{self.order}:W{self.week}:R{self.round}:" \
@@ -112,11 +118,73 @@ class Series(FirestoreDocument):
         self.group_name2 = group_name
         self.group_names[1] = group_name
 
+    def set_group_name(self, slot: int, group_name) -> None:
+        if slot == 1:
+            self.set_group_name1(group_name)
+        else:
+            self.set_group_name2(group_name)
+
 
 Series.init("series")
 
 
-class Group(FirestoreDocument):
+class SeriesState(TrackedDocument):
+    # Everything the s2021 play loop needs about a series in one document, stored with the id of the series.
+    # The matches are in order and the last one is unplayed while the series is on. Players are a snapshot of both groups.
+    PLAYER_FIELDS = ("name", "group_name", "url")
+
+    def __init__(self):
+        super().__init__()
+        self.season: int = int()
+        self.order: int = int()
+        self.winner: str = str()
+        self.series: dict = dict()
+        self.matches: List[dict] = list()
+        self.players: List[dict] = list()
+        self.standings: List[dict] = list()  # Standing dicts with their "id"
+
+    def __repr__(self):
+        return f"SS{self.season}:O{self.order}:M#{len(self.matches)}:W={self.winner if self.winner else TBD}"
+
+    @staticmethod
+    def _to_doc(document_class, doc_dict: dict):
+        doc_dict = dict(doc_dict)
+        return document_class.dict_to_doc(doc_dict, doc_dict.pop("id", None))
+
+    def get_series(self) -> Series:
+        return Series.dict_to_doc(dict(self.series), self.id)
+
+    def set_series(self, series: Series) -> None:
+        self.series = series.doc_to_dict()
+        self.season = series.season
+        self.order = series.order
+        self.winner = series.winner
+
+    def get_matches(self) -> List[Match]:
+        return [self._to_doc(Match, match) for match in self.matches]
+
+    def set_matches(self, matches: List[Match]) -> None:
+        self.matches = [dict(match.doc_to_dict(), id=match.id) if match.id else match.doc_to_dict() for match in matches]
+
+    def get_players(self) -> List["Player"]:
+        return [self._to_doc(Player, player) for player in self.players]
+
+    def set_players(self, players: List["Player"]) -> None:
+        self.players = [{field: getattr(player, field) for field in self.PLAYER_FIELDS} for player in players]
+
+    def get_standings(self) -> List["Standing"]:
+        return [self._to_doc(Standing, standing) for standing in self.standings]
+
+    def set_standings(self, standings: List["Standing"]) -> None:
+        self.standings = [dict(standing.doc_to_dict(), id=standing.id) for standing in standings]
+
+
+SeriesState.init("series_states")
+
+
+class Group(CachedDocument):
+    SHARDED_FIELDS = ("played", "won")  # Written on almost every vote
+    DERIVED_FIELDS = ("score",)
 
     def __init__(self):
         super().__init__()
@@ -126,6 +194,8 @@ class Group(FirestoreDocument):
         self.player_count: int = int()
         self.player_name: str = str()
         self.url: str = str()
+        self.url_thumbnail: str = str()
+        self.url_medium: str = str()
         self.url_expiration: datetime = datetime.now(tz=pytz.UTC)
         self.qualification_locked: bool = bool()
         self.qualified_player_count: int = int()
@@ -164,15 +234,20 @@ class Group(FirestoreDocument):
         self.rank = 0
 
     def update_score(self, played: int, won: int = 0):
-        self.played += played
-        self.won += won
-        self.score = f"{int(self.won / self.played * 10000):05}{self.played:05}"
+        # A vote on a stored group goes to its shards. Its score is derived again when the shards are compacted.
+        self.increment(played=played, won=won)
+        if not self.is_tracked:
+            self.derive_fields()
+
+    def derive_fields(self) -> None:
+        self.score = f"{int(self.won / self.played * 10000):05}{self.played:05}" if self.played else "0" * 10
 
 
 Group.init()
 
 
-class Standing(FirestoreDocument):
+class Standing(TrackedDocument):
+    SHARDED_FIELDS = ("wc_score", "wc_played", "wc_won")
 
     def __init__(self, season: int = None, group_name: str = None, group_fullname: str = None, url_name: str = None,
                  url: str = None):
@@ -195,8 +270,12 @@ class Standing(FirestoreDocument):
 
     @property
     def wc_score_for_ranking(self) -> int:
-        in_play_bonus = self.eliminated * 10 ** 5 if self.eliminated else 10 ** 8
-        return in_play_bonus + self.wc_score
+        return self.get_wc_score_for_ranking(self.wc_score, self.eliminated)
+
+    @staticmethod
+    def get_wc_score_for_ranking(wc_score: int, eliminated: int) -> int:
+        in_play_bonus = eliminated * 10 ** 5 if eliminated else 10 ** 8
+        return in_play_bonus + wc_score
 
     @property
     def total_score(self) -> int:
@@ -209,16 +288,15 @@ class Standing(FirestoreDocument):
     def wc_update_score(self, won: bool, margin: str, group: Group) -> None:
         win_tag: str = MarginTag.WON if won else MarginTag.LOST
         won: int = 1 if won else 0
-        self.wc_score += WC_WIN_MARGIN[margin][win_tag]
-        self.wc_played += 1
-        self.wc_won += won
+        self.increment(wc_score=WC_WIN_MARGIN[margin][win_tag], wc_played=1, wc_won=won)
         group.update_score(played=1, won=won)
 
 
 Standing.init()
 
 
-class Player(FirestoreDocument):
+class Player(CachedDocument):
+    DERIVED_FIELDS = ("score",)
 
     def __init__(self):
         super().__init__()
@@ -226,6 +304,8 @@ class Player(FirestoreDocument):
         self.group_name: str = str()
         self.star_player: bool = bool()
         self.url: str = str()
+        self.url_thumbnail: str = str()
+        self.url_medium: str = str()
         self.url_expiration: datetime = datetime.now(tz=pytz.UTC)
         self.qualified: bool = bool()
         self.league: int = int()
@@ -252,16 +332,16 @@ class Player(FirestoreDocument):
     def update_score(self, played: int, won: int = 0):
         if not played:
             return
-        self.played += played
-        self.won += won
-        self.score = f"{int(self.won / self.played * 10000):05}{self.played:04}"
+        self.increment(played=played, won=won)
+        self.derive_fields()
+
+    def derive_fields(self) -> None:
+        self.score = f"{int(self.won / self.played * 10000):05}{self.played:04}" if self.played else "0" * 9
 
     def wc_update_score(self, won: bool, margin: str):
         win_tag: str = MarginTag.WON if won else MarginTag.LOST
         won: int = 1 if won else 0
-        self.wc_score += WC_WIN_MARGIN[margin][win_tag]
-        self.wc_played += 1
-        self.wc_won += won
+        self.increment(wc_score=WC_WIN_MARGIN[margin][win_tag], wc_played=1, wc_won=won)
         self.update_score(played=1, won=won)
 
     @classmethod
@@ -272,7 +352,23 @@ class Player(FirestoreDocument):
 Player.init()
 
 
-class User(FirestoreDocument, UserMixin):
+class Leaderboard(TrackedDocument):
+
+    def __init__(self):
+        super().__init__()
+        self.rows: List[dict] = list()
+        self.boundary = None  # Lowest key a document outside the rows can have. None when the rows hold every document.
+        self.complete: bool = bool()
+        self.updated: datetime = datetime.now(tz=pytz.UTC)
+
+    def __repr__(self):
+        return f"{self.id}:R#{len(self.rows)}"
+
+
+Leaderboard.init("leaderboards")
+
+
+class User(TrackedDocument, UserMixin):
     TOKEN_EXPIRY = 3600  # 1 hour = 3600 seconds
 
     def __init__(self):
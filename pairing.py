@@ -0,0 +1,231 @@
+import json
+import random
+from collections import deque
+from functools import partial
+from heapq import heapify, heappop, heappush
+from itertools import product
+from string import ascii_uppercase
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Deque, Tuple, List, Optional, Iterable, Set
+
+from executor import io_executor, DeadlineExceeded
+from models import Player
+
+PlayerPair = Tuple[Player, Player]
+
+
+class PairingQueue:
+    # Ready made pairs of players for the friendly matches of each play mode (top, bottom, random and groupXX).
+    # A request takes the next pair from memory and the queue is topped up in the background, so that the loop from a vote
+    # to the next match runs no pairing query. Only the first request of a mode in a worker fills its queue inline.
+    QUEUE_SIZE: int = 10
+    REFILL_AT: int = 3
+    PLAYER_NAMES_FILE: str = "temp/player_names.json"
+
+    def __init__(self):
+        self._pairs: Dict[str, Deque[PlayerPair]] = dict()
+        self._refilling: set = set()
+        self._lock: Lock = Lock()
+        self._player_names: Optional[List[str]] = None
+
+    def __repr__(self):
+        return f"PQ#{len(self._pairs)}"
+
+    @staticmethod
+    def is_valid_mode(play_from: str) -> bool:
+        return play_from in ("top", "bottom", "random") or (len(play_from) == 7 and play_from[:5] == "group")
+
+    @property
+    def player_names(self) -> List[str]:
+        if self._player_names is None:
+            with open(self.PLAYER_NAMES_FILE) as file:
+                self._player_names = json.load(file)
+        return self._player_names
+
+    def _load_candidates(self, play_from: str) -> List[Player]:
+        if play_from == "top":
+            return Player.objects.order_by("score", Player.objects.ORDER_DESCENDING).limit(100).get()
+        if play_from == "bottom":
+            return Player.objects.order_by("played").limit(20).get()
+        if play_from == "random":
+            names: List[str] = random.sample(self.player_names, k=min(2 * self.QUEUE_SIZE, len(self.player_names)))
+            return list(Player.objects.get_many_by_names(names).values())
+        return Player.objects.filter_by(group_name=play_from[-2:].upper()).get()
+
+    def _make_pairs(self, play_from: str) -> List[PlayerPair]:
+        candidates: List[Player] = self._load_candidates(play_from)
+        if len(candidates) < 2:
+            return list()
+        if play_from == "random":  # Each sampled player plays once
+            random.shuffle(candidates)
+            return list(zip(candidates[::2], candidates[1::2]))
+        return [tuple(random.sample(candidates, k=2)) for _ in range(self.QUEUE_SIZE)]
+
+    def refill(self, play_from: str) -> None:
+        try:
+            pairs: List[PlayerPair] = self._make_pairs(play_from)
+        finally:
+            with self._lock:
+                self._refilling.discard(play_from)
+        with self._lock:
+            self._pairs.setdefault(play_from, deque()).extend(pairs)
+
+    def _popleft(self, play_from: str) -> Tuple[Optional[PlayerPair], bool]:
+        with self._lock:
+            pairs: Deque[PlayerPair] = self._pairs.get(play_from, deque())
+            pair: Optional[PlayerPair] = pairs.popleft() if pairs else None
+            needs_refill: bool = pair is not None and len(pairs) <= self.REFILL_AT and play_from not in self._refilling
+            if needs_refill:
+                self._refilling.add(play_from)
+            return pair, needs_refill
+
+    def pop(self, play_from: str) -> Optional[PlayerPair]:
+        if not self.is_valid_mode(play_from):
+            return None
+        pair, needs_refill = self._popleft(play_from)
+        if pair is None:
+            self.refill(play_from)
+            pair, needs_refill = self._popleft(play_from)
+        if needs_refill:
+            try:
+                io_executor.submit(partial(self.refill, play_from))
+            except DeadlineExceeded:
+                with self._lock:
+                    self._refilling.discard(play_from)
+        return pair
+
+
+FRIENDLY_QUEUE: PairingQueue = PairingQueue()
+
+
+class _NameBag:
+    # Names with O(1) add, remove and random pick. A removed name is swapped with the last one.
+
+    def __init__(self, names: Iterable[str] = ()):
+        self._names: List[str] = list(names)
+        self._index: Dict[str, int] = {name: index for index, name in enumerate(self._names)}
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def remove(self, name: str) -> None:
+        index: int = self._index.pop(name)
+        last: str = self._names.pop()
+        if index < len(self._names):
+            self._names[index] = last
+            self._index[last] = index
+
+    def pick(self, rng) -> str:
+        return self._names[rng.randrange(len(self._names))]
+
+
+class GroupPairing:
+    # Pairs the players of a world cup round so that no pair is from the same group. Every step takes the largest group
+    # and pairs all of its players against a random sample of the players of the other groups. Players who have played
+    # fewer matches are a priority tier: while any are left, the largest group is the one with most of them and only they
+    # are paired from it. A step ends a group, so a round costs O(players) plus a heap operation per step.
+
+    def __init__(self, player_names: Iterable[str], priority_names: Iterable[str] = (), rng=random):
+        self._rng = rng
+        self._pool: _NameBag = _NameBag(dict.fromkeys(player_names))
+        self._buckets: Dict[str, Set[str]] = dict()
+        for name in self._pool:
+            self._buckets.setdefault(self.group_of(name), set()).add(name)
+        self._priority_buckets: Dict[str, Set[str]] = dict()
+        for name in set(priority_names) & set(self._pool):
+            self._priority_buckets.setdefault(self.group_of(name), set()).add(name)
+        self._heap: List[Tuple[int, str]] = self._new_heap(self._buckets)
+        self._priority_heap: List[Tuple[int, str]] = self._new_heap(self._priority_buckets)
+
+    def __repr__(self):
+        return f"GP:P#{len(self._pool)}:G#{len(self._buckets)}:PG#{len(self._priority_buckets)}"
+
+    @staticmethod
+    def group_of(name: str) -> str:
+        return name[:2]
+
+    @staticmethod
+    def _new_heap(buckets: Dict[str, Set[str]]) -> List[Tuple[int, str]]:
+        heap: List[Tuple[int, str]] = [(-len(bucket), group_name) for group_name, bucket in buckets.items()]
+        heapify(heap)
+        return heap
+
+    @staticmethod
+    def _pop_largest(heap: List[Tuple[int, str]], buckets: Dict[str, Set[str]]) -> str:
+        # Buckets only shrink. An entry larger than its bucket is pushed again with the current size. Ties go to the
+        # first group name.
+        while True:
+            size, group_name = heappop(heap)
+            bucket: Optional[Set[str]] = buckets.get(group_name)
+            if not bucket:
+                continue
+            if len(bucket) != -size:
+                heappush(heap, (-len(bucket), group_name))
+                continue
+            return group_name
+
+    def _remove(self, name: str) -> None:
+        self._pool.remove(name)
+        group_name: str = self.group_of(name)
+        for buckets in (self._buckets, self._priority_buckets):
+            bucket: Optional[Set[str]] = buckets.get(group_name)
+            if bucket is None:
+                continue
+            bucket.discard(name)
+            if not bucket:
+                del buckets[group_name]
+
+    def _sample_opposition(self, group_name: str, count: int) -> List[str]:
+        # Rejection sampling. The group is the largest, so at least as many of the picks are outside it on average.
+        opposition: List[str] = list()
+        while len(opposition) < count:
+            name: str = self._pool.pick(self._rng)
+            if self.group_of(name) == group_name:
+                continue
+            self._remove(name)
+            opposition.append(name)
+        return opposition
+
+    def pairs(self) -> List[Tuple[str, str]]:
+        pairs: List[Tuple[str, str]] = list()
+        while len(self._buckets) >= 2:
+            if self._priority_buckets:
+                group_name: str = self._pop_largest(self._priority_heap, self._priority_buckets)
+                selection: List[str] = list(self._priority_buckets[group_name])
+            else:
+                group_name: str = self._pop_largest(self._heap, self._buckets)
+                selection: List[str] = list(self._buckets[group_name])
+            other_count: int = len(self._pool) - len(self._buckets[group_name])
+            if len(selection) > other_count:  # Last step. Everyone outside the group plays.
+                selection = self._rng.sample(selection, k=other_count)
+                opposition: List[str] = [name for name in self._pool if self.group_of(name) != group_name]
+                for name in opposition:
+                    self._remove(name)
+            else:
+                opposition: List[str] = self._sample_opposition(group_name, len(selection))
+            for name in selection:
+                self._remove(name)
+            pairs.extend(zip(selection, opposition))
+        return pairs
+
+
+def benchmark_group_pairing(player_counts: Tuple[int, ...] = (10_000, 100_000), group_count: int = 128,
+                            priority_share: float = 0.1, random_seed: int = 0) -> Dict[int, float]:
+    # Prints and returns the seconds taken to pair a round of each size. Group sizes are skewed like the real groups.
+    rng: random.Random = random.Random(random_seed)
+    group_names: List[str] = ["".join(letters) for letters in product(ascii_uppercase, repeat=2)][:group_count]
+    timings: Dict[int, float] = dict()
+    for player_count in player_counts:
+        weights: List[float] = [rng.paretovariate(1.5) for _ in group_names]
+        names: List[str] = [f"{group_name}{index:06}" for index, group_name in
+                            enumerate(rng.choices(group_names, weights=weights, k=player_count))]
+        priority_names: List[str] = rng.sample(names, k=int(player_count * priority_share))
+        start: float = perf_counter()
+        pairs: List[Tuple[str, str]] = GroupPairing(names, priority_names, rng).pairs()
+        timings[player_count] = perf_counter() - start
+        print(f"{player_count} players in {group_count} groups: {len(pairs)} pairs in {timings[player_count]:.3f}s")
+    return timings
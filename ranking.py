@@ -0,0 +1,241 @@
+import logging
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from threading import RLock, Event, Thread
+from typing import List, Dict, Optional, Iterable, Tuple, Callable, Any
+
+# noinspection PyProtectedMember
+from firestore_ci.firestore_ci import _DB
+from google.cloud.firestore import WriteBatch
+
+from documents import UnitOfWork, TrackedDocument, CachedDocument
+from executor import io_executor
+from models import Player, Group
+
+logger = logging.getLogger(__name__)
+
+
+class RankIndex:
+    # Order statistic index over the score keys of a collection. Keys are kept in ascending order.
+    # The rank of a key is one more than the number of strictly greater keys, so that ties share a rank.
+
+    def __init__(self, items: Iterable[Tuple[str, Any]] = ()):
+        pairs: List[Tuple[Any, str]] = sorted((key, doc_id) for doc_id, key in items)
+        self._keys: List[Any] = [key for key, _ in pairs]
+        self._ids: List[str] = [doc_id for _, doc_id in pairs]
+        self._key_by_id: Dict[str, Any] = {doc_id: key for key, doc_id in pairs}
+
+    def __repr__(self):
+        return f"RI#{len(self)}"
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._key_by_id
+
+    def rank_of(self, key) -> int:
+        return len(self._keys) - bisect_right(self._keys, key) + 1
+
+    def rank(self, doc_id: str) -> Optional[int]:
+        return self.rank_of(self._key_by_id[doc_id]) if doc_id in self._key_by_id else None
+
+    def ordered_ids(self) -> List[str]:
+        return self._ids[::-1]
+
+    def _remove(self, doc_id: str) -> None:
+        key = self._key_by_id.pop(doc_id)
+        index: int = self._ids.index(doc_id, bisect_left(self._keys, key), bisect_right(self._keys, key))
+        del self._keys[index]
+        del self._ids[index]
+
+    def _insert(self, doc_id: str, key) -> None:
+        index: int = bisect_right(self._keys, key)
+        self._keys.insert(index, key)
+        self._ids.insert(index, doc_id)
+        self._key_by_id[doc_id] = key
+
+    def update(self, doc_id: str, key) -> Dict[str, int]:
+        # Returns the new rank of every document whose rank moved. Only the keys between the old and the new key move.
+        old_key = self._key_by_id.get(doc_id)
+        if old_key == key:
+            return dict()
+        if old_key is not None:
+            self._remove(doc_id)
+        self._insert(doc_id, key)
+        if old_key is None:  # A new document moves every lower key down by one
+            start, end = 0, bisect_left(self._keys, key)
+        else:
+            start, end = bisect_left(self._keys, min(old_key, key)), bisect_left(self._keys, max(old_key, key))
+        ranks: Dict[str, int] = self._ranks_in_window(start, end)
+        ranks.pop(doc_id, None)
+        ranks[doc_id] = self.rank_of(key)
+        return ranks
+
+    def _ranks_in_window(self, start: int, end: int) -> Dict[str, int]:
+        return {self._ids[index]: self.rank_of(self._keys[index]) for index in range(start, end)}
+
+
+class Ranking:
+    # Keeps a RankIndex per ranking type in memory. The index is only loaded by refresh, which the background refresher
+    # calls at startup and then periodically to pick up the votes recorded by the other workers.
+    # Until the first refresh completes, the ranks stored on the documents are used as they are.
+    REFRESH_SECONDS: int = 300
+
+    def __init__(self, document_class: type, rank_field: str = "rank", score_field: str = "score",
+                 trigger_fields: Iterable[str] = None, loader: Callable[[], List[Tuple[str, Any]]] = None):
+        self.document_class: type = document_class
+        self.rank_field: str = rank_field
+        self.score_field: str = score_field
+        self.trigger_fields: set = set(trigger_fields) if trigger_fields else {score_field}
+        self._loader: Callable[[], List[Tuple[str, Any]]] = loader if loader else self._load_scores
+        self._index: Optional[RankIndex] = None
+        self._lock: RLock = RLock()
+        _RANKINGS.setdefault(document_class.COLLECTION, list()).append(self)
+
+    def __repr__(self):
+        return f"{self.document_class.__name__}:{self.rank_field}:{self._index}"
+
+    def _load_scores(self) -> List[Tuple[str, Any]]:
+        doc_dicts: List[dict] = self.document_class.objects.project(self.score_field)
+        return [(doc_dict["id"], doc_dict[self.score_field]) for doc_dict in doc_dicts if self.score_field in doc_dict]
+
+    @property
+    def index(self) -> Optional[RankIndex]:
+        return self._index
+
+    def refresh(self) -> None:
+        index: RankIndex = RankIndex(self._loader())
+        with self._lock:
+            self._index = index
+
+    def reset(self) -> None:
+        with self._lock:
+            self._index = None
+        request_refresh()
+
+    def key(self, document: TrackedDocument):
+        return getattr(document, self.score_field)
+
+    def apply(self, documents: List[TrackedDocument]) -> List[TrackedDocument]:
+        # Sets the current rank in memory only. Nothing is written.
+        index: Optional[RankIndex] = self.index
+        if index is None:
+            return documents
+        for document in documents:
+            setattr(document, self.rank_field, index.rank_of(self.key(document)))
+        return documents
+
+    def order(self, documents: List[TrackedDocument]) -> List[TrackedDocument]:
+        # Arranges the documents in rank order using the index order instead of sorting them.
+        index: Optional[RankIndex] = self.index
+        if index is None:
+            return sorted(documents, key=self.key, reverse=True)
+        documents_by_id: Dict[str, TrackedDocument] = {document.id: document for document in documents}
+        ordered: List[TrackedDocument] = [documents_by_id[doc_id] for doc_id in index.ordered_ids()
+                                          if doc_id in documents_by_id]
+        ordered.extend(document for document in documents if document.id not in index)
+        return self.apply(ordered)
+
+    def record(self, document: TrackedDocument) -> Dict[str, int]:
+        # Moves the document in the index and returns the new rank of every document whose rank moved.
+        if not self.trigger_fields & set(document.changed_fields):
+            return dict()
+        with self._lock:
+            if self._index is None:  # Not loaded yet. The stored ranks are corrected by update_ranks_and_star_players.
+                return dict()
+            return self._index.update(document.id, self.key(document))
+
+
+class RankedUnitOfWork(UnitOfWork):
+    # Also writes the rank changes caused by the scores saved in the unit of work.
+    # The ranks of the saved documents go in the atomic batch. The ranks of the other documents in the moved windows
+    # are written after it in batches of BATCH_LIMIT writes.
+    BATCH_LIMIT: int = 500  # Maximum number of writes Firestore allows in a single batch
+
+    def commit(self) -> None:
+        saved: Dict[Tuple[str, str], TrackedDocument] = {(document.COLLECTION, document.id): document
+                                                         for document in self._saved}
+        rankings: List[Ranking] = list()
+        rank_updates: Dict[Tuple[type, str], dict] = dict()
+        for document in list(self._saved):
+            for ranking in _RANKINGS.get(document.COLLECTION, list()):
+                ranks: Dict[str, int] = ranking.record(document)
+                if ranks and ranking not in rankings:
+                    rankings.append(ranking)
+                for doc_id, rank in ranks.items():
+                    if (document.COLLECTION, doc_id) in saved:
+                        setattr(saved[(document.COLLECTION, doc_id)], ranking.rank_field, rank)
+                    else:
+                        rank_updates.setdefault((ranking.document_class, doc_id), dict())[ranking.rank_field] = rank
+        try:
+            super().commit()
+        except Exception:
+            for ranking in rankings:
+                ranking.reset()
+            raise
+        if not rank_updates:
+            return
+        try:
+            self._commit_rank_updates(rank_updates)
+        except Exception:
+            logger.exception(f"Rank updates of {len(rank_updates)} documents not fully applied.")
+            for ranking in rankings:
+                ranking.reset()
+        for document_class, doc_id in rank_updates:
+            if issubclass(document_class, CachedDocument):
+                document_class.objects.cache.discard(doc_id)
+
+    def _commit_rank_updates(self, rank_updates: Dict[Tuple[type, str], dict]) -> None:
+        io_executor.run_all([self._batch(chunk).commit for chunk in self._chunks(rank_updates)])
+
+    def _chunks(self, rank_updates: Dict[Tuple[type, str], dict]) -> Iterable[List[Tuple[Tuple[type, str], dict]]]:
+        items = iter(rank_updates.items())
+        chunk: List[Tuple[Tuple[type, str], dict]] = list(islice(items, self.BATCH_LIMIT))
+        while chunk:
+            yield chunk
+            chunk = list(islice(items, self.BATCH_LIMIT))
+
+    @staticmethod
+    def _batch(chunk: List[Tuple[Tuple[type, str], dict]]) -> WriteBatch:
+        batch: WriteBatch = _DB.batch()
+        for (document_class, doc_id), fields in chunk:
+            batch.update(_DB.collection(document_class.COLLECTION).document(doc_id), fields)
+        return batch
+
+
+_RANKINGS: Dict[str, List[Ranking]] = dict()
+_refresh_requested: Event = Event()
+_refresher: Optional[Thread] = None
+
+
+def refresh_all() -> None:
+    for ranking in [ranking for rankings in list(_RANKINGS.values()) for ranking in rankings]:
+        try:
+            ranking.refresh()
+        except Exception:
+            logger.exception(f"Unable to refresh {ranking}.")
+
+
+def request_refresh() -> None:
+    _refresh_requested.set()
+
+
+def _refresh_forever() -> None:
+    while True:
+        refresh_all()
+        _refresh_requested.wait(timeout=Ranking.REFRESH_SECONDS)
+        _refresh_requested.clear()
+
+
+def start_refresh() -> None:
+    # Called once per worker process at startup, so that no request waits for an index to load.
+    global _refresher
+    if _refresher is None:
+        _refresher = Thread(target=_refresh_forever, name="ranking-refresh", daemon=True)
+        _refresher.start()
+
+
+PLAYER_RANKING: Ranking = Ranking(Player)
+PLAYER_WC_RANKING: Ranking = Ranking(Player, "wc_rank", "wc_score")
+GROUP_RANKING: Ranking = Ranking(Group)  # By the score of the compacted counters (see counters.py)
@@ -1,7 +1,5 @@
-import json
-import random
 from datetime import datetime
-from typing import List, Callable
+from typing import List
 from urllib.parse import urlparse as url_parse
 
 import pytz
@@ -10,8 +8,11 @@ from flask_login import login_user, current_user, logout_user
 
 from app import app, CI_SECURITY
 from forms import LoginForm, PlayFriendlyForm
-from methods import update_rank_and_save, MatchPlayer, cookie_login_required, perform_io_task
+from leaderboard import PLAYER_BOARD, GROUP_BOARD
+from methods import MatchPlayer, cookie_login_required
 from models import Group, Player, Match
+from pairing import FRIENDLY_QUEUE
+from vote_queue import VoteUnitOfWork
 
 
 @app.route("/")
@@ -22,16 +23,14 @@ def home():
 @app.route("/players/ranked")
 @cookie_login_required
 def ranked_players():
-    players = Player.objects.order_by("score", Player.objects.ORDER_DESCENDING).limit(100).get()
-    update_rank_and_save(players)
+    players = PLAYER_BOARD.get()
     return render_template("players_ranked.html", title="Top 100 Players", players=players, multi_groups=True)
 
 
 @app.route("/scored_groups")
 @cookie_login_required
 def ranked_groups():
-    groups = Group.objects.get()
-    update_rank_and_save(groups)
+    groups = GROUP_BOARD.get()
     return render_template("groups_ranked.html", title="Groups", groups=groups)
 
 
@@ -50,31 +49,18 @@ def play_friendly():
     play_from = request.args.get("play_from", "top")
     match: Match = Match.objects.filter_by(type="friendly", winner=str()).first()
     if not match:
-        if play_from == "top":
-            players = Player.objects.order_by("score", Player.objects.ORDER_DESCENDING).limit(100).get()
-            selection: List[Player] = random.sample(players, k=2)
-        elif play_from == "bottom":
-            players = Player.objects.order_by("played").limit(20).get()
-            selection: List[Player] = random.sample(players, k=2)
-        elif play_from == "random":
-            with open("temp/player_names.json") as file:
-                player_names: List[str] = json.load(file)
-            select_names: List[str] = random.sample(player_names, k=2)
-            selection: List[Player] = Player.objects.filter("name", Player.objects.IN, select_names).get()
-        elif len(play_from) == 7 and play_from[:5] == "group":
-            group_name = play_from[-2:].upper()
-            players = Player.objects.filter_by(group_name=group_name).get()
-            selection: List[Player] = random.sample(players, k=2)
-        else:
+        pair = FRIENDLY_QUEUE.pop(play_from)
+        if not pair:
             flash("Invalid play option. Defaulting to playing from top.")
             return redirect(url_for("play_friendly", play_from="top"))
+        selection: List[Player] = list(pair)
         match = Match(series_type="friendly")
         match.player1 = selection[0].name
         match.player2 = selection[1].name
         match.players = [selection[0].name, selection[1].name]
         match.create()
     else:
-        selection: List[Player] = Player.objects.filter("name", Player.objects.IN, [match.player1, match.player2]).get()
+        selection: List[Player] = Player.objects.fresh.filter("name", Player.objects.IN, [match.player1, match.player2]).get()
     match_player: MatchPlayer = MatchPlayer()
     match_player.match = match
     match_player.player1 = next(s for s in selection if s.name == match.player1)
@@ -86,21 +72,21 @@ def play_friendly():
     match_player.match.date_played = datetime.now(tz=pytz.UTC)
     match_player.winner.update_score(played=1, won=1)
     match_player.loser.update_score(played=1, won=0)
-    update_tasks: List[Callable] = [match_player.winner.save, match_player.loser.save]
+    unit_of_work: VoteUnitOfWork = VoteUnitOfWork(match_player.match.id).save(match_player.winner, match_player.loser)
     group_names = [match_player.player1.group_name, match_player.player2.group_name]
     if group_names[0] == group_names[1]:
-        group: Group = Group.objects.filter_by(name=group_names[0]).first()
+        group: Group = Group.objects.fresh.filter_by(name=group_names[0]).first()
         group.update_score(played=2, won=1)
-        update_tasks.append(group.save)
+        unit_of_work.save(group)
     else:
-        groups: List[Group] = Group.objects.filter("name", Group.objects.IN, group_names).get()
+        groups: List[Group] = Group.objects.fresh.filter("name", Group.objects.IN, group_names).get()
         winner: Group = next(group for group in groups if group.name == match_player.winner_group_name)
         loser: Group = next(group for group in groups if group.name != winner.name)
         winner.update_score(played=1, won=1)
         loser.update_score(played=1, won=0)
-        update_tasks.extend([winner.save, loser.save])
-    update_tasks.append(match_player.match.save)
-    perform_io_task(update_tasks)
+        unit_of_work.save(winner, loser)
+    unit_of_work.save(match_player.match)
+    unit_of_work.commit()
     return redirect(url_for("play_friendly", play_from=play_from))
 
 
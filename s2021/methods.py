@@ -1,30 +1,53 @@
 from itertools import groupby
 from random import choice, shuffle
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Dict
 
+# noinspection PyProtectedMember
+from firestore_ci.firestore_ci import _DB
 from flask import url_for
 
-from models import Standing, Group, Series, TBD, Match, Player, DECIDER, WINNER, INITIAL1, LOSER, INITIAL2, FINAL
+from documents import UnitOfWork
+from leaderboard import Board, record_leaderboards
+from models import Standing, Group, Series, TBD, Match, Player, DECIDER, WINNER, INITIAL1, LOSER, INITIAL2, FINAL, \
+    SeriesState
 from s2021.utils import get_season, sort_standings, RoundGroup, round_down, RoundTeam, SeriesStanding, MatchGroup, \
     get_match_player, get_conquest_names, get_lhs_names, get_tbd_series_to_update, get_next_round_series_to_update, \
-    get_range_of_week, get_list_of_rounds, get_series_types, get_order
+    get_range_of_week, get_list_of_rounds, get_series_types, get_order, RoundGroupCache, is_terminal, link_bracket, \
+    get_bracket_errors
 
 
-def get_standings_with_url() -> List[Standing]:
-    season = get_season()
+def get_standings_with_url(season: Optional[int] = None) -> List[Standing]:
+    season = season if season is not None else get_season()
     standings: List[Standing] = Standing.objects.filter_by(season=season).get()
     standings = sort_standings(standings)
-    groups: List[Group] = Group.objects.get()
+    groups: Dict[str, dict] = {doc_dict["name"]: doc_dict for doc_dict in Group.objects.project("name", "url", "player_name")}
     for standing in standings:
-        group: Group = next((group for group in groups if group.name == standing.group_name), None)
+        group: Optional[dict] = groups.get(standing.group_name)
         if not group:
             continue
-        standing.url = group.url
-        standing.url_name = group.player_name
+        standing.url = group.get("url", str())
+        standing.url_name = group.get("player_name", str())
     return standings
 
 
+# The world cup standings use the year as their season
+STANDINGS_BOARD: Board = Board("s2021-standings", Standing, ["group_name", "group_fullname", "url", "total_score", "total_ties"],
+                               key=lambda row: (row["total_score"], row["total_ties"]), loader=get_standings_with_url,
+                               accepts=lambda standing: standing.season < 2022, seasonal=True)
+
+
+ROUND_GROUP_CACHE: RoundGroupCache = RoundGroupCache()
+
+
 def get_round_groups(season: int, week: int) -> List[RoundGroup]:
+    round_groups: Optional[List[RoundGroup]] = ROUND_GROUP_CACHE.get(season, week)
+    if round_groups is None:
+        round_groups = build_round_groups(season, week)
+        ROUND_GROUP_CACHE.put(season, week, round_groups)
+    return round_groups
+
+
+def build_round_groups(season: int, week: int) -> List[RoundGroup]:
     week_series: List[Series] = Series.objects.filter_by(season=season, week=week).get()
     week_series.sort(key=lambda item: item.order)
     round_group_range: range = range(1, 6) if week < 8 else range(1, 3)
@@ -32,7 +55,7 @@ def get_round_groups(season: int, week: int) -> List[RoundGroup]:
     round_group_last: int = list(round_group_range)[-1]
     round_groups: List[RoundGroup] = [RoundGroup(str(index)) if index != round_group_last else
                                       RoundGroup(f"{index} & {index + 1}") for index in round_group_range]
-    standings: List[Standing] = get_standings_with_url()
+    standings: Dict[str, Standing] = {standing.group_name: standing for standing in get_standings_with_url(season)}
     for round_number, round_series in groupby(week_series, key=lambda item: item.round):
         round_group_number: int = round_down(round_number, 100) // 100
         if round_group_number > round_group_count:
@@ -44,11 +67,11 @@ def get_round_groups(season: int, week: int) -> List[RoundGroup]:
             round_team.series_standings.append(series_standing)
             series_standing.series = series
             if series.group_name1 != TBD:
-                series_standing.standing1 = next(item for item in standings if item.group_name == series.group_name1)
+                series_standing.standing1 = standings[series.group_name1]
             else:
                 series_standing.standing1.url = url_for("static", filename="default.jpg")
             if series.group_name2 != TBD:
-                series_standing.standing2 = next(item for item in standings if item.group_name == series.group_name2)
+                series_standing.standing2 = standings[series.group_name2]
             else:
                 series_standing.standing2.url = url_for("static", filename="default.jpg")
     return round_groups
@@ -58,56 +81,101 @@ def get_next_series() -> Series:
     return Series.objects.order_by("order").filter_by(season=get_season(), winner=str()).first()
 
 
-def get_match_group(series: Series) -> MatchGroup:
+def build_series_state(series: Series) -> SeriesState:
+    # Reads the matches, players and standings of a series once. The play loop then only reads and writes the state.
+    state: SeriesState = SeriesState()
+    state.set_id(series.id)
+    state.set_series(series)
     if TBD in series.group_names:
-        return MatchGroup()
-    match_group = MatchGroup()
+        return state
     matches: List[Match] = Match.objects.filter_by(season=series.season, week=series.week, type=series.type,
                                                    round=series.round).get()
-    players: List[Player] = Player.objects.filter("group_name", Player.objects.IN, series.group_names).get()
-    standings: List[Standing] = Standing.objects.filter_by(season=series.season) \
-        .filter("group_name", Series.objects.IN, series.group_names).get()
-    past_matches: List[Match] = [match for match in matches if match.winner != str()]
-    past_matches.sort(key=lambda match: match.order)
-    match_group.past_matches = [get_match_player(match, players) for match in past_matches]
+    matches.sort(key=lambda match: (match.winner == str(), match.order))
+    state.set_matches(matches)
+    state.set_players(Player.objects.filter("group_name", Player.objects.IN, series.group_names).get())
+    state.set_standings(Standing.objects.filter_by(season=series.season)
+                        .filter("group_name", Series.objects.IN, series.group_names).get())
+    return state
+
+
+def get_next_series_state() -> Optional[SeriesState]:
+    state: Optional[SeriesState] = SeriesState.objects.order_by("order").filter_by(season=get_season(), winner=str()).first()
+    if state:
+        return state
+    series: Optional[Series] = get_next_series()
+    if not series:
+        return None
+    state = build_series_state(series)
+    if series.is_setup_done:
+        add_next_match(series, get_match_group(series, state), state)
+        state.save()
+    return state
+
+
+def get_match_group(series: Series, state: Optional[SeriesState] = None) -> MatchGroup:
+    if TBD in series.group_names:
+        return MatchGroup()
+    state = state or SeriesState.get_by_id(series.id) or build_series_state(series)
+    match_group = MatchGroup()
+    players: List[Player] = state.get_players()
+    matches: List[Match] = state.get_matches()
+    match_group.past_matches = [get_match_player(match, players) for match in matches if match.winner != str()]
     current_match: Optional[Match] = next((match for match in matches if match.winner == str()), None)
-    if not current_match and not series.winner:
-        current_match = Match(series.season, series.week, series.round, series.type)
-        if series.week in (1, 3, 5, 7, 8):
-            player1_choices: List[str] = get_conquest_names(players, match_group, series.group_name1)
-            player2_choices: List[str] = get_conquest_names(players, match_group, series.group_name2)
-        else:
-            player1_choices: List[str] = get_lhs_names(players, match_group, series.group_name1)
-            player2_choices: List[str] = get_lhs_names(players, match_group, series.group_name2)
-        current_match.player1 = choice(player1_choices)
-        current_match.player2 = choice(player2_choices)
-        current_match.players = [current_match.player1, current_match.player2]
-        current_match.order = max(match.order for match in past_matches) + 1 if past_matches else 1
-        current_match.create()
     match_group.current_match = get_match_player(current_match, players) if current_match else None
+    standings: List[Standing] = state.get_standings()
     match_group.standing1 = next(item for item in standings if item.group_name == series.group_name1)
     match_group.standing2 = next(item for item in standings if item.group_name == series.group_name2)
     return match_group
 
 
+def add_next_match(series: Series, match_group: MatchGroup, state: SeriesState) -> None:
+    if series.winner or match_group.current_match:
+        return
+    players: List[Player] = state.get_players()
+    current_match = Match(series.season, series.week, series.round, series.type)
+    if series.week in (1, 3, 5, 7, 8):
+        player1_choices: List[str] = get_conquest_names(players, match_group, series.group_name1)
+        player2_choices: List[str] = get_conquest_names(players, match_group, series.group_name2)
+    else:
+        player1_choices: List[str] = get_lhs_names(players, match_group, series.group_name1)
+        player2_choices: List[str] = get_lhs_names(players, match_group, series.group_name2)
+    current_match.player1 = choice(player1_choices)
+    current_match.player2 = choice(player2_choices)
+    current_match.players = [current_match.player1, current_match.player2]
+    current_match.order = len(match_group.past_matches) + 1
+    match_group.current_match = get_match_player(current_match, players)
+    state.matches.append(current_match.doc_to_dict())
+
+
 def get_series_score(series: Series, match_group: MatchGroup) -> Tuple[int, int]:
     score1: int = sum(1 for m_player in match_group.past_matches if m_player.winner_group_name == series.group_name1)
     score2: int = sum(1 for m_player in match_group.past_matches if m_player.winner_group_name == series.group_name2)
     return score1, score2
 
 
-def update_results(series: Series, match_group: MatchGroup, winning_name: str) -> None:
-    match_group.current_match.match.winner = winning_name
-    match_group.current_match.match.save()
-    match_group.past_matches.append(match_group.current_match)
-    series.scores = get_series_score(series, match_group)
+def update_results(series: Series, match_group: MatchGroup, winning_name: str, state: SeriesState) -> None:
+    # The match, the series, the standing, the next series and the state with the next match go in one batch.
+    match: Match = match_group.current_match.match
+    match.winner = winning_name
+    match_group.add_past_match(match_group.current_match)
+    series.scores = list(get_series_score(series, match_group))
     standing: Standing = match_group.winner_standing
     if max(series.scores) == 5:
         series.winner = standing.group_name
     update_score(series, standing)
-    if not update_tbd(series):
-        series.save()
-    standing.save()
+    unit_of_work: UnitOfWork = UnitOfWork().save(series, standing, *update_tbd(series))
+    if match.id:  # Created before the series had a state
+        unit_of_work.save(match)
+    else:
+        unit_of_work.create(match)
+    state.set_series(series)
+    state.set_matches([match_player.match for match_player in match_group.past_matches])
+    state.set_standings([match_group.standing1, match_group.standing2])
+    match_group.current_match = None
+    add_next_match(series, match_group, state)
+    unit_of_work.save(state).commit()
+    ROUND_GROUP_CACHE.invalidate(series.season, series.week)
+    record_leaderboards([standing])
     if series.winner and series.round == 601 and series.type == DECIDER:
         setup_initial_matches()
     return
@@ -147,6 +215,7 @@ def setup_initial_matches():
         series.group_name2 = group_names[index * 2 + 1]
         series.group_names = [series.group_name1, series.group_name2]
     Series.objects.save_all(tbd_series)
+    ROUND_GROUP_CACHE.invalidate(season, week)
     print(f"Initial matches for season {season} for week {week} setup.")
 
 
@@ -154,7 +223,7 @@ def setup_initial_matches_for_playoff():
     season = get_season()
     tbd_series: List[Series] = Series.objects.filter_by(season=season, week=8).filter("round", "<", 200).get()
     tbd_series.sort(key=lambda item: item.round)
-    standings: List[Standing] = Standing.objects.get()
+    standings: List[Standing] = Standing.objects.filter_by(season=season).get()
     standings = sort_standings(standings)
     top: List[Standing] = standings[:8]
     middle: List[Standing] = standings[8:24]
@@ -174,6 +243,7 @@ def setup_initial_matches_for_playoff():
             series.group_name2 = bottom.pop().group_name
             series.group_names = [TBD, series.group_name2]
     Series.objects.save_all(tbd_series)
+    ROUND_GROUP_CACHE.invalidate(season, 8)
     return
 
 
@@ -189,12 +259,33 @@ def update_score(series: Series, standing: Standing) -> None:
     return
 
 
-def update_tbd(series) -> bool:
-    if series.round == 601 and series.type == DECIDER or series.round == 300 and series.type == FINAL:
-        return False
+def get_series_by_ids(doc_ids: List[str]) -> Dict[str, Series]:
+    # Reads the documents by key in one call. No query is run.
+    doc_refs = [_DB.collection(Series.COLLECTION).document(doc_id) for doc_id in doc_ids]
+    return {snapshot.id: Series.dict_to_doc(snapshot.to_dict(), snapshot.id)
+            for snapshot in _DB.get_all(doc_refs) if snapshot.exists}
+
+
+def update_tbd(series) -> List[Series]:
+    # Sets the winner and the loser of a finished series in the series that follow it and returns them
+    if is_terminal(series):
+        return list()
     if not series.winner or not series.loser:
-        return False
-    series_to_update: List[Series] = [series]
+        return list()
+    if not series.winner_to and not series.loser_to:
+        return update_tbd_by_lookup(series)
+    links: List[Tuple[str, int, str]] = [(series.winner_to, series.winner_slot, series.winner),
+                                         (series.loser_to, series.loser_slot, series.loser)]
+    links = [link for link in links if link[0]]
+    successors: Dict[str, Series] = get_series_by_ids([successor_id for successor_id, _, _ in links])
+    for successor_id, slot, group_name in links:
+        successors[successor_id].set_group_name(slot, group_name)
+    return list(successors.values())
+
+
+def update_tbd_by_lookup(series) -> List[Series]:
+    # For the seasons initialized before the series stored their successors
+    series_to_update: List[Series] = list()
     if series.type == INITIAL1:
         tbd_series: List[Series] = get_tbd_series_to_update(series, [WINNER, LOSER])
         tbd_series[0].set_group_name1(series.winner)
@@ -228,8 +319,7 @@ def update_tbd(series) -> bool:
         else:  # Series round is 220 or 240
             next_series.set_group_name2(series.winner)
         series_to_update.append(next_series)
-    Series.objects.save_all(series_to_update)
-    return True
+    return series_to_update
 
 
 def init_standings():
@@ -258,5 +348,13 @@ def init_series():
                   for week in get_range_of_week()
                   for round_number in get_list_of_rounds(week)
                   for series_type in get_series_types(week, round_number)]
-    Series.objects.create_all(Series.objects.to_dicts(new_series))
+    for series in new_series:
+        series.set_id(_DB.collection(Series.COLLECTION).document().id)
+    link_bracket(new_series)
+    errors: List[str] = get_bracket_errors(new_series)
+    if errors:
+        print("\n".join(errors))
+        return
+    Series.objects.save_all(new_series, workers=100)
+    ROUND_GROUP_CACHE.invalidate(season)
     print(f"Series for season {season}  for all 7 weeks initialized.")
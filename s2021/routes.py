@@ -1,12 +1,14 @@
 from typing import List, Tuple
 
 from flask import render_template, redirect, url_for
+from munch import Munch
 
 from methods import cookie_login_required
-from models import Group, Player, Standing, Series
+from models import Group, Player, Series, SeriesState
 from s2021 import bp
 from s2021.forms import QualificationForm, PlayForm
-from s2021.methods import get_standings_with_url, get_next_series, get_round_groups, get_match_group, update_results
+from s2021.methods import STANDINGS_BOARD, get_next_series, get_round_groups, get_match_group, update_results, \
+    get_next_series_state
 from s2021.utils import get_season, RoundGroup, MatchGroup
 
 
@@ -47,8 +49,8 @@ def players_in_a_group(group_id: str):
 @bp.route("/s2021/standings")
 @cookie_login_required
 def view_standings():
-    standings: List[Standing] = get_standings_with_url()
-    ranked_standings: List[Tuple[int, Standing]] = [(index + 1, standing) for index, standing in enumerate(standings)]
+    standings: List[Munch] = STANDINGS_BOARD.get(get_season())
+    ranked_standings: List[Tuple[int, Munch]] = [(index + 1, standing) for index, standing in enumerate(standings)]
     return render_template("s2021_standings.html", standings=standings, title="Standings",
                            ranked_standings=ranked_standings)
 
@@ -85,12 +87,13 @@ def view_series(series_id: str):
 @bp.route("/s2021/play", methods=["GET", "POST"])
 @cookie_login_required
 def play():
-    series: Series = get_next_series()
-    if not series:
+    state: SeriesState = get_next_series_state()
+    if not state:
         return render_template("not_found_404.html")
-    match_group: MatchGroup = get_match_group(series)
+    series: Series = state.get_series()
+    match_group: MatchGroup = get_match_group(series, state)
     form = PlayForm(match_group)
     if not form.validate_on_submit():
         return render_template("s2021_play.html", form=form, match_group=match_group, series=series, title="Play")
-    update_results(series, match_group, form.winner.data)
+    update_results(series, match_group, form.winner.data, state)
     return redirect(url_for("s2021.play"))
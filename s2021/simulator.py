@@ -0,0 +1,172 @@
+from contextlib import ExitStack
+from random import Random, seed
+from time import perf_counter
+from typing import Dict, List, Optional, Callable
+from unittest.mock import patch
+
+from memory_store import MemoryClient
+from models import Group, Player, Series, SeriesState, FINAL
+from s2021 import methods
+from s2021.utils import MatchGroup
+
+# The s2021 format is fixed at 128 groups a season. Larger runs play more seasons on the same store, so that the
+# collections that the queries run against keep growing, and more players per group.
+GROUP_COUNT: int = 128
+TIMED_STEPS = ("init_standings", "init_series", "setup_initial_matches", "setup_initial_matches_for_playoff",
+               "get_next_series_state", "get_match_group", "update_results", "update_tbd")
+
+
+class SimulationError(Exception):
+    pass
+
+
+class StepStats:
+
+    def __init__(self):
+        self.times: List[float] = list()
+        self.counts: Dict[str, int] = dict()
+
+    def __repr__(self):
+        return f"C#{len(self.times)}:T{sum(self.times):.3f}"
+
+    def add(self, elapsed: float, counts: Dict[str, int]) -> None:
+        self.times.append(elapsed)
+        for field, value in counts.items():
+            self.counts[field] = self.counts.get(field, 0) + value
+
+    def percentile(self, percent: int) -> float:
+        times: List[float] = sorted(self.times)
+        return times[min(len(times) - 1, len(times) * percent // 100)]
+
+
+class SimulationReport:
+
+    def __init__(self):
+        self.champions: List[str] = list()
+        self.series_played: int = 0
+        self.matches_played: int = 0
+        self.totals: Dict[str, int] = dict()
+        self.steps: Dict[str, StepStats] = {step: StepStats() for step in TIMED_STEPS}
+        self.wall_time: float = 0.0
+
+    def __repr__(self):
+        return f"S#{len(self.champions)}:M#{self.matches_played}:T{self.wall_time:.1f}"
+
+    def lines(self) -> List[str]:
+        lines: List[str] = [f"Seasons {len(self.champions)}, champions {', '.join(self.champions)}",
+                            f"Series {self.series_played}, matches {self.matches_played}, wall time {self.wall_time:.2f}s",
+                            "Totals " + ", ".join(f"{field} {value}" for field, value in self.totals.items()),
+                            "Step (nested steps are included in their callers): calls, mean/p50/p95/max ms, "
+                            "reads, writes, queries per call"]
+        for name, step in self.steps.items():
+            if not step.times:
+                continue
+            calls: int = len(step.times)
+            lines.append(f"{name:34} {calls:6} {sum(step.times) / calls * 1000:8.2f} {step.percentile(50) * 1000:8.2f} "
+                         f"{step.percentile(95) * 1000:8.2f} {max(step.times) * 1000:8.2f} "
+                         f"{step.counts['reads'] / calls:7.1f} {step.counts['writes'] / calls:6.1f} "
+                         f"{step.counts['queries'] / calls:6.1f}")
+        return lines
+
+
+class SeasonSimulator:
+    # Plays whole s2021 seasons on an in-memory store through the same calls as the play page, one vote at a time.
+    # The winner of a match is random, or weighted by the score of the players. The same seed plays the same seasons.
+
+    def __init__(self, random_seed: int = 0, players_per_group: int = 11, weighted: bool = False, latency: float = 0.0):
+        self.random_seed: int = random_seed
+        self.players_per_group: int = players_per_group
+        self.weighted: bool = weighted
+        self.client: MemoryClient = MemoryClient(latency)
+        self.report: SimulationReport = SimulationReport()
+        self._random: Random = Random(random_seed)
+        self._weights: Dict[str, int] = dict()
+
+    def __repr__(self):
+        return f"SIM:{self.client.stats}:{self.report}"
+
+    def _timed(self, name: str, function: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            before: Dict[str, int] = self.client.stats.as_dict()
+            start: float = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.report.steps[name].add(perf_counter() - start, self.client.stats.since(before))
+
+        return timed
+
+    def _load_groups(self) -> None:
+        groups: List[Group] = list()
+        players: List[Player] = list()
+        for group_index in range(1, GROUP_COUNT + 1):
+            group: Group = Group()
+            group.name = f"G{group_index:03}"
+            group.fullname = f"Group {group_index}"
+            group.qualification_locked = True
+            group.player_count = self.players_per_group
+            groups.append(group)
+            for player_index in range(1, self.players_per_group + 1):
+                player: Player = Player()
+                player.name = f"{group.name}{player_index:03}"
+                player.group_name = group.name
+                player.url = f"https://images.example.com/{player.name}"
+                player.update_score(played=20, won=self._random.randint(0, 20))
+                players.append(player)
+                self._weights[player.name] = player.won + 1
+        for document in groups + players:
+            self.client.collection(document.COLLECTION).document().set(document.doc_to_dict())
+
+    def _pick_winner(self, match_group: MatchGroup) -> str:
+        match = match_group.current_match.match
+        if not self.weighted:
+            return self._random.choice(match.players)
+        weights: List[int] = [self._weights.get(name, 1) for name in match.players]
+        return self._random.choices(match.players, weights=weights)[0]
+
+    def _play_season(self, season: int, weeks: int, max_matches: Optional[int]) -> None:
+        with patch.object(methods, "get_season", return_value=season):
+            methods.init_standings()
+            methods.init_series()
+            methods.setup_initial_matches()
+            while True:
+                state: Optional[SeriesState] = methods.get_next_series_state()
+                if not state:
+                    break
+                series: Series = state.get_series()
+                if series.week > weeks or self.report.matches_played == max_matches:
+                    return
+                if not series.is_setup_done:
+                    raise SimulationError(f"The next series {series} of season {season} is not setup.")
+                match_group: MatchGroup = methods.get_match_group(series, state)
+                methods.update_results(series, match_group, self._pick_winner(match_group), state)
+                self.report.matches_played += 1
+                self.report.series_played += 1 if series.winner else 0
+        final: Optional[Series] = Series.objects.filter_by(season=season, week=8, round=300, type=FINAL).first()
+        if not final or not final.winner:
+            raise SimulationError(f"Season {season} ended without a champion.")
+        self.report.champions.append(final.winner)
+
+    def run(self, seasons: int = 1, weeks: int = 8, max_matches: Optional[int] = None) -> SimulationReport:
+        # Only the seasons played through week 8 have a champion. A run stops early after max_matches votes.
+        seed(self.random_seed)  # The draws and the match ups of the engine use the module random
+        with self.client, ExitStack() as stack:
+            for name in TIMED_STEPS:
+                stack.enter_context(patch.object(methods, name, self._timed(name, getattr(methods, name))))
+            self._load_groups()
+            before: Dict[str, int] = self.client.stats.as_dict()
+            start: float = perf_counter()
+            for season in range(1, seasons + 1):
+                if self.report.matches_played == max_matches:
+                    break
+                self._play_season(season, weeks, max_matches)
+            self.report.wall_time = perf_counter() - start
+            self.report.totals = self.client.stats.since(before)
+        return self.report
+
+
+def simulate(seasons: int = 1, weeks: int = 8, random_seed: int = 0, players_per_group: int = 11, weighted: bool = False,
+             latency: float = 0.0) -> SimulationReport:
+    report: SimulationReport = SeasonSimulator(random_seed, players_per_group, weighted, latency).run(seasons, weeks)
+    print("\n".join(report.lines()))
+    return report
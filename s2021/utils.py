@@ -1,15 +1,18 @@
-from typing import Tuple, List, Optional
+from threading import RLock
+from typing import Tuple, List, Optional, Dict
 
+from cachetools import TTLCache
 from flask_login import current_user
 
 from methods import MatchPlayer
 from models import SERIES_TYPES, BYE_SERIES_TYPES, FINAL_SERIES_TYPES, Standing, Series, Match, Player, WINNER, \
-    DECIDER, INITIAL1, INITIAL2, FINAL
+    DECIDER, INITIAL1, INITIAL2, FINAL, LOSER
 
 
 class MatchGroup:
     def __init__(self):
-        self.past_matches: List[MatchPlayer] = list()
+        self._past_matches: List[MatchPlayer] = list()
+        self._tally: Dict[str, List[int]] = dict()  # player name -> [won, lost] in the past matches
         self.current_match: MatchPlayer = MatchPlayer()
         self.standing1: Standing = Standing()
         self.standing2: Standing = Standing()
@@ -23,11 +26,27 @@ class MatchGroup:
             return None
         return self.standing1 if self.current_match.winner_group_name == self.standing1.group_name else self.standing2
 
+    @property
+    def past_matches(self) -> List[MatchPlayer]:
+        return self._past_matches
+
+    @past_matches.setter
+    def past_matches(self, match_players: List[MatchPlayer]) -> None:
+        self._past_matches, self._tally = list(), dict()
+        for match_player in match_players:
+            self.add_past_match(match_player)
+
+    def add_past_match(self, match_player: MatchPlayer) -> None:
+        # The match needs its winner. Use this instead of appending to past_matches, so that the tally stays current.
+        self._past_matches.append(match_player)
+        self._tally.setdefault(match_player.match.winner, [0, 0])[0] += 1
+        self._tally.setdefault(match_player.match.loser, [0, 0])[1] += 1
+
     def won_count(self, name: str) -> int:
-        return sum(1 for match_player in self.past_matches if match_player.match.winner == name)
+        return self._tally.get(name, (0, 0))[0]
 
     def lost_count(self, name: str) -> int:
-        return sum(1 for match_player in self.past_matches if match_player.match.loser == name)
+        return self._tally.get(name, (0, 0))[1]
 
 
 class RoundGroup:
@@ -58,6 +77,31 @@ class SeriesStanding:
         return f"{self.series}::{self.standing1}::{self.standing2}"
 
 
+class RoundGroupCache:
+    # The fixtures of a week assembled for the rounds page. Kept until a series of the week changes in this worker.
+
+    def __init__(self, maxsize: int = 32, ttl: int = 600):
+        self._round_groups: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)  # (season, week) -> round groups
+        self._lock: RLock = RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._round_groups)
+
+    def get(self, season: int, week: int) -> Optional[List[RoundGroup]]:
+        with self._lock:
+            return self._round_groups.get((season, week))
+
+    def put(self, season: int, week: int, round_groups: List[RoundGroup]) -> None:
+        with self._lock:
+            self._round_groups[(season, week)] = round_groups
+
+    def invalidate(self, season: int, week: Optional[int] = None) -> None:
+        with self._lock:
+            for key in [key for key in self._round_groups if key[0] == season and (week is None or key[1] == week)]:
+                self._round_groups.pop(key, None)
+
+
 def get_order(week: int, round_number: int, series_type: str) -> int:
     round_list = get_list_of_rounds(week)
     if week <= 7:
@@ -176,6 +220,76 @@ def get_next_series_type(series: Series) -> str:
     return INITIAL2 if series.round % 2 == 1 else INITIAL1
 
 
+def is_terminal(series: Series) -> bool:
+    return series.round == 601 and series.type == DECIDER or series.round == 300 and series.type == FINAL
+
+
+def get_successor_slots(series: Series) -> Dict[str, Tuple[Tuple[int, int, str], int]]:
+    # Returns the (week, round, type) and the slot of the series that the winner and the loser of a series play next
+    def key(round_number: int, series_type: str) -> Tuple[int, int, str]:
+        return series.week, round_number, series_type
+
+    if is_terminal(series):
+        return dict()
+    if series.type in (INITIAL1, INITIAL2):
+        slot: int = 1 if series.type == INITIAL1 else 2
+        return {"winner": (key(series.round, WINNER), slot), "loser": (key(series.round, LOSER), slot)}
+    if series.type == WINNER:
+        slots = {"loser": (key(series.round, DECIDER), 1)}
+        if series.round != 601:
+            slots["winner"] = (key(get_next_round(series), get_next_series_type(series)), 1)
+        return slots
+    if series.type == LOSER:
+        return {"winner": (key(series.round, DECIDER), 2)}
+    if series.type == DECIDER:
+        return {"winner": (key(get_next_round(series), get_next_series_type(series)), 2)}
+    # Series type is final
+    return {"winner": (key(get_next_round(series), get_next_series_type(series)), 1 if series.round in (210, 230) else 2)}
+
+
+def link_bracket(series_list: List[Series]) -> None:
+    # Stores the successor links in the series of a season. The series need their ids.
+    series_by_key = {(series.week, series.round, series.type): series for series in series_list}
+    for series in series_list:
+        for outcome, (successor_key, slot) in get_successor_slots(series).items():
+            setattr(series, f"{outcome}_to", series_by_key[successor_key].id)
+            setattr(series, f"{outcome}_slot", slot)
+
+
+def is_setup_slot(series: Series, slot: int) -> bool:
+    # Slots filled by setup_initial_matches instead of by the result of another series
+    if series.round > 200:
+        return False
+    if series.week <= 7:
+        return series.type in (INITIAL1, INITIAL2)
+    return series.type == INITIAL1 or series.type in (WINNER, LOSER) and slot == 2
+
+
+def get_bracket_errors(series_list: List[Series]) -> List[str]:
+    # Checks the successor links offline. Every slot is filled exactly once, either by setup or by a series result.
+    series_by_id = {series.id: series for series in series_list}
+    fed: Dict[Tuple[str, int], str] = dict()
+    errors: List[str] = list()
+    for series in series_list:
+        for outcome in ("winner", "loser"):
+            successor_id, slot = getattr(series, f"{outcome}_to"), getattr(series, f"{outcome}_slot")
+            if not successor_id:
+                continue
+            if successor_id not in series_by_id:
+                errors.append(f"{series} {outcome} goes to an unknown series {successor_id}.")
+            elif (successor_id, slot) in fed:
+                errors.append(f"{series} {outcome} and {fed[(successor_id, slot)]} fill the same slot.")
+            else:
+                fed[(successor_id, slot)] = f"{series} {outcome}"
+        if not series.winner_to and not is_terminal(series) and not (series.week <= 7 and series.round == 601):
+            errors.append(f"{series} has no successor for its winner.")
+    for series in series_list:
+        for slot in (1, 2):
+            if not is_setup_slot(series, slot) and (series.id, slot) not in fed:
+                errors.append(f"{series} slot {slot} is never filled.")
+    return errors
+
+
 def get_conquest_names(players: List[Player], match_group: MatchGroup, group_name: str) -> List[str]:
     return [player.name for player in players if player.group_name == group_name
             and match_group.won_count(player.name) == 0 and match_group.lost_count(player.name) < 2]
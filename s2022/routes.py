@@ -1,13 +1,14 @@
 from typing import List
 
 from flask import render_template, url_for
+from munch import Munch
 from werkzeug.utils import redirect
 
-from methods import update_rank_and_save, cookie_login_required
+from methods import cookie_login_required
 from models import Player, Standing, MarginTag
 from s2022 import bp
 from s2022.forms import PlayWorldCupForm
-from s2022.wc_methods import WorldCupMatch, get_wc_match, SEASON
+from s2022.wc_methods import WorldCupMatch, get_wc_match, SEASON, STANDING_WC_BOARD
 
 
 @bp.route("/s2022/play", methods=["GET", "POST"])
@@ -27,8 +28,7 @@ def play_world_cup():
 @bp.route("/s2022/standings")
 @cookie_login_required
 def view_wc_standings():
-    standings: List[Standing] = Standing.objects.filter_by(season=SEASON).get()
-    update_rank_and_save(standings, "wc_rank", "wc_score_for_ranking")
+    standings: List[Munch] = STANDING_WC_BOARD.get()
     return render_template("s2022_standings.html", standings=standings, title="World Cup 2022 - Standings")
 
 
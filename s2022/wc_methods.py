@@ -1,17 +1,116 @@
-import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from itertools import groupby
-from random import sample, shuffle
-from typing import Optional, List, Callable
+from random import shuffle
+from threading import RLock
+from typing import Optional, List, Tuple, Dict
 
 import pytz
+# noinspection PyProtectedMember
+from firestore_ci.firestore_ci import _DB
 
+from counters import add_shard_counts, add_shard_counts_to_dicts
 from models import Match, Player, Standing, Group
+from leaderboard import Board, ResultUnitOfWork
+from pairing import FRIENDLY_QUEUE, GroupPairing
+from ranking import Ranking, PLAYER_WC_RANKING
+from vote_queue import VoteUnitOfWork
 
 SEASON = 2022
 
 
+def load_wc_scores() -> List[Tuple[str, int]]:
+    doc_dicts: List[dict] = Standing.objects.filter_by(season=SEASON).project("wc_score", "eliminated")
+    doc_dicts = add_shard_counts_to_dicts(Standing, doc_dicts)
+    return [(doc_dict["id"], Standing.get_wc_score_for_ranking(doc_dict.get("wc_score", 0), doc_dict.get("eliminated", 0)))
+            for doc_dict in doc_dicts]
+
+
+STANDING_WC_RANKING: Ranking = Ranking(Standing, "wc_rank", "wc_score_for_ranking", trigger_fields=["wc_score", "eliminated"],
+                                       loader=load_wc_scores)
+STANDING_WC_BOARD: Board = Board("s2022-standings", Standing, ["group_name", "group_fullname", "url", "wc_score", "wc_played",
+                                                               "wc_won", "eliminated"],
+                                 key=lambda row: Standing.get_wc_score_for_ranking(row["wc_score"], row["eliminated"]),
+                                 loader=lambda _: add_shard_counts(Standing.objects.filter_by(season=SEASON).get()),
+                                 rank_field="wc_rank", accepts=lambda standing: standing.season == SEASON)
+
+
+class WorldCupRound:
+    # The open matches of the current round in play order, the last order number and the standings of the groups still in
+    # play. Kept in memory per worker. setup_matches loads it when it creates a round and update_result advances it.
+    # Serving a match reads only that match, so that the matches played by the other workers are skipped.
+    # The results are sent as increments of these standings, so other workers' votes in between are not lost.
+
+    def __init__(self):
+        self._matches: Dict[str, Match] = dict()  # Ordered by the match order
+        self._standings: Dict[str, Standing] = dict()  # group_name -> standing
+        self.round: int = int()
+        self.last_order: int = int()
+        self.is_loaded: bool = False
+        self._lock: RLock = RLock()
+
+    def __repr__(self):
+        return f"WCR:R{self.round}:M#{len(self._matches)}:L{self.last_order}"
+
+    def load(self, matches: List[Match], last_match: Optional[Match], standings: List[Standing]) -> None:
+        with self._lock:
+            self._matches = {match.id: match for match in sorted(matches, key=lambda item: item.order)}
+            self._standings = {standing.group_name: standing for standing in standings}
+            self.round = last_match.round if last_match else 0
+            self.last_order = last_match.order if last_match else 0
+            self.is_loaded = True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._matches, self._standings, self.is_loaded = dict(), dict(), False
+
+    def _first(self) -> Optional[Match]:
+        with self._lock:
+            return next(iter(self._matches.values()), None)
+
+    def next_match(self) -> Optional[Match]:
+        # Once the first match turns out played by another worker, the rest are read in one lookup and the played ones
+        # are dropped together
+        match: Optional[Match] = self._first()
+        if not match:
+            return None
+        stored: Optional[Match] = Match.get_by_id(match.id)
+        if stored and not stored.winner:
+            return stored
+        with self._lock:
+            match_ids: List[str] = [match_id for match_id in self._matches if match_id != match.id]
+        self.remove(match.id)
+        references = [_DB.collection(Match.COLLECTION).document(match_id) for match_id in match_ids]
+        open_matches: Dict[str, Match] = {snapshot.id: Match.dict_to_doc(snapshot.to_dict(), snapshot.id)
+                                          for snapshot in (_DB.get_all(references) if references else list())
+                                          if snapshot.exists and not snapshot.to_dict().get("winner")}
+        for match_id in match_ids:
+            if match_id not in open_matches:
+                self.remove(match_id)
+        return next((open_matches[match_id] for match_id in match_ids if match_id in open_matches), None)
+
+    def remove(self, match_id: str) -> None:
+        with self._lock:
+            self._matches.pop(match_id, None)
+
+    @property
+    def standings(self) -> List[Standing]:
+        with self._lock:
+            return [Standing.dict_to_doc(standing.doc_to_dict(), standing.id) for standing in self._standings.values()]
+
+    def get_standing(self, group_name: str) -> Optional[Standing]:
+        with self._lock:
+            standing: Optional[Standing] = self._standings.get(group_name)
+            return Standing.dict_to_doc(standing.doc_to_dict(), standing.id) if standing else None
+
+    def update_standings(self, standings: List[Standing]) -> None:
+        with self._lock:
+            for standing in standings:
+                if standing.group_name in self._standings:
+                    self._standings[standing.group_name] = Standing.dict_to_doc(standing.doc_to_dict(), standing.id)
+
+
+WC_ROUND: WorldCupRound = WorldCupRound()
+
+
 class WorldCupMatch:
 
     def __init__(self):
@@ -26,36 +125,51 @@ class WorldCupMatch:
         self.match.winner = winning_name
         self.match.win_margin = winning_margin
         self.match.date_played = datetime.now(tz=pytz.UTC)
+        # The players were read fresh with the match, so their scores are derived from the stored counters. The counters
+        # are sent as increments, so a concurrent vote on the same player is not lost either.
+        standings: Dict[str, Standing] = {standing.group_name: standing for standing in (self.standing1, self.standing2)
+                                          if standing}
         group_names: List[str] = [self.player1.group_name, self.player2.group_name]
-        query = Standing.objects.filter("group_name", Standing.objects.IN, group_names)
-        standings: List[Standing] = query.filter_by(season=SEASON).get()
-        groups: List[Group] = Group.objects.filter("name", Group.objects.IN, group_names).get()
+        if len(standings) < 2:
+            query = Standing.objects.filter("group_name", Standing.objects.IN, group_names)
+            standings = {standing.group_name: standing for standing in query.filter_by(season=SEASON).get()}
+        groups: Dict[str, Group] = Group.objects.fresh.get_many_by_names(group_names)
         winner: Player = self.player1 if winning_name == self.player1.name else self.player2
         loser: Player = self.player2 if winning_name == self.player1.name else self.player1
-        winning_group: Group = groups[0] if groups[0].name == winner.group_name else groups[1]
-        losing_group: Group = groups[1] if groups[0].name == winner.group_name else groups[0]
-        winning_standing: Standing = standings[0] if standings[0].group_name == winner.group_name else standings[1]
-        losing_standing: Standing = standings[1] if standings[0].group_name == winner.group_name else standings[0]
+        winning_group: Group = groups[winner.group_name]
+        losing_group: Group = groups[loser.group_name]
+        winning_standing: Standing = standings[winner.group_name]
+        losing_standing: Standing = standings[loser.group_name]
         winner.wc_update_score(won=True, margin=winning_margin)
         loser.wc_update_score(won=False, margin=winning_margin)
         winning_standing.wc_update_score(won=True, margin=winning_margin, group=winning_group)
         losing_standing.wc_update_score(won=False, margin=winning_margin, group=losing_group)
-        with ThreadPoolExecutor() as executor:
-            task_list: List[Callable] = [self.match.save, winner.save, loser.save, winning_group.save,
-                                         losing_group.save, winning_standing.save, losing_standing.save]
-            threads = [executor.submit(task) for task in task_list]
-            [future.result() for future in as_completed(threads)]
+        unit_of_work: VoteUnitOfWork = VoteUnitOfWork(self.match.id, synced=[Match])  # The next match skips it
+        unit_of_work.save(self.match, winner, loser, winning_group, losing_group, winning_standing, losing_standing)
+        unit_of_work.commit()
+        WC_ROUND.remove(self.match.id)
+        WC_ROUND.update_standings([winning_standing, losing_standing])
         return
 
 
-def get_wc_match() -> Optional[WorldCupMatch]:
+def load_wc_round() -> None:
+    # On the first request of a worker and when its round runs out of open matches
     match_query = Match.objects.filter_by(season=SEASON)
-    match: Match = match_query.filter_by(winner=str()).order_by("order").first()
+    matches: List[Match] = match_query.filter_by(winner=str()).get()
+    last_match: Optional[Match] = match_query.order_by("order", Match.objects.ORDER_DESCENDING).first()
+    standings: List[Standing] = add_shard_counts(Standing.objects.filter_by(season=SEASON, eliminated=0).get())
+    WC_ROUND.load(matches, last_match, standings)
+
+
+def get_wc_match() -> Optional[WorldCupMatch]:
+    match: Optional[Match] = WC_ROUND.next_match() if WC_ROUND.is_loaded else None
+    if not match:
+        load_wc_round()
+        match = WC_ROUND.next_match()
     if not match:
-        last_match: Match = match_query.order_by("order", Match.objects.ORDER_DESCENDING).first()
-        next_round: int = last_match.round + 1 if last_match else 1
-        match_number: int = last_match.order + 1 if last_match else 1
-        standings: List[Standing] = Standing.objects.filter_by(season=SEASON, eliminated=0).get()
+        next_round: int = WC_ROUND.round + 1
+        match_number: int = WC_ROUND.last_order + 1
+        standings: List[Standing] = WC_ROUND.standings
         if len(standings) <= 1:  # Game over OR Season Not setup
             return None
         if next_round != 1:
@@ -64,57 +178,37 @@ def get_wc_match() -> Optional[WorldCupMatch]:
             eliminated = [s for s in standings if s.wc_score == min_score]
             for group in eliminated:
                 group.eliminated = next_round - 1  # last round
-            Standing.objects.save_all(eliminated)
+            ResultUnitOfWork().save(*eliminated).commit()
             standings = [s for s in standings if s.wc_score != min_score]
         setup_matches(next_round, match_number, standings)
         return None
     wc_match = WorldCupMatch()
     wc_match.match = match
-    players: List[Player] = Player.objects.filter("name", Player.objects.IN, [match.player1, match.player2]).get()
-    wc_match.player1 = next(player for player in players if player.name == match.player1)
-    wc_match.player2 = next(player for player in players if player.name == match.player2)
-    wc_match.last_order = Match.objects.filter_by(season=SEASON).order_by("order", Match.objects.ORDER_DESCENDING).first().order
-    group_names: List[str] = [wc_match.player1.group_name, wc_match.player2.group_name]
-    standings: List[Standing] = Standing.objects.filter("group_name", Player.objects.IN, group_names).get()
-    standings = [standing for standing in standings if standing.season == SEASON]
-    wc_match.standing1 = next(standing for standing in standings if standing.group_name == wc_match.player1.group_name)
-    wc_match.standing2 = next(standing for standing in standings if standing.group_name == wc_match.player2.group_name)
+    players: Dict[str, Player] = Player.objects.fresh.get_many_by_names(match.players)  # Their scores are saved
+    wc_match.player1 = players[match.player1]
+    wc_match.player2 = players[match.player2]
+    PLAYER_WC_RANKING.apply([wc_match.player1, wc_match.player2])
+    wc_match.last_order = WC_ROUND.last_order
+    wc_match.standing1 = WC_ROUND.get_standing(wc_match.player1.group_name)
+    wc_match.standing2 = WC_ROUND.get_standing(wc_match.player2.group_name)
+    STANDING_WC_RANKING.apply([wc_match.standing1, wc_match.standing2])
     return wc_match
 
 
 def setup_matches(next_round: int, next_match_number: int, standings: list) -> None:
-    with open("temp/player_names.json") as file:
-        player_names: List[str] = json.load(file)
     group_names = {s.group_name for s in standings}
-    remaining_players: set = {name for name in player_names if name[:2] in group_names}
-    priority_players: set = set()
+    # The names file is read once per worker and shared with the friendly matches
+    remaining_players: List[str] = [name for name in FRIENDLY_QUEUE.player_names if name[:2] in group_names]
+    priority_players: List[str] = list()
     if next_round > 1:
-        players: List[Player] = Player.objects.filter("wc_played", "<", next_round - 1).get()
-        played_count: set = {player.name for player in players}
-        priority_players: set = {name for name in remaining_players if name in played_count}
-    matches: List[Match] = list()
-    remaining_groups: set = set(group_names)
-    while len(remaining_groups) >= 2:
-        selected_players = priority_players or remaining_players
-        sorted_players = sorted(list(selected_players))
-        select: List[list] = [list(player_group) for _, player_group in
-                              groupby(sorted_players, key=lambda item: item[:2])]
-        selection: List[str] = max(select, key=lambda item: len(item))
-        # Remove all players of selected group for opposition selection
-        remaining_opposition: List[str] = [name for name in remaining_players if name[:2] != selection[0][:2]]
-        if len(selection) > len(remaining_opposition):
-            selection = sample(selection, k=len(remaining_opposition))
-            opposition: List[str] = remaining_opposition
-        else:
-            opposition: List[str] = sample(remaining_opposition, k=len(selection))
-        matches.extend([Match(season=SEASON, round_number=next_round, player1=player1, player2=player2)
-                        for player1, player2 in zip(selection, opposition)])
-        matched_players: set = set(selection) | set(opposition)
-        remaining_players -= matched_players
-        priority_players -= matched_players
-        remaining_groups = {name[:2] for name in remaining_players}
+        query = Player.objects.filter("wc_played", "<", next_round - 1)
+        priority_players = [doc_dict["name"] for doc_dict in query.project("name")]
+    pairs: List[Tuple[str, str]] = GroupPairing(remaining_players, priority_players).pairs()
+    matches: List[Match] = [Match(season=SEASON, round_number=next_round, player1=player1, player2=player2)
+                            for player1, player2 in pairs]
     shuffle(matches)
     for index, match in enumerate(matches):
         match.order = next_match_number + index
-    Match.objects.create_all(Match.objects.to_dicts(matches))
+    matches = Match.objects.create_all(Match.objects.to_dicts(matches))
+    WC_ROUND.load(matches, matches[-1] if matches else None, standings)
     return
@@ -3,9 +3,9 @@ from itertools import product
 from random import shuffle
 from typing import List, Tuple
 
-from firestore_ci import FirestoreDocument
 from flask import url_for
 
+from documents import TrackedDocument
 from models import Player, Group
 from super_cup.errors import PlayerNotFound, GroupAlreadyInitialized, InvalidNumberOfPlayersProvidedForInitialization, SeriesNotCompleted, \
     GroupNotInitialized, SeriesCompleted, InvalidPlayerPerGroup
@@ -36,7 +36,7 @@ class CupConfig:
             raise InvalidPlayerPerGroup
         return cls.FILTERED_PLAYER_COUNT[cls.VALID_PLAYERS_PER_GROUP.index(player_per_group)]
 
-class CupSeries(FirestoreDocument):
+class CupSeries(TrackedDocument):
     PLAYER1: str = "player1"
     PLAYER2: str = "player2"
 
@@ -111,12 +111,13 @@ class CupSeries(FirestoreDocument):
         return player_type, index
 
     @staticmethod
-    def get_url(players: List[Player], player_name) -> str:
+    def get_url(players: List[Player], player_name, url_field: str = "url") -> str:
         # used in html file. Cannot error. Fail gracefully
         if player_name == CupConfig.TBD:
             return url_for("static", filename="default.jpg")
         try:
-            return next(player for player in players if player.name == player_name).url
+            player: Player = next(player for player in players if player.name == player_name)
+            return getattr(player, url_field) or player.url
         except StopIteration:
             return url_for("static", filename="default.jpg")
 
@@ -153,10 +154,10 @@ class CupSeries(FirestoreDocument):
         return [self.star_player1, self.star_player2]
 
     def get_group1_url(self, players: List[Player]) -> str:
-        return self.get_url(players, self.star_player1)
+        return self.get_url(players, self.star_player1, "url_medium")
 
     def get_group2_url(self, players: List[Player]) -> str:
-        return self.get_url(players, self.star_player2)
+        return self.get_url(players, self.star_player2, "url_medium")
 
     @property
     def group1_score(self):
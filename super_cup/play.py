@@ -7,6 +7,7 @@ from munch import Munch
 from adventure.response import StandardResponse, RequestType, SuccessMessage
 from methods import perform_io_task
 from models import Player, Group, Match
+from vote_queue import VoteUnitOfWork
 from super_cup.errors import InvalidNumberOfPlayersProvidedForInitialization, GroupAlreadyInitialized, PlayerNotFound, \
     InvalidPlayerPerGroup, SeriesNotCompleted, GroupNotInitialized, SeriesCompleted
 from super_cup.models import CupConfig, CupSeries, RoundCalculator
@@ -70,8 +71,7 @@ def create_season(request: Munch) -> Munch:
         rsp.message.error = "Not enough players found to start the season."
         return rsp.dict
     group_names: List[str] = list({player.group_name for player in selected_players})
-    get_group_tasks: List[Callable] = [Group.objects.filter_by(name=group_name).first for group_name in group_names]
-    groups: List[Group] = perform_io_task(get_group_tasks)
+    groups: List[Group] = list(Group.objects.get_many_by_names(group_names).values())
     series_to_be_created: List[CupSeries] = list()
     if player_count_per_group != 1:
         shuffle(groups)
@@ -156,11 +156,7 @@ def get_season(request: Munch) -> Munch:
     player_names: List[str] = [match.star_player1 for match in series_list if match.is_group1_initialized()]
     player_names += [match.star_player2 for match in series_list if match.is_group2_initialized()]
     player_names = list(set(player_names))
-    if player_names:
-        get_player_tasks = [Player.objects.filter_by(name=player_name).first for player_name in player_names]
-        rsp.data.players = perform_io_task(get_player_tasks)
-    else:
-        rsp.data.players = list()
+    rsp.data.players = list(Player.objects.get_many_by_names(player_names).values())
     if rsp.request.limited:
         rsp.data.earlier_rounds = [series for series in series_list
                                    if series.round_number == round_calculator.pre_quarter_final_round_number]
@@ -217,8 +213,8 @@ def update_play_result(request: Munch) -> Munch:
     group_names = [rsp.request.winner[:2], rsp.request.loser[:2]]
     get_series_task = CupSeries.objects.filter_by(season=rsp.request.season, round_number=rsp.request.round_number,
                                                   match_number=rsp.request.match_number, player_per_group=rsp.request.player_per_group).get
-    get_players_task = Player.objects.filter("name", Player.objects.IN, player_names).get
-    get_group_task = Group.objects.filter("name", Group.objects.IN, group_names).get
+    get_players_task = Player.objects.fresh.filter("name", Player.objects.IN, player_names).get
+    get_group_task = Group.objects.fresh.filter("name", Group.objects.IN, group_names).get
     get_document_tasks: List[Callable] = [get_series_task, get_players_task, get_group_task]
     results = perform_io_task(get_document_tasks)
     series: CupSeries = next((result[0] for result in results if result and isinstance(result[0], CupSeries)), None)
@@ -243,26 +239,26 @@ def update_play_result(request: Munch) -> Munch:
     losing_player = players[0] if players[0].name == rsp.request.loser else players[1]
     winning_player.update_score(played=1, won=1)
     losing_player.update_score(played=1, won=0)
-    update_tasks = [winning_player.save, losing_player.save]
+    unit_of_work: VoteUnitOfWork = VoteUnitOfWork(synced=[CupSeries]).save(winning_player, losing_player)
     if len(groups) == 1:
         groups[0].update_score(played=2, won=1)
-        update_tasks.append(groups[0].save)
+        unit_of_work.save(groups[0])
     else:
         winning_group = groups[0] if groups[0].name == rsp.request.winner[:2] else groups[1]
         losing_group = groups[0] if groups[0].name == rsp.request.loser[:2] else groups[1]
         winning_group.update_score(played=1, won=1)
         losing_group.update_score(played=1, won=0)
-        update_tasks.extend([winning_group.save, losing_group.save])
+        unit_of_work.save(winning_group, losing_group)
     match: Match = Match(season=rsp.request.season, series_type=CupConfig.TYPE, round_number=rsp.request.round_number,
                          player1=rsp.request.winner, player2=rsp.request.loser)
     match.winner = rsp.request.winner
-    update_tasks.append(match.save)
+    unit_of_work.create(match)
     try:
         series.set_winner(rsp.request.winner)
     except PlayerNotFound:
         rsp.message.error = "Exception. Winner player not found."
         return rsp.dict
-    update_tasks.append(series.save)
+    unit_of_work.save(series)
     if series.is_series_completed():
         series.series_completed_status = True
         if not series.is_season_over():
@@ -283,8 +279,8 @@ def update_play_result(request: Munch) -> Munch:
             except InvalidNumberOfPlayersProvidedForInitialization:
                 rsp.message.error = "Exception. Invalid number of players."
                 return rsp.dict
-            update_tasks.append(next_series.save)
-    perform_io_task(update_tasks)
+            unit_of_work.save(next_series)
+    unit_of_work.commit()
     rsp.message.success = SuccessMessage.PLAY_RESULT
     return rsp.dict
 
@@ -304,8 +300,7 @@ def get_all_seasons(request: Munch) -> Munch:
         return rsp.with_error_message("No completed series as yet.")
     finals.sort(key=lambda item: item.season, reverse=True)
     star_players = set(star_player for final in finals for star_player in final.star_players)
-    get_players_task = [Player.objects.filter_by(name=star_player).first for star_player in star_players]
-    players: List[Player] = perform_io_task(get_players_task)
+    players: List[Player] = list(Player.objects.get_many_by_names(star_players).values())
     rsp.data.players = players
     rsp.data.finals = finals
     return rsp.with_success_message(SuccessMessage.GET_SEASON)
@@ -0,0 +1,88 @@
+import os
+import unittest
+from unittest.mock import patch
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("FIRESTORE_EMULATOR_PROJECT_ID", "za2021-test")
+
+from counters import add_shard_counts, add_shard_counts_to_dicts, compact_shards, compact_if_due, COMPACT_SECONDS, \
+    LEASE_COLLECTION
+from documents import UnitOfWork
+from leaderboard import ResultUnitOfWork
+from memory_store import MemoryClient
+from models import Group
+from ranking import GROUP_RANKING
+
+
+class ShardedCounterTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.client = MemoryClient()
+        self.client.install()
+        self.addCleanup(self.client.uninstall)
+        group: Group = Group()
+        group.name = "AA"
+        group.update_score(played=4, won=2)
+        self.group_id: str = Group.objects.create(group.doc_to_dict()).id
+
+    def vote(self, won: int) -> None:
+        group: Group = Group.objects.filter_by(name="AA").first()
+        group.update_score(played=1, won=won)
+        UnitOfWork().save(group).commit()
+
+    def stored(self) -> dict:
+        return self.client.collection_dict(Group.COLLECTION)[self.group_id]
+
+    def test_votes_go_to_the_shards(self):
+        for won in (1, 1, 0):
+            self.vote(won)
+        self.assertEqual((4, 2, "0500000004"), (self.stored()["played"], self.stored()["won"], self.stored()["score"]))
+        self.assertLessEqual(1, len(self.client.collection_dict(Group.shard_collection())))
+        group: Group = add_shard_counts([Group.get_by_id(self.group_id)])[0]
+        self.assertEqual((7, 4, "0500000004"), (group.played, group.won, group.score))  # Derived at compaction
+        self.assertEqual(dict(), group.changed_fields)
+        self.assertEqual(7, add_shard_counts_to_dicts(Group, Group.objects.project("played"))[0]["played"])
+
+    def test_compaction_keeps_the_total(self):
+        for won in (1, 0):
+            self.vote(won)
+        self.assertEqual(1, compact_shards(Group))
+        self.assertEqual((6, 3, "0500000006"), (self.stored()["played"], self.stored()["won"], self.stored()["score"]))
+        shards = self.client.collection_dict(Group.shard_collection())
+        self.assertTrue(all(not shard.get("played") and not shard.get("won") for shard in shards.values()))
+        self.vote(1)
+        self.assertEqual((7, 4), (add_shard_counts([Group.get_by_id(self.group_id)])[0].played, self.stored()["won"] + 1))
+        self.assertEqual(1, compact_shards(Group))
+        self.assertEqual(0, compact_shards(Group))
+        self.assertEqual("0571400007", Group.get_by_id(self.group_id).score)
+
+    def test_rank_moves_at_compaction(self):
+        group: Group = Group()
+        group.name = "BB"
+        group.update_score(played=4, won=3)
+        Group.objects.create(group.doc_to_dict())
+        with patch.object(GROUP_RANKING, "_index", None):
+            GROUP_RANKING.refresh()
+            for _ in range(4):
+                group = Group.objects.fresh.filter_by(name="AA").first()
+                group.update_score(played=1, won=1)
+                ResultUnitOfWork().save(group).commit()
+            self.assertEqual((2, "0500000004"), (GROUP_RANKING.index.rank(self.group_id), self.stored()["score"]))
+            compact_shards(Group)
+            self.assertEqual(1, GROUP_RANKING.index.rank(self.group_id))
+        self.assertEqual((1, "0750000008"), (self.stored()["rank"], self.stored()["score"]))
+
+    def test_one_compaction_per_period(self):
+        self.vote(1)
+        with patch("counters.time", return_value=COMPACT_SECONDS * 10):
+            self.assertEqual(1, compact_if_due())
+            self.vote(1)
+            self.assertEqual(0, compact_if_due())  # Taken by another worker in this period
+        with patch("counters.time", return_value=COMPACT_SECONDS * 11):
+            self.assertEqual(1, compact_if_due())
+        self.assertEqual((6, 4), (self.stored()["played"], self.stored()["won"]))
+        self.assertEqual(["11"], list(self.client.collection_dict(LEASE_COLLECTION)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import os
+import unittest
+from typing import List, Dict
+from unittest.mock import patch, MagicMock
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("FIRESTORE_EMULATOR_PROJECT_ID", "za2021-test")
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore import Increment
+
+from documents import UnitOfWork
+from memory_store import MemoryClient
+from models import Player, Match, Group
+
+
+class DocumentCacheTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        Player.objects.cache.clear()
+        self.player = Player()
+        self.player.name = "AB001"
+        self.player.group_name = "AB"
+        self.player.set_id("player-id")
+        Player.objects.cache.put(self.player)
+
+    def test_read_by_name(self):
+        player: Player = Player.objects.filter_by(name="AB001").first()
+        self.assertEqual("player-id", player.id)
+        self.assertEqual("AB", player.group_name)
+        players = Player.objects.filter("name", Player.objects.IN, ["AB001"]).get()
+        self.assertEqual(["AB001"], [player.name for player in players])
+
+    def test_get_many_by_names_from_cache(self):
+        players = Player.objects.get_many_by_names(["AB001", "AB001", str()])
+        self.assertEqual(["AB001"], list(players))
+        self.assertEqual("player-id", players["AB001"].id)
+
+    def test_read_by_id(self):
+        self.assertEqual("AB001", Player.get_by_id("player-id").name)
+
+    def test_cached_copy_is_isolated(self):
+        player: Player = Player.objects.filter_by(name="AB001").first()
+        player.update_score(played=1, won=1)
+        self.assertEqual(0, Player.objects.filter_by(name="AB001").first().played)
+
+    @patch("firestore_ci.FirestoreQuery.get", return_value=list())
+    def test_fresh_bypasses_cache(self, get: MagicMock):
+        self.assertEqual(list(), Player.objects.fresh.filter("name", Player.objects.IN, ["AB001"]).get())
+        self.assertEqual(dict(), Player.objects.fresh.get_many_by_names(["AB001"]))
+        self.assertEqual(2, get.call_count)
+        self.assertEqual(["AB001"], [player.name for player in Player.objects.filter_by(name="AB001").get()])
+
+    def test_rename_and_invalidate(self):
+        self.player.name = "AB002"
+        Player.objects.cache.put(self.player)
+        self.assertIsNone(Player.objects.cache.get_by_name("AB001"))
+        self.assertEqual("player-id", Player.objects.cache.get_by_name("AB002")[0])
+        Player.objects.cache.invalidate(self.player)
+        self.assertIsNone(Player.objects.cache.get_by_id("player-id"))
+        self.assertIsNone(Player.objects.cache.get_by_name("AB002"))
+
+
+class TrackedDocumentTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        Player.objects.cache.clear()
+        self.player: Player = Player.dict_to_doc(Player().doc_to_dict(), "player-id")
+
+    def test_loaded_document_is_clean(self):
+        self.assertTrue(self.player.is_tracked)
+        self.assertEqual(dict(), self.player.changed_fields)
+
+    @patch("documents._DB")
+    def test_save_sends_changed_fields_only(self, db: MagicMock):
+        self.player.update_score(played=1, won=1)
+        self.assertTrue(self.player.save())
+        doc_ref: MagicMock = db.collection.return_value.document.return_value
+        doc_ref.update.assert_called_once_with({"played": Increment(1), "won": Increment(1), "score": "100000001"})
+        doc_ref.set.assert_not_called()
+        self.assertEqual(dict(), self.player.changed_fields)
+        self.assertTrue(self.player.save())
+        doc_ref.update.assert_called_once()
+
+    @patch("documents._DB")
+    def test_save_recreates_deleted_document(self, db: MagicMock):
+        doc_ref: MagicMock = db.collection.return_value.document.return_value
+        doc_ref.update.side_effect = NotFound("deleted")
+        self.player.update_score(played=1, won=1)
+        self.assertTrue(self.player.save())
+        doc_ref.set.assert_called_once_with(self.player.doc_to_dict())
+        self.assertEqual(dict(), self.player.changed_fields)
+
+    @patch("documents._DB")
+    def test_unit_of_work_skips_unchanged_documents(self, db: MagicMock):
+        UnitOfWork().save(self.player).commit()
+        db.batch.return_value.commit.assert_not_called()
+        self.player.rank = 7
+        UnitOfWork().save(self.player).commit()
+        db.batch.return_value.update.assert_called_once_with(db.collection.return_value.document.return_value,
+                                                             {"rank": 7})
+
+
+class IncrementTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.client = MemoryClient()
+        self.client.install()
+        self.addCleanup(self.client.uninstall)
+        player: Player = Player()
+        player.name = "AB001"
+        player.update_score(played=4, won=2)
+        self.player_id: str = Player.objects.create(player.doc_to_dict()).id
+
+    def test_concurrent_votes_add_up(self):
+        players = [Player.objects.fresh.filter_by(name="AB001").first() for _ in range(2)]
+        players[0].wc_update_score(won=True, margin="high")
+        players[1].update_score(played=1, won=0)
+        UnitOfWork().save(players[0]).commit()
+        players[1].save()
+        player: Player = Player.objects.fresh.filter_by(name="AB001").first()
+        self.assertEqual((6, 3, 3, 1), (player.played, player.won, player.wc_score, player.wc_played))
+        self.assertEqual("050000006", player.score)
+        self.assertEqual("040000005", self.client.collection_dict(Player.COLLECTION)[self.player_id]["score"])
+        player.save()  # The score derived on load repairs the stored one
+        self.assertEqual("050000006", self.client.collection_dict(Player.COLLECTION)[self.player_id]["score"])
+
+    def test_assigned_counter_is_sent_as_value(self):
+        player: Player = Player.objects.fresh.filter_by(name="AB001").first()
+        player.update_score(played=1, won=1)
+        self.assertEqual(Increment(1), player.update_fields["played"])
+        player.init_score()
+        self.assertEqual({"played": 0, "won": 0, "score": "0" * 9}, player.update_fields)
+        group: Group = Group()
+        group.update_score(played=2, won=1)
+        self.assertEqual(2, group.update_fields["played"])
+
+
+class UnitOfWorkTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        Player.objects.cache.clear()
+
+    @patch("documents._DB")
+    def test_commit_in_single_batch(self, db: MagicMock):
+        db.collection.return_value.document.return_value.id = "match-id"
+        player = Player()
+        player.name = "AB001"
+        player.set_id("player-id")
+        player.update_score(played=1, won=1)
+        match = Match(series_type="friendly", player1="AB001", player2="CD001")
+        UnitOfWork().save(player, player).create(match).commit()
+        batch: MagicMock = db.batch.return_value
+        self.assertEqual(2, batch.set.call_count)
+        batch.commit.assert_called_once()
+        self.assertEqual("match-id", match.id)
+        self.assertEqual(1, Player.objects.filter_by(name="AB001").first().played)
+
+    @patch("documents._DB")
+    def test_same_id_in_other_collection_is_saved(self, db: MagicMock):
+        player = Player()
+        player.set_id("shared-id")
+        match = Match()
+        match.set_id("shared-id")
+        UnitOfWork().save(player, match, player).commit()
+        self.assertEqual(2, db.batch.return_value.set.call_count)
+
+    def test_commit_recreates_only_the_deleted_document(self):
+        with MemoryClient() as client:
+            players: List[Player] = [Player.objects.create({"name": name, "played": 4, "won": 2}) for name in ("AB001", "CD001")]
+            for player in players:
+                player.update_score(played=1, won=1)
+            del client.collection_dict(Player.COLLECTION)[players[0].id]
+            client.collection_dict(Player.COLLECTION)[players[1].id]["rank"] = 7  # Written by another worker
+            UnitOfWork().save(*players).commit()
+            stored: Dict[str, dict] = client.collection_dict(Player.COLLECTION)
+            self.assertEqual((5, 3, "060000005"), (stored[players[0].id]["played"], stored[players[0].id]["won"],
+                                                   stored[players[0].id]["score"]))
+            self.assertEqual((5, 3, 7), (stored[players[1].id]["played"], stored[players[1].id]["won"],
+                                         stored[players[1].id]["rank"]))
+            self.assertEqual(dict(), players[0].changed_fields)
+
+    @patch("documents._DB")
+    def test_failed_commit_invalidates_cache(self, db: MagicMock):
+        db.batch.return_value.commit.side_effect = RuntimeError
+        player = Player()
+        player.name = "AB001"
+        player.set_id("player-id")
+        Player.objects.cache.put(player)
+        player.update_score(played=1, won=1)
+        with self.assertRaises(RuntimeError):
+            UnitOfWork().save(player).commit()
+        self.assertIsNone(Player.objects.cache.get_by_id("player-id"))
+
+
+if __name__ == '__main__':
+    unittest.main()
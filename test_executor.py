@@ -0,0 +1,45 @@
+import unittest
+from threading import Event
+from time import monotonic
+from unittest.mock import patch
+
+from executor import IOExecutor, DeadlineExceeded
+
+
+class IOExecutorTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.executor = IOExecutor(max_workers=2)
+
+    def test_results_in_submission_order(self):
+        self.assertEqual([1, 2, 3], self.executor.run_all([lambda: 1, lambda: 2, lambda: 3]))
+        self.assertEqual(3, self.executor.gauges["completed"])
+        self.assertEqual(0, self.executor.gauges["queue_depth"])
+
+    def test_nested_fan_out_runs_inline(self):
+        result = self.executor.run_all([lambda: self.executor.run_all([lambda: 1, lambda: 2]) for _ in range(4)])
+        self.assertEqual([[1, 2]] * 4, result)
+
+    def test_deadline_cancels_stragglers(self):
+        release = Event()
+        tasks = [release.wait] * 4
+        with self.assertRaises(DeadlineExceeded):
+            self.executor.run_all(tasks, deadline=monotonic() + 0.1)
+        release.set()
+        self.assertEqual(2, self.executor.gauges["cancelled"])
+        with self.assertRaises(DeadlineExceeded):
+            self.executor.submit(lambda: 1, deadline=monotonic() - 1)
+
+    def test_deadline_during_submit_cancels_submitted(self):
+        release = Event()
+        self.executor = IOExecutor(max_workers=1)
+        with patch("executor.monotonic", side_effect=[0, 0, 2]):
+            with self.assertRaises(DeadlineExceeded):
+                self.executor.run_all([release.wait] * 3, deadline=1)
+        release.set()
+        self.assertGreaterEqual(self.executor.gauges["cancelled"], 1)
+        self.assertEqual(0, self.executor.gauges["queue_depth"])
+
+
+if __name__ == '__main__':
+    unittest.main()
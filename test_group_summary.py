@@ -0,0 +1,89 @@
+import os
+import unittest
+from typing import Optional
+from unittest.mock import patch, MagicMock
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("FIRESTORE_EMULATOR_PROJECT_ID", "za2021-test")
+
+from documents import CachedQuery
+from group_summary import rebuild_group_summaries, record_star_players
+from models import Player, Group, Standing
+
+
+def create_player(name: str, played: int, won: int) -> Player:
+    player: Player = Player()
+    player.name = name
+    player.group_name = name[:2]
+    player.url = f"url-{name}"
+    player.update_score(played, won)
+    return Player.dict_to_doc(player.doc_to_dict(), f"id-{name}")
+
+
+def create_group(name: str, star: Optional[Player] = None) -> Group:
+    group: Group = Group()
+    group.name = name
+    if star:
+        group.player_name = star.name
+        group.url = star.url
+        group.url_expiration = star.url_expiration
+    return Group.dict_to_doc(group.doc_to_dict(), f"id-{name}")
+
+
+class GroupSummaryTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        Player.objects.cache.clear()
+        Group.objects.cache.clear()
+        self.players = [create_player("AB001", 4, 3), create_player("AB002", 4, 2), create_player("CD001", 4, 1)]
+        self.players[0].star_player = True
+        self.players[0].mark_clean()
+        self.group = create_group("AB", self.players[0])
+        for player in self.players:
+            Player.objects.cache.put(player)
+        Group.objects.cache.put(self.group)
+
+    def test_rebuild_in_one_pass(self):
+        groups = [create_group("AB"), create_group("CD"), create_group("EF")]
+        standing = Standing(season=2022, group_name="CD")
+        rebuild_group_summaries(self.players, groups, [standing])
+        self.assertEqual([2, 1, 0], [group.player_count for group in groups])
+        self.assertEqual(["AB001", "CD001", str()], [group.player_name for group in groups])
+        self.assertEqual([True, False, True], [player.star_player for player in self.players])
+        self.assertEqual(("CD001", "url-CD001"), (standing.url_name, standing.url))
+
+    @patch("group_summary.Standing")
+    def test_better_player_becomes_star(self, standing_class: MagicMock):
+        standing: Standing = Standing.dict_to_doc(Standing(season=2022, group_name="AB").doc_to_dict(), "id-standing")
+        standing_class.objects.filter_by.return_value.first.return_value = standing
+        scorer: Player = self.players[1]
+        scorer.update_score(played=4, won=4)
+        old_star, star, group, changed_standing = record_star_players([scorer])
+        self.assertEqual(("AB002", "url-AB002"), (group.player_name, group.url))
+        self.assertEqual(("AB002", "url-AB002"), (standing.url_name, standing.url))
+        self.assertEqual([("AB001", False), ("AB002", True)], [(old_star.name, old_star.star_player),
+                                                               (star.name, star.star_player)])
+        self.assertIs(scorer, star)
+        self.assertEqual([self.group, standing], [group, changed_standing])
+
+    @patch("group_summary.Standing")
+    def test_weaker_player_changes_nothing(self, standing_class: MagicMock):
+        scorer: Player = self.players[1]
+        scorer.update_score(played=1, won=1)
+        self.assertEqual(list(), record_star_players([scorer, self.players[2]]))
+        standing_class.objects.filter_by.assert_not_called()
+
+    @patch("group_summary.Standing")
+    def test_losing_star_scans_its_group(self, standing_class: MagicMock):
+        standing_class.objects.filter_by.return_value.first.return_value = None
+        star: Player = self.players[0]
+        star.update_score(played=8, won=0)
+        with patch.object(CachedQuery, "get", return_value=[create_player("AB001", 4, 3), self.players[1]]) as get:
+            changed = record_star_players([star])
+        get.assert_called_once()
+        self.assertEqual([star, self.players[1], self.group], changed)
+        self.assertEqual("AB002", changed[2].player_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
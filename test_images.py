@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+from datetime import timedelta
+from unittest.mock import patch, MagicMock, PropertyMock
+
+from images import ImageIndex, get_crc32c
+
+
+def create_blob(name: str, size: int = 10, crc32c: str = "crc") -> MagicMock:
+    blob = MagicMock()
+    blob.name = name
+    blob.size = size
+    blob.crc32c = crc32c
+    blob.updated = None
+    return blob
+
+
+class ImageIndexTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.bucket = MagicMock()
+        self.bucket.list_blobs.return_value = [create_blob("images/AB001.png"), create_blob("images/AB001.jpg"),
+                                               create_blob("images/AB002.webp"), create_blob("images/notes.txt")]
+        patcher = patch.object(ImageIndex, "bucket", new_callable=PropertyMock, return_value=self.bucket)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index = ImageIndex()
+
+    def test_single_listing(self):
+        self.assertEqual("images/AB001.jpg", self.index.get("AB001").name)
+        self.assertEqual("images/AB002.webp", self.index.get("AB002").name)
+        self.assertIsNone(self.index.get("AB003"))
+        self.assertIsNone(self.index.get_object("images/notes.txt"))
+        self.bucket.list_blobs.assert_called_once_with(prefix="images/")
+        self.bucket.blob.assert_not_called()
+
+    def test_add_and_sign(self):
+        self.index.add(create_blob("images/AB003.jpeg"))
+        self.assertEqual(10, self.index.get("AB003").size)
+        self.index.sign_url("images/AB003.jpeg", timedelta(days=1))
+        self.bucket.blob.assert_called_once_with("images/AB003.jpeg")
+
+    def test_derivatives(self):
+        self.bucket.list_blobs.return_value.extend([create_blob("images/thumbnail/AB001.webp"),
+                                                    create_blob("images/other/AB002.webp")])
+        self.bucket.blob.return_value.generate_signed_url.side_effect = lambda **_: "signed"
+        self.assertEqual("images/AB001.jpg", self.index.get("AB001").name)
+        self.assertEqual("images/thumbnail/AB001.webp", self.index.get_derivative("AB001", "thumbnail").name)
+        self.assertIsNone(self.index.get_derivative("AB001", "medium"))
+        self.assertIsNone(self.index.get_object("images/other/AB002.webp"))
+        urls: dict = self.index.sign_urls("AB001", timedelta(days=1))
+        self.assertEqual({"url": "signed", "url_thumbnail": "signed", "url_medium": str()}, urls)
+        self.assertIsNone(self.index.sign_urls("AB003", timedelta(days=1)))
+
+    def test_find_by_content(self):
+        self.assertEqual("images/AB001.jpg", self.index.find_by_crc32c("crc").name)
+        self.index.add(create_blob("images/AB001.jpg", crc32c="new"))
+        self.assertEqual("images/AB001.png", self.index.find_by_crc32c("crc").name)
+        self.assertEqual("images/AB001.jpg", self.index.find_by_crc32c("new").name)
+        self.assertIsNone(self.index.find_by_crc32c("other"))
+
+    def test_crc32c_of_file(self):
+        file_path: str = os.path.join(tempfile.mkdtemp(), "AB001.jpg")
+        with open(file_path, "wb") as file:
+            file.write(b"abc")
+        self.assertEqual("Nks/tw==", get_crc32c(file_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import unittest
+from unittest.mock import patch
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("FIRESTORE_EMULATOR_PROJECT_ID", "za2021-test")
+
+from leaderboard import Board
+from memory_store import MemoryClient
+from models import Player, Leaderboard
+
+
+def create_player(doc_id: str, played: int, won: int) -> Player:
+    player: Player = Player()
+    player.name = f"AB{doc_id}"
+    player.url = f"url-{doc_id}"
+    player.update_score(played, won)
+    player.set_id(doc_id)
+    return player
+
+
+class BoardTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        with patch("leaderboard._BOARDS", dict()):
+            self.board = Board("test", Player, ["name", "url", "score"], key=lambda row: row["score"],
+                               loader=lambda _: list(), size=2, rank_field="rank")
+        self.board.SPARE_ROWS = 1
+        self.players = [create_player(str(index), 4, won) for index, won in enumerate([4, 3, 3, 2, 1])]
+
+    def test_build_from_top_rows(self):
+        board_dict: dict = self.board.build(self.players[:3])
+        self.assertEqual([1, 2, 2], [row["rank"] for row in board_dict["rows"]])
+        self.assertEqual(self.players[2].score, board_dict["boundary"])
+        self.assertTrue(board_dict["complete"])
+        self.assertIsNone(self.board.build(self.players[:2])["boundary"])
+
+    def test_merge_moves_rows_and_trims(self):
+        board_dict: dict = self.board.build(self.players[:3])
+        self.players[4].update_score(played=12, won=12)
+        board_dict = self.board.merge(board_dict, [self.players[4]])
+        self.assertEqual(["0", "4"], [row["id"] for row in board_dict["rows"]][:2])
+        self.assertEqual([1, 2, 3], [row["rank"] for row in board_dict["rows"]])
+        self.assertEqual(self.players[1].score, board_dict["boundary"])
+
+    def test_row_below_boundary_leaves_board(self):
+        board_dict: dict = self.board.build(self.players[:3])
+        self.players[0].update_score(played=8, won=0)
+        self.players[0].url = str()
+        board_dict = self.board.merge(board_dict, [self.players[0], self.players[3]])
+        self.assertEqual(["1", "2"], [row["id"] for row in board_dict["rows"]])
+        self.assertTrue(board_dict["complete"])
+        self.players[1].update_score(played=8, won=0)
+        self.assertFalse(self.board.merge(board_dict, [self.players[1]])["complete"])
+
+    def test_record_many_documents(self):
+        with MemoryClient() as client:
+            client.collection(Leaderboard.COLLECTION).document(self.board.document_id()).set(self.board.build(self.players[:3]))
+            self.players[4].update_score(played=12, won=12)
+            self.board.record([self.players[4], self.players[3]])
+            self.assertEqual(["0", "4"], [row["id"] for row in Leaderboard.get_by_id(self.board.document_id()).rows][:2])
+
+    def test_incomplete_board_is_served_without_writes(self):
+        self.board._loader = lambda _: self.players
+        with MemoryClient() as client:
+            self.assertEqual(["0", "1"], [row.id for row in self.board.get()])
+            self.assertEqual(0, client.stats.writes)
+            self.board.rebuild()
+            self.assertTrue(Leaderboard.get_by_id(self.board.document_id()).complete)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import random
+import unittest
+from unittest.mock import patch, MagicMock
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("FIRESTORE_EMULATOR_PROJECT_ID", "za2021-test")
+
+from models import Player
+from pairing import PairingQueue, GroupPairing
+
+
+def create_players(count: int):
+    players = list()
+    for index in range(count):
+        player = Player()
+        player.name = f"AB{index:03}"
+        players.append(player)
+    return players
+
+
+class PairingQueueTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.queue = PairingQueue()
+
+    @patch("pairing.io_executor")
+    @patch.object(PairingQueue, "_load_candidates", return_value=create_players(5))
+    def test_pairs_served_from_memory(self, load: MagicMock, executor: MagicMock):
+        pairs = [self.queue.pop("top") for _ in range(PairingQueue.QUEUE_SIZE - PairingQueue.REFILL_AT - 1)]
+        self.assertTrue(all(pair[0].name != pair[1].name for pair in pairs))
+        load.assert_called_once_with("top")
+        executor.submit.assert_not_called()
+        self.queue.pop("top")
+        executor.submit.assert_called_once()
+        self.queue.pop("top")
+        executor.submit.assert_called_once()
+
+    @patch.object(PairingQueue, "_load_candidates", return_value=create_players(1))
+    def test_invalid_mode_and_short_group(self, load: MagicMock):
+        self.assertIsNone(self.queue.pop("middle"))
+        self.assertIsNone(self.queue.pop("groupAB"))
+        load.assert_called_once_with("groupAB")
+
+    @patch.object(PairingQueue, "_load_candidates", return_value=create_players(6))
+    def test_random_players_play_once(self, _):
+        self.queue.refill("random")
+        names = [player.name for _ in range(3) for player in self.queue.pop("random")]
+        self.assertEqual(6, len(set(names)))
+
+
+class GroupPairingTestCase(unittest.TestCase):
+
+    def test_no_pair_within_a_group(self):
+        names = [f"AA{index:03}" for index in range(6)] + [f"BB{index:03}" for index in range(3)] + ["CC001", "DD001"]
+        pairs = GroupPairing(names, rng=random.Random(1)).pairs()
+        self.assertEqual(5, len(pairs))
+        self.assertTrue(all(player1[:2] != player2[:2] for player1, player2 in pairs))
+        self.assertEqual(10, len({name for pair in pairs for name in pair}))
+        self.assertTrue(all(player1[:2] == "AA" for player1, _ in pairs))
+
+    def test_priority_players_are_paired_first(self):
+        names = [f"AA{index:03}" for index in range(4)] + [f"BB{index:03}" for index in range(4)] + ["CC001"]
+        pairs = GroupPairing(names, ["BB001", "BB002", "ZZ001"], rng=random.Random(2)).pairs()
+        self.assertEqual({"BB001", "BB002"}, {player1 for player1, _ in pairs[:2]})
+        self.assertEqual(4, len(pairs))
+        self.assertTrue(all(player1[:2] != player2[:2] for player1, player2 in pairs))
+
+    def test_largest_group_outnumbers_the_rest(self):
+        names = [f"AA{index:03}" for index in range(5)] + ["BB001", "CC001"]
+        pairs = GroupPairing(names, rng=random.Random(3)).pairs()
+        self.assertEqual({"BB001", "CC001"}, {player2 for _, player2 in pairs})
+
+    def test_large_round(self):
+        rng = random.Random(4)
+        names = [f"{rng.choice('ABCDEFGH')}{rng.choice('ABCDEFGH')}{index:05}" for index in range(10000)]
+        pairs = GroupPairing(names, rng.sample(names, k=1000), rng).pairs()
+        self.assertTrue(all(player1[:2] != player2[:2] for player1, player2 in pairs))
+        self.assertEqual(2 * len(pairs), len({name for pair in pairs for name in pair}))
+        self.assertLessEqual(10000 - 2 * len(pairs), max(sum(1 for name in names if name[:2] == group)
+                                                         for group in {name[:2] for name in names}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import random
+import unittest
+from unittest.mock import patch, MagicMock
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("FIRESTORE_EMULATOR_PROJECT_ID", "za2021-test")
+
+from adventure.play import sample_ranked_players
+from memory_store import MemoryClient
+from methods import update_rank
+from models import Player
+from ranking import RankIndex, Ranking, RankedUnitOfWork
+
+
+def create_player(doc_id: str, played: int, won: int) -> Player:
+    player: Player = Player()
+    player.update_score(played, won)
+    player = Player.dict_to_doc(player.doc_to_dict(), doc_id)
+    return player
+
+
+class RankIndexTestCase(unittest.TestCase):
+
+    def test_ties_share_rank(self):
+        index = RankIndex([("a", 10), ("b", 20), ("c", 20), ("d", 5)])
+        self.assertEqual([1, 1, 3, 4], [index.rank(doc_id) for doc_id in ("b", "c", "a", "d")])
+        self.assertEqual({"b", "c"}, set(index.ordered_ids()[:2]))
+
+    def test_window_matches_full_rerank(self):
+        random.seed(7)
+        players = [create_player(str(index), random.randint(1, 9), 0) for index in range(200)]
+        update_rank(players)
+        index = RankIndex((player.id, player.score) for player in players)
+        for _ in range(500):
+            player: Player = random.choice(players)
+            player.update_score(played=1, won=random.randint(0, 1))
+            for doc_id, rank in index.update(player.id, player.score).items():
+                next(item for item in players if item.id == doc_id).rank = rank
+            expected = {item.id: item.rank for item in players}
+            update_rank(players)
+            self.assertEqual({item.id: item.rank for item in players}, expected)
+
+
+class RankingTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        Player.objects.cache.clear()
+        self.players = [create_player("a", 2, 2), create_player("b", 2, 1), create_player("c", 2, 0)]
+        with patch("ranking._RANKINGS", dict()) as rankings:
+            self.ranking = Ranking(Player, loader=lambda: [(player.id, player.score) for player in self.players])
+        self.rankings = rankings
+
+    def test_ranks_unchanged_until_refreshed(self):
+        self.assertEqual([0, 0, 0], [player.rank for player in self.ranking.apply(self.players)])
+        self.assertEqual(dict(), self.ranking.record(self.players[0]))
+        self.ranking.refresh()
+        self.assertEqual([1, 2, 3], [player.rank for player in self.ranking.apply(self.players)])
+
+    @patch("documents._DB")
+    @patch("ranking._DB")
+    def test_commit_writes_saved_ranks_in_batch(self, db: MagicMock, _):
+        self.ranking.refresh()
+        self.ranking.apply(self.players)
+        for player in self.players:
+            player.mark_clean()
+        self.players[2].update_score(played=2, won=2)
+        with patch("ranking._RANKINGS", self.rankings):
+            RankedUnitOfWork().save(self.players[2]).commit()
+        self.assertEqual(2, self.players[2].rank)
+        db.batch.return_value.update.assert_called_once_with(db.collection.return_value.document.return_value,
+                                                             {"rank": 3})
+        db.collection.return_value.document.assert_called_once_with("b")
+        self.assertEqual(["a", "c", "b"], [player.id for player in self.ranking.order(self.players)])
+
+    @patch("documents._DB")
+    @patch("ranking._DB")
+    def test_window_written_in_chunks(self, db: MagicMock, _):
+        self.ranking.refresh()
+        player: Player = create_player("d", 2, 2)
+        player.update_score(played=1, won=1)
+        with patch("ranking._RANKINGS", self.rankings), patch.object(RankedUnitOfWork, "BATCH_LIMIT", 2):
+            RankedUnitOfWork().save(player).commit()
+        self.assertEqual(1, player.rank)
+        self.assertEqual(3, db.batch.return_value.update.call_count)
+        self.assertEqual(2, db.batch.return_value.commit.call_count)
+
+
+class RankedPlayerSampleTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.client = MemoryClient()
+        self.client.install()
+        self.addCleanup(self.client.uninstall)
+        ranks = [1, 1, 1, 4, 5, 5, 7, 0, 1201]  # Tied ranks leave holes. 0 is unranked.
+        for index, rank in enumerate(ranks):
+            Player.objects.create({"name": f"AA{index:03}", "rank": rank})
+
+    def test_sample_in_one_query(self):
+        queries: int = self.client.stats.queries
+        players = sample_ranked_players(5)
+        self.assertEqual(1, self.client.stats.queries - queries)
+        self.assertEqual(5, len({player.name for player in players}))
+        self.assertTrue(all(player.name < "AA007" and player.id for player in players))
+
+    def test_sample_with_fewer_ranked_players(self):
+        self.assertEqual(7, len(sample_ranked_players(20)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import os
+import unittest
+from unittest.mock import patch, MagicMock
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("FIRESTORE_EMULATOR_PROJECT_ID", "za2021-test")
+
+from documents import UnitOfWork
+from models import Match, Series, Standing, Player, SeriesState, INITIAL1, INITIAL2, WINNER, LOSER, DECIDER
+from memory_store import MemoryClient
+from s2021 import methods
+from s2021.simulator import SeasonSimulator
+from s2021.utils import RoundGroupCache, get_order, get_range_of_week, get_list_of_rounds, get_series_types, \
+    link_bracket, get_bracket_errors, MatchGroup, get_match_player, get_conquest_names, get_lhs_names
+
+
+def create_series(round_number: int, series_type: str, order: int, group_name1: str, group_name2: str) -> Series:
+    series: Series = Series(1, 1, round_number, series_type, order)
+    series.set_group_name1(group_name1)
+    series.set_group_name2(group_name2)
+    return series
+
+
+@patch("s2021.methods.get_standings_with_url")
+@patch("s2021.methods.Series")
+class RoundGroupsTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        patcher = patch("s2021.methods.ROUND_GROUP_CACHE", RoundGroupCache())
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.week_series = [create_series(101, INITIAL2, 2, "CC", "DD"), create_series(101, INITIAL1, 1, "AA", "BB"),
+                            create_series(601, INITIAL1, 3, "AA", "CC")]
+        self.standings = [Standing(1, group_name, url=f"url-{group_name}") for group_name in ("AA", "BB", "CC", "DD")]
+
+    def test_build_from_indexes(self, series_class: MagicMock, get_standings: MagicMock):
+        series_class.objects.filter_by.return_value.get.return_value = self.week_series
+        get_standings.return_value = self.standings
+        round_groups = methods.get_round_groups(1, 1)
+        get_standings.assert_called_once_with(1)
+        self.assertEqual(["1", "2", "3", "4", "5 & 6"], [round_group.round_group_text for round_group in round_groups])
+        series_standings = round_groups[0].rounds[0].series_standings
+        self.assertEqual([("url-AA", "url-BB"), ("url-CC", "url-DD")],
+                         [(item.standing1.url, item.standing2.url) for item in series_standings])
+        self.assertEqual(601, round_groups[4].rounds[0].round_number)
+
+    def test_cached_until_a_series_of_the_week_changes(self, series_class: MagicMock, get_standings: MagicMock):
+        series_class.objects.filter_by.return_value.get.return_value = self.week_series
+        get_standings.return_value = self.standings
+        round_groups = methods.get_round_groups(1, 1)
+        self.assertIs(round_groups, methods.get_round_groups(1, 1))
+        self.cache.invalidate(1, 2)
+        self.assertIs(round_groups, methods.get_round_groups(1, 1))
+        self.cache.invalidate(1, 1)
+        self.assertIsNot(round_groups, methods.get_round_groups(1, 1))
+        self.assertEqual(2, get_standings.call_count)
+
+
+def create_state() -> SeriesState:
+    series: Series = create_series(101, INITIAL1, 1, "AA", "BB")
+    series = Series.dict_to_doc(series.doc_to_dict(), "series-id")
+    players = [Player.dict_to_doc({"name": f"{group_name}00{index}", "group_name": group_name})
+               for group_name in ("AA", "BB") for index in range(1, 4)]
+    standings = [Standing.dict_to_doc(Standing(1, group_name).doc_to_dict(), f"id-{group_name}") for group_name in ("AA", "BB")]
+    state: SeriesState = SeriesState()
+    state.set_id(series.id)
+    state.set_series(series)
+    state.set_players(players)
+    state.set_standings(standings)
+    methods.add_next_match(series, methods.get_match_group(series, state), state)
+    return state
+
+
+class SeriesStateTestCase(unittest.TestCase):
+
+    @patch("s2021.methods.record_leaderboards")
+    @patch("documents._DB")
+    def test_vote_is_one_batch(self, db: MagicMock, record_leaderboards: MagicMock):
+        state: SeriesState = create_state()
+        series: Series = state.get_series()
+        match_group = methods.get_match_group(series, state)
+        winner: Player = match_group.current_match.player1
+        methods.update_results(series, match_group, winner.name, state)
+        db.batch.assert_called_once()
+        db.batch.return_value.commit.assert_called_once()
+        self.assertEqual(4, db.batch.return_value.set.call_count + db.batch.return_value.update.call_count)
+        self.assertEqual([1, 0], state.get_series().scores)
+        self.assertEqual([winner.name, str()], [match.winner for match in state.get_matches()])
+        self.assertEqual([1, 0], [standing.weekly_ties[0] for standing in state.get_standings()])
+        record_leaderboards.assert_called_once()
+        next_group = methods.get_match_group(state.get_series(), state)
+        self.assertEqual(1, len(next_group.past_matches))
+        self.assertEqual(2, next_group.current_match.match.order)
+
+
+class BracketTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.series_list = [Series(1, week, round_number, series_type, get_order(week, round_number, series_type))
+                            for week in get_range_of_week()
+                            for round_number in get_list_of_rounds(week)
+                            for series_type in get_series_types(week, round_number)]
+        for index, series in enumerate(self.series_list):
+            series.set_id(f"id-{index}")
+        link_bracket(self.series_list)
+        self.series_by_key = {(series.week, series.round, series.type): series for series in self.series_list}
+
+    def test_every_slot_filled_once(self):
+        self.assertEqual(list(), get_bracket_errors(self.series_list))
+        self.series_list[0].loser_to = self.series_list[0].winner_to
+        self.assertEqual(2, len(get_bracket_errors(self.series_list)))
+
+    def test_successors(self):
+        winner: Series = self.series_by_key[(1, 101, WINNER)]
+        self.assertEqual((self.series_by_key[(1, 201, INITIAL1)].id, 1), (winner.winner_to, winner.winner_slot))
+        self.assertEqual((self.series_by_key[(1, 101, DECIDER)].id, 1), (winner.loser_to, winner.loser_slot))
+        loser: Series = self.series_by_key[(1, 101, LOSER)]
+        self.assertEqual((self.series_by_key[(1, 101, DECIDER)].id, 2), (loser.winner_to, loser.winner_slot))
+        self.assertEqual(str(), loser.loser_to)
+
+    @patch("s2021.methods._DB")
+    def test_advance_without_queries(self, db: MagicMock):
+        series: Series = self.series_by_key[(1, 101, INITIAL2)]
+        series.set_group_name1("AA")
+        series.set_group_name2("BB")
+        series.winner = "BB"
+        snapshots = [MagicMock(id=successor.id, exists=True, to_dict=MagicMock(return_value=successor.doc_to_dict()))
+                     for successor in (self.series_by_key[(1, 101, WINNER)], self.series_by_key[(1, 101, LOSER)])]
+        db.get_all.return_value = snapshots
+        with patch.object(Series.objects, "filter_by") as filter_by:
+            winner, loser = methods.update_tbd(series)
+        filter_by.assert_not_called()
+        db.get_all.assert_called_once()
+        self.assertEqual([["TBD", "BB"], ["TBD", "AA"]], [winner.group_names, loser.group_names])
+
+
+class MatchGroupTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.players = [Player.dict_to_doc({"name": f"AA00{index}", "group_name": "AA"}) for index in range(1, 5)]
+        matches = [Match(player1="AA001", player2="BB001"), Match(player1="AA002", player2="BB001"),
+                   Match(player1="AA002", player2="BB002")]
+        for match, winner in zip(matches, ("BB001", "BB001", "AA002")):
+            match.winner = winner
+        opponents = [Player.dict_to_doc({"name": f"BB00{index}", "group_name": "BB"}) for index in range(1, 3)]
+        self.match_group = MatchGroup()
+        self.match_group.past_matches = [get_match_player(match, self.players + opponents) for match in matches]
+
+    def test_tally(self):
+        self.assertEqual([(0, 1), (1, 1), (2, 0), (0, 0)], [(self.match_group.won_count(name), self.match_group.lost_count(name))
+                                                            for name in ("AA001", "AA002", "BB001", "AA003")])
+        self.assertEqual(["AA001", "AA003", "AA004"], get_conquest_names(self.players, self.match_group, "AA"))
+        self.assertEqual(["AA003", "AA004"], get_lhs_names(self.players, self.match_group, "AA"))
+
+    def test_added_result_is_counted(self):
+        match_player = get_match_player(Match(player1="AA001", player2="BB002"), self.players + [
+            Player.dict_to_doc({"name": "BB002", "group_name": "BB"})])
+        match_player.match.winner = "BB002"
+        self.match_group.add_past_match(match_player)
+        self.assertEqual(4, len(self.match_group.past_matches))
+        self.assertEqual(2, self.match_group.lost_count("AA001"))
+        self.assertEqual(["AA003", "AA004"], get_conquest_names(self.players, self.match_group, "AA"))
+
+
+class MemoryClientTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.client = MemoryClient()
+        for round_number, series_type in ((102, INITIAL2), (101, INITIAL1), (101, WINNER)):
+            series: Series = Series(1, 1, round_number, series_type)
+            self.client.collection(Series.COLLECTION).document().set(series.doc_to_dict())
+
+    def test_query_through_the_models(self):
+        with self.client:
+            series_list = Series.objects.filter_by(season=1).filter("round", "<", 102).order_by("type").get()
+            self.assertEqual([INITIAL1, WINNER], [series.type for series in series_list])
+            self.assertIsNone(Series.objects.filter_by(season=2).first())
+            self.assertEqual([{"round": 102}], [{"round": row["round"]} for row in
+                                                Series.objects.filter_by(type=INITIAL2).project("round")])
+        self.assertEqual({"queries": 3, "reads": 4}, {"queries": self.client.stats.queries, "reads": self.client.stats.reads})
+
+    def test_batch_is_atomic(self):
+        with self.client:
+            series: Series = Series.objects.filter_by(type=WINNER).first()
+            series.winner = "AA"
+            self.client.collection_dict(Series.COLLECTION).pop(series.id)
+            match: Match = Match(1, 1, 101, WINNER)
+            UnitOfWork().save(series).create(match).commit()  # The update fails and the batch is sent again in full
+            self.assertEqual("AA", Series.get_by_id(series.id).winner)
+            self.assertEqual(WINNER, Match.get_by_id(match.id).type)
+
+
+class SimulatorTestCase(unittest.TestCase):
+
+    def test_same_seed_plays_the_same_votes(self):
+        reports = [SeasonSimulator(random_seed=7).run(max_matches=120) for _ in range(2)]
+        self.assertEqual(120, reports[0].matches_played)
+        self.assertLess(0, reports[0].series_played)
+        self.assertEqual(reports[0].totals, reports[1].totals)
+        self.assertEqual(0, reports[0].steps["update_results"].counts["queries"])
+
+
+if __name__ == '__main__':
+    unittest.main()
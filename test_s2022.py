@@ -0,0 +1,102 @@
+import os
+import unittest
+from unittest.mock import patch
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("FIRESTORE_EMULATOR_PROJECT_ID", "za2021-test")
+
+from counters import add_shard_counts
+from memory_store import MemoryClient
+from models import Player, Standing, Group, Match, MarginTag
+from s2022 import wc_methods
+from s2022.wc_methods import WorldCupRound, get_wc_match, setup_matches, SEASON
+
+GROUP_NAMES = ("AA", "BB", "CC")
+PLAYER_NAMES = [f"{group_name}00{index}" for group_name in GROUP_NAMES for index in range(1, 3)]
+
+
+class WorldCupRoundTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.client = MemoryClient()
+        self.client.install()
+        self.addCleanup(self.client.uninstall)
+        for patcher in (patch.object(wc_methods, "WC_ROUND", WorldCupRound()),
+                        patch.object(wc_methods.FRIENDLY_QUEUE, "_player_names", PLAYER_NAMES)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for group_name in GROUP_NAMES:
+            group = Group()
+            group.name = group_name
+            Group.objects.create(Group.objects.to_dicts([group])[0])
+            Standing.objects.create(Standing(season=SEASON, group_name=group_name).doc_to_dict())
+        for name in PLAYER_NAMES:
+            Player.objects.create({"name": name, "group_name": name[:2]})
+        setup_matches(1, 1, Standing.objects.filter_by(season=SEASON).get())
+        self.matches = Match.objects.filter_by(season=SEASON).order_by("order").get()
+
+    def reads(self, function):
+        reads: int = self.client.stats.reads
+        result = function()
+        return result, self.client.stats.reads - reads
+
+    def test_next_match_reads_the_match_and_its_players(self):
+        self.assertLessEqual(2, len(self.matches))
+        wc_match, reads = self.reads(get_wc_match)
+        self.assertEqual(1, wc_match.match.order)
+        self.assertEqual(len(self.matches), wc_match.last_order)
+        self.assertEqual([wc_match.player1.group_name, wc_match.player2.group_name],
+                         [wc_match.standing1.group_name, wc_match.standing2.group_name])
+        self.assertEqual(3, reads)
+
+    def test_result_advances_the_round(self):
+        wc_match = get_wc_match()
+        wc_match.update_result(wc_match.match.player1, MarginTag.HIGH)
+        standing = Standing.objects.filter_by(season=SEASON, group_name=wc_match.player1.group_name).first()
+        self.assertEqual(3, add_shard_counts([standing])[0].wc_score)
+        next_match, reads = self.reads(get_wc_match)
+        self.assertEqual(2, next_match.match.order)
+        self.assertEqual(3, reads)
+        group_names = [next_match.player1.group_name, next_match.player2.group_name]
+        if standing.group_name in group_names:
+            next_standing = next_match.standing1 if group_names[0] == standing.group_name else next_match.standing2
+            self.assertEqual(3, next_standing.wc_score)
+
+    def test_scores_match_the_counters_voted_by_other_workers(self):
+        Player.objects.get_many_by_names(PLAYER_NAMES)  # Cached before the vote of another worker
+        stored: dict = self.client.collection_dict(Player.COLLECTION)
+        for doc_dict in stored.values():
+            doc_dict.update(played=3, won=3, score="100000003")
+        wc_match = get_wc_match()
+        wc_match.update_result(wc_match.match.player1, MarginTag.HIGH)
+        winner: dict = next(doc_dict for doc_dict in stored.values() if doc_dict["name"] == wc_match.match.player1)
+        self.assertEqual((4, 4, "100000004"), (winner["played"], winner["won"], winner["score"]))
+
+    def test_skips_matches_played_by_other_workers(self):
+        for match in self.matches[:-1]:
+            match.winner = match.player1
+            match.save()
+        lookups: int = self.client.stats.lookups
+        wc_match = get_wc_match()
+        self.assertEqual(len(self.matches), wc_match.match.order)
+        self.assertEqual(2, self.client.stats.lookups - lookups)
+        self.assertEqual(wc_match.match.id, get_wc_match().match.id)
+
+    def test_next_round_after_the_last_match(self):
+        for _ in self.matches:
+            wc_match = get_wc_match()
+            wc_match.update_result(wc_match.match.player1, MarginTag.LOW)
+        self.assertIsNone(get_wc_match())
+        standings = Standing.objects.filter_by(season=SEASON).get()
+        eliminated = [standing.group_name for standing in standings if standing.eliminated == 1]
+        self.assertLess(0, len(eliminated))
+        wc_match = get_wc_match()
+        if len(eliminated) == len(standings) - 1:  # The lowest score was tied
+            self.assertIsNone(wc_match)
+            return
+        self.assertEqual((2, len(self.matches) + 1), (wc_match.match.round, wc_match.match.order))
+        self.assertNotIn(wc_match.player1.group_name, eliminated)
+
+
+if __name__ == '__main__':
+    unittest.main()
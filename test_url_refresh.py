@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+
+import pytz
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("FIRESTORE_EMULATOR_PROJECT_ID", "za2021-test")
+
+from images import ImageObject
+from url_refresh import UrlRefreshScheduler
+
+
+def expiring_players(count: int) -> list:
+    return [{"id": f"id{index}", "name": f"AB{index:03}", "url_expiration": datetime(2026, 1, count - index, tzinfo=pytz.UTC)}
+            for index in range(count)]
+
+
+@patch("url_refresh.sleep")
+@patch("url_refresh.IMAGE_INDEX")
+@patch("url_refresh._DB")
+class UrlRefreshSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
+        patcher = patch.object(UrlRefreshScheduler, "CHECKPOINT_FILE", self.checkpoint)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(UrlRefreshScheduler, "BATCH_SIZE", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def load(self, players: list) -> UrlRefreshScheduler:
+        groups = [{"id": "group-id", "name": "AB", "player_name": "AB002"}]
+        standings = [{"id": "standing-id", "group_name": "AB"}]
+        with patch("documents.TrackedQuery.project", side_effect=[players, groups, standings]):
+            return UrlRefreshScheduler().load()
+
+    def test_earliest_expiry_first_and_copies(self, db: MagicMock, index: MagicMock, _):
+        index.get.side_effect = lambda name: ImageObject(f"images/{name}.jpg", 1, str(), None)
+        scheduler = self.load(expiring_players(3))
+        self.assertEqual(3, scheduler.run())
+        documents: MagicMock = db.collection.return_value.document
+        self.assertEqual(["id2", "group-id", "standing-id", "id1", "id0"], [item.args[0] for item in documents.call_args_list])
+        self.assertEqual(2, db.batch.return_value.commit.call_count)
+        self.assertEqual({"url", "url_name"}, set(db.batch.return_value.update.call_args_list[2].args[1]))
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_interrupted_run_resumes(self, db: MagicMock, index: MagicMock, _):
+        index.get.side_effect = lambda name: ImageObject(f"images/{name}.jpg", 1, str(), None)
+        scheduler = self.load(expiring_players(3))
+        self.assertEqual(2, scheduler.run(max_batches=1))
+        self.assertTrue(os.path.exists(self.checkpoint))
+        db.reset_mock()
+        scheduler = self.load(expiring_players(3))
+        self.assertEqual(1, scheduler.run())
+        db.collection.return_value.document.assert_called_once_with("id0")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("FIRESTORE_EMULATOR_PROJECT_ID", "za2021-test")
+
+from google.cloud.firestore import Increment
+
+from counters import add_shard_counts
+from memory_store import MemoryClient
+from models import Player, Group, Match
+from vote_queue import VoteQueue, VoteUnitOfWork, coalesce
+
+
+class CoalesceTestCase(unittest.TestCase):
+
+    def test_increments_add_up_and_last_value_wins(self):
+        writes = coalesce([("update", "players", "a", {"played": Increment(1), "score": "1"}),
+                           ("merge", "groups_shards", "g-3", {"won": Increment(1), "document_id": "g"}),
+                           ("update", "players", "a", {"played": Increment(1), "score": "2"}),
+                           ("merge", "groups_shards", "g-5", {"won": Increment(2), "document_id": "g"}),
+                           ("set", "matches", "m", {"winner": "a"}), ("update", "matches", "m", {"played": Increment(1)})])
+        self.assertEqual([("update", "players", "a", {"played": Increment(2), "score": "2"}),
+                          ("merge", "groups_shards", "g-3", {"won": Increment(3), "document_id": "g"}),
+                          ("set", "matches", "m", {"winner": "a", "played": 1})], writes)
+
+
+class VoteQueueTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.client = MemoryClient()
+        self.client.install()
+        self.addCleanup(self.client.uninstall)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.queue = VoteQueue(os.path.join(directory.name, "votes.db"))
+        patcher = patch("vote_queue.VOTE_QUEUE", self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in ("AA001", "BB001"):
+            Player.objects.create({"name": name, "group_name": name[:2]})
+            Group.objects.create({"name": name[:2]})
+
+    def vote(self, key: str, winner: str, loser: str, synced=()) -> int:
+        # Read fresh like the vote handlers, so the votes still queued are not in the counters read
+        players = Player.objects.fresh.get_many_by_names([winner, loser])
+        groups = Group.objects.fresh.get_many_by_names([winner[:2], loser[:2]])
+        players[winner].update_score(played=1, won=1)
+        players[loser].update_score(played=1)
+        groups[winner[:2]].update_score(played=1, won=1)
+        groups[loser[:2]].update_score(played=1)
+        match = Match(player1=winner, player2=loser)
+        match.winner = winner
+        unit_of_work = VoteUnitOfWork(key, synced).save(*players.values(), *groups.values()).create(match)
+        unit_of_work.commit()
+        return self.queue.pending_count
+
+    def stored(self, collection: str) -> dict:
+        return {doc_dict.get("name", doc_id): doc_dict for doc_id, doc_dict in self.client.collection_dict(collection).items()}
+
+    def test_votes_are_applied_in_coalesced_batches(self):
+        writes: int = self.client.stats.writes
+        self.assertEqual(1, self.vote("m1", "AA001", "BB001"))
+        self.assertEqual(2, self.vote("m2", "AA001", "BB001"))
+        self.assertEqual(2, self.vote("m2", "BB001", "AA001"))  # Submitted again
+        self.assertEqual(writes, self.client.stats.writes)
+        self.assertEqual(2, self.queue.drain())
+        self.assertEqual(0, self.queue.pending_count)
+        players = self.stored(Player.COLLECTION)
+        self.assertEqual([(2, 2, "100000002"), (2, 0, "000000002")],
+                         [(players[name]["played"], players[name]["won"], players[name]["score"]) for name in ("AA001", "BB001")])
+        self.assertEqual(2, len(self.client.collection_dict(Match.COLLECTION)))
+        groups = add_shard_counts(Group.objects.fresh.get())
+        self.assertEqual({"AA": (2, 2), "BB": (2, 0)}, {group.name: (group.played, group.won) for group in groups})
+        # 2 players, 2 groups with their shown player, 2 group shards, 2 matches and the marker instead of 7 + 5 writes
+        self.assertEqual(9, self.client.stats.writes - writes)
+
+    def test_replay_is_ignored(self):
+        self.vote("m1", "AA001", "BB001")
+        self.queue.drain()
+        self.queue._connection.execute("UPDATE votes SET applied = 0")  # Stopped before the votes were marked applied
+        self.assertEqual(1, self.queue.drain())
+        self.assertEqual(1, self.stored(Player.COLLECTION)["AA001"]["played"])
+
+    def test_deleted_document_is_created_again(self):
+        self.vote("m1", "AA001", "BB001")
+        player_id: str = Player.objects.fresh.filter_by(name="AA001").first().id
+        del self.client.collection_dict(Player.COLLECTION)[player_id]
+        self.assertEqual(1, self.queue.drain())
+        self.assertEqual((1, 1, "100000001"), tuple(self.stored(Player.COLLECTION)["AA001"][field]
+                                                    for field in ("played", "won", "score")))
+        self.assertEqual(1, self.stored(Player.COLLECTION)["BB001"]["played"])
+
+    def test_synced_documents_are_written_at_once(self):
+        self.vote("m1", "AA001", "BB001", synced=[Match])
+        self.assertEqual(["AA001"], [match["winner"] for match in self.client.collection_dict(Match.COLLECTION).values()])
+        self.assertEqual(0, self.stored(Player.COLLECTION)["AA001"]["played"])
+        self.queue.drain()
+        self.assertEqual(1, self.stored(Player.COLLECTION)["AA001"]["played"])
+        self.assertEqual(1, len(self.client.collection_dict(Match.COLLECTION)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+import json
+import os
+from concurrent.futures import Future, wait, FIRST_COMPLETED, ALL_COMPLETED
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Dict, List, Optional, Set
+
+import pytz
+
+from derivatives import DerivativeStage
+from documents import UnitOfWork
+from executor import io_executor
+from images import IMAGE_INDEX, IMAGE_FOLDER, DERIVATIVE_SIZES, get_derivative_name, get_crc32c, ImageObject
+from models import Player, Group
+
+
+def is_image_file(filename: str) -> bool:
+    if filename.startswith("firestore_export"):
+        return False
+    return filename[-5:] != ".json" and filename[-7:] != ".pickle" and filename[-4:] != ".log"
+
+
+class UploadPipeline:
+    # Imports the files of the temp folder as new players. Up to UPLOAD_WORKERS images and their derivatives are uploaded
+    # at a time and the players are created with their groups in batches of FLUSH_SIZE. A file is removed only after its
+    # player is committed and the manifest lists the files already imported, so a crashed import resumes where it stopped.
+    # Uploads are decided by content. The CRC32C of a file is compared with the metadata of the stored objects: unchanged
+    # bytes are not sent again, a renamed image is copied within the bucket and a changed image of an existing player
+    # replaces the stored one along with its derivatives.
+    FOLDER: str = "temp"
+    MANIFEST_FILE: str = "temp/upload_manifest.json"
+    UPLOAD_WORKERS: int = 16
+    FLUSH_SIZE: int = 200  # Players per batch. With their groups it stays below the limit of 500 writes.
+    URL_VALIDITY: timedelta = timedelta(days=365)
+
+    def __init__(self, new_groups: Dict[str, str], upload_images: bool = True):
+        self.new_groups: Dict[str, str] = new_groups  # group name -> fullname of the groups that can be created
+        self.upload_images: bool = upload_images
+        self._player_names: Set[str] = set()
+        self._groups: Dict[str, Group] = dict()
+        self._imported: List[str] = list()
+        self._pending: List[str] = list()  # Files whose players are not committed yet
+        self._existing: Set[str] = set()  # Files of existing players whose stored image is checked for changes
+        self._new_players: List[Player] = list()
+        self._created_groups: Dict[str, Group] = dict()
+        self._changed_groups: Dict[str, Group] = dict()
+        self._start_time: datetime = datetime.now(tz=pytz.UTC)
+
+    def __repr__(self):
+        return f"UP:I#{len(self._imported)}:P#{len(self._pending)}"
+
+    def _read_manifest(self) -> List[str]:
+        if not os.path.exists(self.MANIFEST_FILE):
+            return list()
+        with open(self.MANIFEST_FILE) as file:
+            return json.load(file)["imported"]
+
+    def _write_manifest(self) -> None:
+        with open(self.MANIFEST_FILE, "w") as file:
+            json.dump({"imported": self._imported}, file)
+
+    def _clear_manifest(self) -> None:
+        if os.path.exists(self.MANIFEST_FILE):
+            os.remove(self.MANIFEST_FILE)
+
+    def load(self) -> "UploadPipeline":
+        self._imported = self._read_manifest()
+        if self._imported:
+            print(f"Resuming upload. {len(self._imported)} players already imported.")
+        self._player_names = {doc_dict["name"] for doc_dict in Player.objects.project("name")}
+        self._groups = {group.name: group for group in Group.objects.get()}
+        if self.upload_images:
+            IMAGE_INDEX.load()
+        return self
+
+    def _file_path(self, filename: str) -> str:
+        return os.path.join(self.FOLDER, filename)
+
+    def _filenames(self) -> List[str]:
+        imported: Set[str] = set(self._imported)
+        filenames: List[str] = list()
+        for filename in sorted(os.listdir(self.FOLDER)):
+            if not is_image_file(filename):
+                continue
+            if filename in imported:  # Committed before a crash but not removed
+                os.remove(self._file_path(filename))
+                continue
+            player_name, group_name = filename[:5], filename[:2]
+            if player_name in self._player_names:
+                if self.upload_images and IMAGE_INDEX.get_object(f"{IMAGE_FOLDER}{filename}"):
+                    self._existing.add(filename)
+                    filenames.append(filename)
+                    continue
+                print(f"{player_name} already exists in players. Not uploaded.")
+                continue
+            if group_name not in self._groups and group_name not in self.new_groups:
+                print(f"{player_name}: Invalid group name. Group not initialized in NEW_PLAYERS.")
+                continue
+            self._player_names.add(player_name)
+            filenames.append(filename)
+        return filenames
+
+    @staticmethod
+    def _missing_derivatives(player_name: str) -> List[str]:
+        return [size for size in DERIVATIVE_SIZES if not IMAGE_INDEX.get_derivative(player_name, size)]
+
+    def _upload_original(self, filename: str) -> List[str]:
+        # Returns the derivative sizes that are still to be uploaded
+        player_name: str = filename[:5]
+        object_name: str = f"{IMAGE_FOLDER}{filename}"
+        crc32c: str = get_crc32c(self._file_path(filename))
+        stored: Optional[ImageObject] = IMAGE_INDEX.get_object(object_name)
+        if stored and stored.crc32c == crc32c:
+            print(f"{filename} already exists in the images folder of cloud storage. Not uploaded.")
+            return self._missing_derivatives(player_name)
+        source: Optional[ImageObject] = IMAGE_INDEX.find_by_crc32c(crc32c) if not stored else None
+        if source:
+            print(f"{filename} is a copy of {source.name}. Copied in cloud storage.")
+            IMAGE_INDEX.copy(source.name, object_name)
+            for size in DERIVATIVE_SIZES:
+                derivative: Optional[ImageObject] = IMAGE_INDEX.get_derivative(source.player_name, size)
+                if derivative and not IMAGE_INDEX.get_derivative(player_name, size):
+                    IMAGE_INDEX.copy(derivative.name, get_derivative_name(size, player_name))
+            return self._missing_derivatives(player_name)
+        if stored:
+            print(f"{filename} has changed. Uploaded again with its derivatives.")
+        blob = IMAGE_INDEX.bucket.blob(object_name)
+        blob.upload_from_filename(self._file_path(filename), checksum="crc32c")
+        IMAGE_INDEX.add(blob)
+        return list(DERIVATIVE_SIZES) if stored else self._missing_derivatives(player_name)
+
+    def _upload(self, stage: DerivativeStage, filename: str) -> Optional[Dict[str, str]]:
+        # Runs in the io executor. Returns the signed url fields of the player.
+        player_name: str = filename[:5]
+        file_path: str = self._file_path(filename)
+        try:
+            missing: List[str] = self._upload_original(filename)
+            if missing:
+                derivatives: Dict[str, bytes] = stage.result(file_path)
+                for size in missing:
+                    blob = IMAGE_INDEX.bucket.blob(get_derivative_name(size, player_name))
+                    blob.upload_from_string(derivatives[size], content_type="image/webp")
+                    IMAGE_INDEX.add(blob)
+        finally:
+            stage.discard(file_path)
+        return IMAGE_INDEX.sign_urls(player_name, self.URL_VALIDITY)
+
+    def _add_player(self, filename: str, urls: Dict[str, str]) -> None:
+        player: Player = Player()
+        player.name = filename[:5]
+        player.group_name = filename[:2]
+        player.qualification_rank = 99999
+        for field, url in urls.items():
+            setattr(player, field, url)
+        if urls:
+            player.url_expiration = datetime.now(tz=pytz.UTC) + self.URL_VALIDITY
+        group: Optional[Group] = self._groups.get(player.group_name)
+        if not group:
+            group = Group()
+            group.name = player.group_name
+            group.fullname = self.new_groups[player.group_name]
+            for field in urls:
+                setattr(group, field, getattr(player, field))
+            group.url_expiration = player.url_expiration
+            group.player_name = player.name
+            group.qualification_locked = True
+            self._groups[group.name] = group
+            self._created_groups[group.name] = group
+        elif group.id:
+            self._changed_groups[group.name] = group
+        group.player_count += 1
+        self._new_players.append(player)
+        self._pending.append(filename)
+        if len(self._new_players) >= self.FLUSH_SIZE:
+            self._flush()
+
+    def _collect(self, in_flight: Dict[Future, str], return_when: str) -> None:
+        done, _ = wait(in_flight, return_when=return_when)
+        for future in done:
+            filename: str = in_flight.pop(future)
+            try:
+                urls: Optional[Dict[str, str]] = future.result()
+            except Exception as error:
+                print(f"{filename}: Upload failed. {error}")
+                continue
+            if not urls:
+                print(f"{filename[:5]}: Issue in creating url. Not uploaded.")
+                continue
+            if filename in self._existing:  # The stored image is now the same as the file
+                os.remove(self._file_path(filename))
+                continue
+            self._add_player(filename, urls)
+
+    def _flush(self) -> None:
+        if not self._new_players:
+            return
+        UnitOfWork().create(*self._new_players, *self._created_groups.values()) \
+            .save(*self._changed_groups.values()).commit()
+        self._imported.extend(self._pending)
+        self._write_manifest()
+        for filename in self._pending:
+            os.remove(self._file_path(filename))
+        seconds: int = (datetime.now(tz=pytz.UTC) - self._start_time).seconds
+        print(f"{len(self._imported)} players imported in {seconds} seconds.")
+        self._pending, self._new_players = list(), list()
+        self._created_groups, self._changed_groups = dict(), dict()
+
+    def run(self) -> int:
+        # Returns the number of players imported. The manifest is removed once every file is imported.
+        filenames: List[str] = self._filenames()
+        if not self.upload_images:
+            for filename in filenames:
+                self._add_player(filename, dict())
+        else:
+            in_flight: Dict[Future, str] = dict()
+            with DerivativeStage() as stage:
+                for filename in filenames:
+                    if len(in_flight) >= self.UPLOAD_WORKERS:
+                        self._collect(in_flight, FIRST_COMPLETED)
+                    if filename not in self._existing and self._missing_derivatives(filename[:5]):
+                        stage.submit(self._file_path(filename))
+                    in_flight[io_executor.submit(partial(self._upload, stage, filename))] = filename
+                self._collect(in_flight, ALL_COMPLETED)
+        self._flush()
+        self._clear_manifest()
+        return len(self._imported)
@@ -0,0 +1,121 @@
+import json
+import os
+from datetime import datetime, timedelta
+from heapq import heapify, heappop
+from time import monotonic, sleep
+from typing import List, Tuple, Dict, Optional
+
+import pytz
+# noinspection PyProtectedMember
+from firestore_ci.firestore_ci import _DB
+from google.cloud.firestore import WriteBatch
+
+from images import IMAGE_INDEX
+from models import Player, Group, Standing
+
+
+class UrlRefreshScheduler:
+    # Re-signs the image urls that expire within REFRESH_WINDOW, earliest expiry first, in small rate limited batches.
+    # Only the expiring players are read. Each batch writes just the url fields of its players and of the group and
+    # standing that copy the url of their star player. Progress is checkpointed after every batch, so that an
+    # interrupted run resumes with the same window and skips the players already refreshed.
+    URL_VALIDITY: timedelta = timedelta(days=365)
+    REFRESH_WINDOW: timedelta = timedelta(days=30)
+    BATCH_SIZE: int = 50
+    BATCH_SECONDS: float = 2.0  # Minimum duration of a batch
+    CHECKPOINT_FILE: str = "temp/url_refresh_checkpoint.json"
+    STANDING_SEASON: int = 2022  # Only the world cup standings copy the group url
+
+    def __init__(self):
+        self._queue: List[Tuple[datetime, str, str]] = list()  # Heap of (url_expiration, player id, player name)
+        self._horizon: Optional[datetime] = None
+        self._done: List[str] = list()
+        self._group_by_star: Dict[str, Tuple[str, str]] = dict()  # star player name -> (group id, group name)
+        self._standing_by_group: Dict[str, str] = dict()  # group name -> standing id
+
+    def __repr__(self):
+        return f"URS:Q#{len(self._queue)}:D#{len(self._done)}"
+
+    def _read_checkpoint(self) -> Optional[dict]:
+        if not os.path.exists(self.CHECKPOINT_FILE):
+            return None
+        with open(self.CHECKPOINT_FILE) as file:
+            return json.load(file)
+
+    def _write_checkpoint(self) -> None:
+        with open(self.CHECKPOINT_FILE, "w") as file:
+            json.dump({"horizon": self._horizon.isoformat(), "done": self._done}, file)
+
+    def _clear_checkpoint(self) -> None:
+        if os.path.exists(self.CHECKPOINT_FILE):
+            os.remove(self.CHECKPOINT_FILE)
+
+    def load(self) -> "UrlRefreshScheduler":
+        checkpoint: Optional[dict] = self._read_checkpoint()
+        if checkpoint:
+            self._horizon = datetime.fromisoformat(checkpoint["horizon"])
+            self._done = checkpoint["done"]
+            print(f"Resuming url refresh. {len(self._done)} players already refreshed.")
+        else:
+            self._horizon = datetime.now(tz=pytz.UTC) + self.REFRESH_WINDOW
+        done: set = set(self._done)
+        doc_dicts: List[dict] = Player.objects.filter("url_expiration", Player.objects.LESS_THAN, self._horizon) \
+            .project("name", "url_expiration")
+        self._queue = [(doc_dict["url_expiration"], doc_dict["id"], doc_dict["name"]) for doc_dict in doc_dicts
+                       if doc_dict["id"] not in done]
+        heapify(self._queue)
+        if not self._queue:
+            return self
+        self._group_by_star = {doc_dict["player_name"]: (doc_dict["id"], doc_dict["name"])
+                               for doc_dict in Group.objects.project("name", "player_name") if doc_dict.get("player_name")}
+        self._standing_by_group = {doc_dict["group_name"]: doc_dict["id"] for doc_dict in
+                                   Standing.objects.filter_by(season=self.STANDING_SEASON).project("group_name")}
+        return self
+
+    def _next_batch(self) -> List[Tuple[datetime, str, str]]:
+        return [heappop(self._queue) for _ in range(min(self.BATCH_SIZE, len(self._queue)))]
+
+    def _refresh(self, batch: List[Tuple[datetime, str, str]]) -> int:
+        write_batch: WriteBatch = _DB.batch()
+        refreshed: List[str] = list()
+        group_ids: List[str] = list()
+        for _, doc_id, player_name in batch:
+            fields: Optional[dict] = IMAGE_INDEX.sign_urls(player_name, self.URL_VALIDITY)
+            if not fields:
+                print(f"{player_name} Storage Image does not exists.")
+                continue
+            fields["url_expiration"] = datetime.now(tz=pytz.UTC) + self.URL_VALIDITY
+            write_batch.update(_DB.collection(Player.COLLECTION).document(doc_id), fields)
+            refreshed.append(doc_id)
+            if player_name not in self._group_by_star:
+                continue
+            group_id, group_name = self._group_by_star[player_name]
+            write_batch.update(_DB.collection(Group.COLLECTION).document(group_id), fields)
+            group_ids.append(group_id)
+            if group_name in self._standing_by_group:  # A standing only mirrors the url of the star
+                write_batch.update(_DB.collection(Standing.COLLECTION).document(self._standing_by_group[group_name]),
+                                   {"url": fields["url"], "url_name": player_name})
+        if refreshed:
+            write_batch.commit()
+        for doc_id in refreshed:
+            Player.objects.cache.discard(doc_id)
+        for group_id in group_ids:
+            Group.objects.cache.discard(group_id)
+        self._done.extend(doc_id for _, doc_id, _ in batch)
+        self._write_checkpoint()
+        return len(refreshed)
+
+    def run(self, max_batches: Optional[int] = None) -> int:
+        # Returns the number of players whose url was refreshed. The checkpoint is removed once the queue is empty.
+        refreshed_count: int = 0
+        batch_count: int = 0
+        while self._queue and (max_batches is None or batch_count < max_batches):
+            start: float = monotonic()
+            refreshed_count += self._refresh(self._next_batch())
+            batch_count += 1
+            print(f"{refreshed_count} urls refreshed. {len(self._queue)} pending.")
+            if self._queue:
+                sleep(max(self.BATCH_SECONDS - (monotonic() - start), 0))
+        if not self._queue:
+            self._clear_checkpoint()
+        return refreshed_count
@@ -0,0 +1,256 @@
+import logging
+import os
+import pickle
+import sqlite3
+from datetime import datetime
+from itertools import chain
+from threading import RLock, Event, Thread
+from time import time
+from typing import List, Dict, Optional, Tuple, Iterable, Any
+from uuid import uuid4
+
+import pytz
+# noinspection PyProtectedMember
+from firestore_ci.firestore_ci import _DB, _REFERENCE
+from google.cloud.firestore import Increment, Transaction, DocumentReference, transactional
+
+from documents import Write, commit_writes, TrackedDocument
+from leaderboard import ResultUnitOfWork, record_leaderboards
+
+logger = logging.getLogger(__name__)
+
+# Write-behind ingestion of the votes. A vote appends its writes to a local SQLite file in WAL mode and returns after
+# the fsync of that append. The aggregator applies the votes in batches, in the order they were taken, and coalesces
+# the writes of a batch per document: the increments add up and the last value of a field wins.
+# Every Firestore batch is applied in a transaction that also creates a marker document named after the votes in it. A
+# batch that is applied again after a crash finds its marker and is skipped, so a replay never counts a vote twice.
+# The derived fields of the votes were derived from counters that lacked the votes still queued. The transaction derives
+# them again from the stored counters plus the ones of the batch.
+VOTE_QUEUE_ENABLED: bool = os.environ.get("VOTE_QUEUE") == "on"
+
+
+class VoteQueue:
+    PATH: str = "temp/vote_queue.db"
+    MARKER_COLLECTION: str = "vote_batches"
+    BATCH_LIMIT: int = 500  # Maximum number of writes Firestore allows in a single batch. One of them is the marker.
+    MAX_VOTES: int = 50  # Per batch of the aggregator
+    FLUSH_SECONDS: float = 1.0
+    KEEP_SECONDS: int = 3600  # Applied votes are kept this long, so that the same vote key is not taken twice
+
+    def __init__(self, path: str = None):
+        self.path: str = path or self.PATH
+        self._lock: RLock = RLock()
+        self._connection: sqlite3.Connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=FULL")  # Every commit is flushed to the disk
+        self._connection.execute("CREATE TABLE IF NOT EXISTS votes (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                 "key TEXT UNIQUE NOT NULL, payload BLOB NOT NULL, created REAL NOT NULL, batch TEXT, "
+                                 "applied INTEGER NOT NULL DEFAULT 0)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._connection.execute("INSERT OR IGNORE INTO meta VALUES ('queue_id', ?)", (uuid4().hex,))
+        self.queue_id: str = self._connection.execute("SELECT value FROM meta WHERE name = 'queue_id'").fetchone()[0]
+        self._wake: Event = Event()
+        self._aggregator: Optional[Thread] = None
+
+    def __repr__(self):
+        return f"VQ:{self.queue_id[:8]}:P#{self.pending_count}"
+
+    @property
+    def pending_count(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM votes WHERE applied = 0").fetchone()[0]
+
+    def append(self, key: str, writes: List[Write], documents: Iterable[TrackedDocument] = ()) -> bool:
+        # The documents are recorded on the leaderboards once the vote is applied. A key that was taken is ignored.
+        payload: bytes = pickle.dumps({"writes": writes, "documents": [(document.COLLECTION, document.id,
+                                                                        document.doc_to_dict()) for document in documents]})
+        with self._lock:
+            cursor = self._connection.execute("INSERT OR IGNORE INTO votes (key, payload, created) VALUES (?, ?, ?)",
+                                              (key, payload, time()))
+        self._wake.set()
+        return cursor.rowcount == 1
+
+    def _take_batch(self) -> Optional[str]:
+        # A batch that was taken and not applied is applied again with the same votes, so that its markers match
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute("SELECT batch FROM votes WHERE applied = 0 AND batch IS NOT NULL "
+                                               "ORDER BY seq LIMIT 1").fetchone()
+                if row:
+                    return row[0]
+                seqs: List[int] = [row[0] for row in self._connection.execute(
+                    "SELECT seq FROM votes WHERE batch IS NULL ORDER BY seq LIMIT ?", (self.MAX_VOTES,))]
+                if not seqs:
+                    return None
+                batch_id: str = f"{self.queue_id}-{seqs[0]}"
+                self._connection.execute(f"UPDATE votes SET batch = ? WHERE seq IN ({','.join('?' * len(seqs))})",
+                                         (batch_id, *seqs))
+                return batch_id
+            finally:
+                self._connection.execute("COMMIT")
+
+    def _load_batch(self, batch_id: str) -> List[dict]:
+        with self._lock:
+            rows = self._connection.execute("SELECT payload FROM votes WHERE batch = ? ORDER BY seq", (batch_id,))
+            return [pickle.loads(row[0]) for row in rows]
+
+    def _mark_applied(self, batch_id: str) -> None:
+        with self._lock:
+            self._connection.execute("UPDATE votes SET applied = 1 WHERE batch = ?", (batch_id,))
+            self._connection.execute("DELETE FROM votes WHERE applied = 1 AND created < ?", (time() - self.KEEP_SECONDS,))
+
+    def _commit(self, marker_id: str, writes: List[Write], vote_count: int,
+                documents: Dict[Tuple[str, str], dict]) -> Dict[Tuple[str, str], dict]:
+        # Returns the values of the updated fields as applied
+        marker_ref: DocumentReference = _DB.collection(self.MARKER_COLLECTION).document(marker_id)
+        marker: dict = {"votes": vote_count, "writes": len(writes), "applied": datetime.now(tz=pytz.UTC)}
+        return _apply_in_transaction(_DB.transaction(), marker_ref, marker, writes, documents)
+
+    def apply_next(self) -> int:
+        # Applies the next batch of votes and returns the number of votes in it
+        batch_id: Optional[str] = self._take_batch()
+        if not batch_id:
+            return 0
+        votes: List[dict] = self._load_batch(batch_id)
+        writes: List[Write] = coalesce(chain.from_iterable(vote["writes"] for vote in votes))
+        documents: Dict[Tuple[str, str], dict] = {(collection, doc_id): doc_dict for vote in votes
+                                                  for collection, doc_id, doc_dict in vote["documents"]}
+        chunk_size: int = self.BATCH_LIMIT - 1
+        values: Dict[Tuple[str, str], dict] = dict()
+        for index in range(0, len(writes), chunk_size):
+            values.update(self._commit(f"{batch_id}-{index // chunk_size}", writes[index: index + chunk_size], len(votes),
+                                       documents))
+        self._mark_applied(batch_id)
+        for key, applied in values.items():
+            documents.get(key, dict()).update(applied)
+        record_leaderboards([_REFERENCE[collection].dict_to_doc(doc_dict, doc_id)
+                             for (collection, doc_id), doc_dict in documents.items()])
+        return len(votes)
+
+    def drain(self) -> int:
+        vote_count: int = 0
+        while True:
+            applied: int = self.apply_next()
+            if not applied:
+                return vote_count
+            vote_count += applied
+
+    def _aggregate_forever(self) -> None:
+        while True:
+            try:
+                self.drain()
+            except Exception:
+                logger.exception(f"Unable to apply the votes of {self}. Retrying.")
+            self._wake.wait(timeout=self.FLUSH_SECONDS)
+            self._wake.clear()
+
+    def start(self) -> None:
+        # Called once per worker process at startup. The votes left by a previous process are applied first.
+        if self._aggregator is None:
+            self._aggregator = Thread(target=self._aggregate_forever, name="vote-aggregator", daemon=True)
+            self._aggregator.start()
+
+
+def _apply(collection: str, doc_id: str, fields: dict, doc_dict: dict) -> dict:
+    # The values of the fields after they are written to the document. The derived fields they feed are derived again.
+    document: TrackedDocument = _REFERENCE[collection].dict_to_doc(doc_dict, doc_id)
+    for field, value in fields.items():
+        setattr(document, field, getattr(document, field) + value.value if isinstance(value, Increment) else value)
+    document.derive_fields()
+    derived_fields: set = set(document.DERIVED_FIELDS) if set(document.DERIVED_FIELDS) & set(fields) else set()
+    return {field: getattr(document, field) for field in set(fields) | derived_fields}
+
+
+@transactional
+def _apply_in_transaction(transaction: Transaction, marker_ref: DocumentReference, marker: dict, writes: List[Write],
+                          documents: Dict[Tuple[str, str], dict]) -> Dict[Tuple[str, str], dict]:
+    # Every read comes before the writes. The updated documents are read, so that their derived fields are derived from
+    # the stored counters. A document deleted since the votes is created again from the last vote on it.
+    updated: List[Tuple[str, str]] = [(collection, doc_id) for operation, collection, doc_id, _ in writes
+                                      if operation == "update"]
+    references: List[DocumentReference] = [marker_ref] + [_DB.collection(collection).document(doc_id)
+                                                           for collection, doc_id in updated]
+    snapshots: dict = {snapshot.reference.path: snapshot for snapshot in _DB.get_all(references, transaction=transaction)}
+    if snapshots[marker_ref.path].exists:  # Applied before
+        return dict()
+    values: Dict[Tuple[str, str], dict] = dict()
+    for operation, collection, doc_id, fields in writes:
+        doc_ref: DocumentReference = _DB.collection(collection).document(doc_id)
+        if operation != "update":
+            transaction.set(doc_ref, fields, merge=operation == "merge")
+            continue
+        snapshot = snapshots[doc_ref.path]
+        if not snapshot.exists:  # Like the full save of the last vote on it
+            doc_dict: Optional[dict] = documents.get((collection, doc_id))
+            transaction.set(doc_ref, doc_dict if doc_dict else fields, merge=not doc_dict)
+            continue
+        values[(collection, doc_id)] = _apply(collection, doc_id, fields, snapshot.to_dict())
+        derived: dict = {field: value for field, value in values[(collection, doc_id)].items()
+                         if field in _REFERENCE[collection].DERIVED_FIELDS}
+        transaction.update(doc_ref, dict(fields, **derived))
+    transaction.create(marker_ref, marker)
+    return values
+
+
+def _combine(last_value: Any, value: Any, is_set: bool) -> Any:
+    if not isinstance(value, Increment):
+        return value
+    if isinstance(last_value, Increment):
+        return Increment(last_value.value + value.value)
+    if isinstance(last_value, (int, float)) and not isinstance(last_value, bool):
+        return last_value + value.value
+    return value.value if is_set else value
+
+
+def coalesce(writes: Iterable[Write]) -> List[Write]:
+    # One write per document. The increments for the shards of a document go to the first shard written.
+    coalesced: Dict[Tuple[str, str], Tuple[str, dict]] = dict()
+    shard_ids: Dict[Tuple[str, str], str] = dict()  # (shard collection, document id) -> shard id
+    for operation, collection, doc_id, fields in writes:
+        if operation == "merge" and "document_id" in fields:
+            doc_id = shard_ids.setdefault((collection, fields["document_id"]), doc_id)
+        key: Tuple[str, str] = (collection, doc_id)
+        if key not in coalesced or operation == "set":
+            coalesced[key] = (operation, dict(fields))
+            continue
+        last_operation, last_fields = coalesced[key]
+        for field, value in fields.items():
+            last_fields[field] = _combine(last_fields.get(field), value, last_operation == "set")
+    return [(operation, collection, doc_id, fields) for (collection, doc_id), (operation, fields) in coalesced.items()]
+
+
+VOTE_QUEUE: Optional[VoteQueue] = VoteQueue() if VOTE_QUEUE_ENABLED else None
+
+
+class VoteUnitOfWork(ResultUnitOfWork):
+    # Queues the writes of a vote when the vote queue is on. The documents of the synced classes are written before the
+    # response as usual, since the next request is served from them. The ranks move in memory at once.
+
+    def __init__(self, key: Optional[str] = None, synced: Iterable[type] = ()):
+        super().__init__()
+        self.key: str = key or uuid4().hex
+        self._synced: set = {document_class.COLLECTION for document_class in synced}
+        self._queue: Optional[VoteQueue] = VOTE_QUEUE
+
+    def _commit_batch(self, created_ids: List[str], missing: Iterable[Tuple[str, str]] = ()) -> None:
+        if not self._queue:
+            return super()._commit_batch(created_ids, missing)
+        writes: List[Write] = self._writes(created_ids, missing)
+        synced: List[Write] = [write for write in writes if write[1] in self._synced]
+        if synced:
+            commit_writes(synced)
+        # The documents as stored, without the increments sent to their shards
+        self._queue.append(self.key, [write for write in writes if write[1] not in self._synced],
+                           [self._stored_copy(document) for document in self._saved])
+
+    def _commit_rank_updates(self, rank_updates: Dict[Tuple[type, str], dict]) -> None:
+        if not self._queue:
+            return super()._commit_rank_updates(rank_updates)
+        writes: List[Write] = [("update", document_class.COLLECTION, doc_id, fields)
+                               for (document_class, doc_id), fields in rank_updates.items()]
+        self._queue.append(f"{self.key}-ranks", writes)
+
+    def _record_leaderboards(self, saved: List[TrackedDocument]) -> None:
+        if not self._queue:
+            super()._record_leaderboards(saved)